@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+Fake vLLM / OpenAI chat server for benchmarking vllm-tool-proxy.py
+
+Answers /v1/chat/completions (streaming and not), /v1/models, /health and a
+minimal /metrics without a GPU, with a tunable cost model:
+
+  --prefill-ms         delay before the first token
+  --prefill-ms-per-1k  extra delay per 1000 prompt tokens not in the prefix
+                       cache (tools and messages, in blocks of 16 tokens,
+                       as vLLM's automatic prefix caching does; warm-up
+                       testing)
+  --tokens-per-sec     decode speed after that
+  --completion-tokens  tokens of filler text per response
+  --tool-format        how a tool call comes back when the request has tools:
+                         none       plain text only
+                         native     proper tool_calls (vLLM parser worked)
+                         tags       <tools>{...}</tools> in content
+                         bare       one-line JSON object in content
+                         multiline  pretty-printed JSON object in content
+  --tool-tail          what the model writes after a text-mode tool call:
+                         none       nothing (the turn ends)
+                         repeat     the same call again and again
+                         junk       a leaked <|im_start|> and more text
+  --text-tail          what the model writes after its text when there is no
+                       tool call: none, repeat (the text again and again) or
+                       junk, as for --tool-tail
+  --tail-tokens        how long either tail runs (early-cutoff and
+                       degeneration testing)
+  --fail-rate          fraction of chat requests answered 503 (retry testing)
+  --slow-rate          fraction of chat requests given --slow-ms extra prefill
+                       (tail latency, for hedging)
+
+Like vLLM, a generation is aborted as soon as its client disconnects
+(mock_requests_aborted_total in /metrics).
+
+Any of these can be overridden per request with an X-Mock-* header, e.g.
+X-Mock-Tool-Format: bare or X-Mock-Completion-Tokens: 512.
+
+Stdlib only (asyncio), so one process can hold thousands of streams open
+without becoming the bottleneck it is meant to measure around.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import random
+import time
+import uuid
+
+CONFIG = {
+    'prefill_ms': 50.0,
+    'prefill_ms_per_1k': 0.0,
+    'tokens_per_sec': 100.0,
+    'completion_tokens': 64,
+    'tool_format': 'tags',
+    'tool_tail': 'none',
+    'text_tail': 'none',
+    'tail_tokens': 256,
+    'fail_rate': 0.0,
+    'slow_rate': 0.0,
+    'slow_ms': 2000.0,
+}
+MODEL = 'mock-model'
+WORDS = ['the', 'proxy', 'streams', 'tokens', 'from', 'a', 'fake', 'model', 'so', 'we',
+         'can', 'measure', 'what', 'it', 'costs', 'per', 'request']
+# Filler text: a fixed pseudo-random word sequence, so long completions do not
+# look like a repetition loop to the proxy's degeneration check
+FILLER = [word + ' ' for word in random.Random(0).choices(WORDS, k=1 << 16)]
+
+running = 0
+served = 0
+aborted = 0
+BLOCK_CHARS = 64                        # about 16 tokens
+prefix_blocks = collections.OrderedDict()   # chained block hash -> None (LRU)
+PREFIX_BLOCKS_MAX = 1 << 16
+prefix_queries = prefix_hits = 0        # prompt tokens, as vllm:prefix_cache_* counts them
+
+
+def dumps(obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def request_config(headers):
+    config = dict(CONFIG)
+    for key, value in config.items():
+        override = headers.get('x-mock-' + key.replace('_', '-'))
+        if override is not None:
+            config[key] = type(value)(override)
+    return config
+
+
+def tool_call_text(fmt):
+    call = {'name': 'exec', 'arguments': {'command': 'ls -la /tmp', 'workdir': '/home/user'}}
+    if fmt == 'tags':
+        return '\n<tools>\n' + json.dumps(call) + '\n</tools>'
+    if fmt == 'bare':
+        return '\n' + json.dumps(call)
+    if fmt == 'multiline':
+        return '\n' + json.dumps(call, indent=2)
+    return ''
+
+
+def native_tool_call():
+    return {'id': f'chatcmpl-tool-{uuid.uuid4().hex[:16]}', 'type': 'function',
+            'function': {'name': 'exec', 'arguments': json.dumps({'command': 'ls -la /tmp'})}}
+
+
+def filler(count):
+    return [FILLER[i % len(FILLER)] for i in range(count)]
+
+
+def tail_pieces(tail, repeated, config):
+    if tail == 'repeat':
+        return repeated * max(1, config['tail_tokens'] // len(repeated))
+    if tail == 'junk':
+        return ['\n', '<|', 'im', '_start', '|>', 'assistant', '\n'] + \
+            filler(config['tail_tokens'])
+    return []
+
+
+def completion_pieces(config, with_tools):
+    """Content deltas of one response, roughly one token each."""
+    pieces = filler(config['completion_tokens'])
+    if with_tools and config['tool_format'] not in ('none', 'native'):
+        text = tool_call_text(config['tool_format'])
+        call = [text[i:i + 4] for i in range(0, len(text), 4)]
+        return pieces + call + tail_pieces(config['tool_tail'], call, config)
+    if pieces:
+        pieces += tail_pieces(config['text_tail'], ['\n\n'] + pieces, config)
+    return pieces
+
+
+def prompt_text(body):
+    return dumps(body.get('tools') or []) + dumps(body.get('messages', []))
+
+
+def prefix_cache_lookup(text):
+    """Prompt tokens already cached, then cache the whole prompt."""
+    global prefix_queries, prefix_hits
+    key, cached, hit = None, 0, True
+    for start in range(0, len(text) - BLOCK_CHARS + 1, BLOCK_CHARS):
+        key = hash((key, text[start:start + BLOCK_CHARS]))
+        if hit and key in prefix_blocks:
+            prefix_blocks.move_to_end(key)
+            cached += BLOCK_CHARS
+            continue
+        hit = False
+        prefix_blocks[key] = None
+    while len(prefix_blocks) > PREFIX_BLOCKS_MAX:
+        prefix_blocks.popitem(last=False)
+    prefix_queries += len(text) // 4
+    prefix_hits += cached // 4
+    return cached // 4
+
+
+def usage(body, completion_tokens, cached_tokens=0):
+    prompt_tokens = len(prompt_text(body)) // 4
+    return {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+            'prompt_tokens_details': {'cached_tokens': cached_tokens}}
+
+
+async def respond(writer, status, payload, content_type='application/json'):
+    if not isinstance(payload, bytes):
+        payload = payload.encode()
+    writer.write(f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}\r\n'
+                 f'Content-Type: {content_type}\r\nContent-Length: {len(payload)}\r\n\r\n'.encode() + payload)
+    await writer.drain()
+
+
+async def pace(started, index, config):
+    """Sleep until token `index` is due under the prefill + decode cost model."""
+    due = started + config['prefill_ms'] / 1000 + index / config['tokens_per_sec']
+    delay = due - time.monotonic()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+async def chat(writer, headers, body):
+    config = request_config(headers)
+    if random.random() < config['fail_rate']:
+        await respond(writer, 503, dumps({'error': 'mock failure (--fail-rate)'}))
+        return
+    if random.random() < config['slow_rate']:
+        config['prefill_ms'] += config['slow_ms']
+    cached = 0
+    if config['prefill_ms_per_1k']:
+        text = prompt_text(body)
+        cached = prefix_cache_lookup(text)
+        config['prefill_ms'] += (len(text) // 4 - cached) / 1000 * config['prefill_ms_per_1k']
+    started = time.monotonic()
+    with_tools = bool(body.get('tools')) and config['tool_format'] != 'none'
+    native = with_tools and config['tool_format'] == 'native'
+    pieces = completion_pieces(config, with_tools)
+    resp_id = f'chatcmpl-{uuid.uuid4().hex[:24]}'
+    created = int(time.time())
+    envelope = {'id': resp_id, 'created': created, 'model': body.get('model', MODEL)}
+
+    if not body.get('stream'):
+        await pace(started, len(pieces), config)
+        message = {'role': 'assistant', 'content': ''.join(pieces), 'reasoning_content': None,
+                   'tool_calls': [native_tool_call()] if native else []}
+        await respond(writer, 200, dumps(dict(envelope, object='chat.completion', choices=[{
+            'index': 0, 'message': message, 'logprobs': None,
+            'finish_reason': 'tool_calls' if native else 'stop', 'stop_reason': None
+        }], usage=usage(body, len(pieces), cached), prompt_logprobs=None)))
+        return
+
+    writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n'
+                 b'Cache-Control: no-cache\r\nTransfer-Encoding: chunked\r\n\r\n')
+
+    async def event(delta=None, finish_reason=None, **extra):
+        chunk = dict(envelope, object='chat.completion.chunk', **extra)
+        if 'choices' not in extra:
+            chunk['choices'] = [{'index': 0, 'delta': delta or {}, 'logprobs': None,
+                                 'finish_reason': finish_reason}]
+        data = f'data: {dumps(chunk)}\n\n'.encode()
+        writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+        await writer.drain()
+
+    await pace(started, 0, config)
+    await event({'role': 'assistant', 'content': ''})
+    for i, piece in enumerate(pieces):
+        await pace(started, i, config)
+        await event({'content': piece})
+    if native:
+        call = native_tool_call()
+        await event({'tool_calls': [dict(call, index=0)]})
+    await event(finish_reason='tool_calls' if native else 'stop')
+    if (body.get('stream_options') or {}).get('include_usage'):
+        await event(choices=[], usage=usage(body, len(pieces), cached))
+    data = b'data: [DONE]\n\n'
+    writer.write(b'%x\r\n%s\r\n0\r\n\r\n' % (len(data), data))
+    await writer.drain()
+
+
+async def hangup(reader):
+    while not reader.at_eof():
+        await asyncio.sleep(0.05)
+
+
+async def route(reader, writer, method, path, headers, body):
+    global running, served, aborted
+    path = path.split('?', 1)[0]
+    if path == '/health':
+        await respond(writer, 200, b'')
+    elif path == '/v1/models':
+        await respond(writer, 200, dumps({'object': 'list', 'data': [
+            {'id': MODEL, 'object': 'model', 'owned_by': 'vllm', 'max_model_len': 131072}]}))
+    elif path == '/metrics':
+        await respond(writer, 200, f'vllm:num_requests_running {running}\n'
+                                   f'vllm:num_requests_waiting 0\n'
+                                   f'vllm:prefix_cache_queries_total {prefix_queries}\n'
+                                   f'vllm:prefix_cache_hits_total {prefix_hits}\n'
+                                   f'mock_requests_served_total {served}\n'
+                                   f'mock_requests_aborted_total {aborted}\n', 'text/plain')
+    elif path == '/v1/chat/completions' and method == 'POST':
+        try:
+            request = json.loads(body)
+        except ValueError as e:
+            await respond(writer, 400, dumps({'error': f'invalid JSON: {e}'}))
+            return
+        if not isinstance(request, dict):
+            await respond(writer, 400, dumps({'error': 'request body must be a JSON object'}))
+            return
+        running += 1
+        generation = asyncio.ensure_future(chat(writer, headers, request))
+        client = asyncio.ensure_future(hangup(reader))
+        try:
+            await asyncio.wait({generation, client}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            client.cancel()
+            if not generation.done():
+                generation.cancel()
+                aborted += 1
+            running -= 1
+            served += 1
+        if generation.cancelled():
+            raise ConnectionError('client disconnected')
+        generation.result()
+    else:
+        await respond(writer, 404, dumps({'error': f'no route {method} {path}'}))
+
+
+async def read_body(reader, headers):
+    if 'content-length' in headers:
+        return await reader.readexactly(int(headers['content-length']))
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        parts = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                await reader.readline()
+                return b''.join(parts)
+            parts.append(await reader.readexactly(size))
+            await reader.readline()
+    return b''
+
+
+async def handle(reader, writer):
+    try:
+        while True:
+            line = await reader.readline()
+            if not line.strip():
+                break
+            method, path, version = line.decode('latin-1').split()
+            headers = {}
+            while True:
+                header = await reader.readline()
+                if header in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = header.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await read_body(reader, headers)
+            await route(reader, writer, method, path, headers, body)
+            if version != 'HTTP/1.1' or headers.get('connection', '').lower() == 'close':
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def main(host, port):
+    server = await asyncio.start_server(handle, host, port, limit=1 << 24, backlog=4096)
+    print(f'mock vLLM listening on {host}:{port} {CONFIG}', flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--model', type=str, default=MODEL)
+    parser.add_argument('--prefill-ms', type=float, default=CONFIG['prefill_ms'])
+    parser.add_argument('--prefill-ms-per-1k', type=float, default=CONFIG['prefill_ms_per_1k'])
+    parser.add_argument('--tokens-per-sec', type=float, default=CONFIG['tokens_per_sec'])
+    parser.add_argument('--completion-tokens', type=int, default=CONFIG['completion_tokens'])
+    parser.add_argument('--tool-format', choices=['none', 'native', 'tags', 'bare', 'multiline'],
+                        default=CONFIG['tool_format'])
+    parser.add_argument('--tool-tail', choices=['none', 'repeat', 'junk'], default=CONFIG['tool_tail'])
+    parser.add_argument('--text-tail', choices=['none', 'repeat', 'junk'], default=CONFIG['text_tail'])
+    parser.add_argument('--tail-tokens', type=int, default=CONFIG['tail_tokens'])
+    parser.add_argument('--fail-rate', type=float, default=CONFIG['fail_rate'])
+    parser.add_argument('--slow-rate', type=float, default=CONFIG['slow_rate'])
+    parser.add_argument('--slow-ms', type=float, default=CONFIG['slow_ms'])
+    args = parser.parse_args()
+    MODEL = args.model
+    CONFIG.update(prefill_ms=args.prefill_ms, prefill_ms_per_1k=args.prefill_ms_per_1k,
+                  tokens_per_sec=args.tokens_per_sec,
+                  completion_tokens=args.completion_tokens, tool_format=args.tool_format,
+                  tool_tail=args.tool_tail, text_tail=args.text_tail, tail_tokens=args.tail_tokens,
+                  fail_rate=args.fail_rate, slow_rate=args.slow_rate, slow_ms=args.slow_ms)
+    try:
+        asyncio.run(main(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+"""
+Load-test vllm-tool-proxy.py against mock-vllm.py
+
+Starts a mock vLLM server and the proxy on free local ports, then drives each
+routing branch of proxy() at each concurrency level:
+
+  passthrough     GET /v1/models                      -> forward_request
+  fix             non-streaming chat with tools       -> forward_with_body_and_fix
+  rewrap_sse      streaming chat with tools, proxy in --tool-streaming rewrap
+                                                      -> forward_fix_and_rewrap_sse
+  stream_extract  streaming chat with tools           -> stream_and_extract
+  stream          streaming chat without tools        -> stream_response
+
+Every scenario also runs straight against the mock ("direct"), so the report
+can show what the proxy itself adds: latency p50/p99, time to first token,
+throughput, and the proxy's CPU time per request and RSS (read from /proc).
+
+    python3 proxy-bench.py --concurrency 1,16,64 --output after.json --compare before.json
+
+Results are written as JSON; --compare prints the change against an earlier
+run (use --input to compare two saved files without running anything).
+Only needs requests (already a proxy dependency).
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SCENARIOS = {
+    'passthrough': {'method': 'GET', 'path': '/v1/models', 'stream': False, 'tools': False},
+    'fix': {'method': 'POST', 'path': '/v1/chat/completions', 'stream': False, 'tools': True},
+    'rewrap_sse': {'method': 'POST', 'path': '/v1/chat/completions', 'stream': True, 'tools': True,
+                   'proxy_args': ['--tool-streaming', 'rewrap']},
+    'stream_extract': {'method': 'POST', 'path': '/v1/chat/completions', 'stream': True, 'tools': True},
+    'stream': {'method': 'POST', 'path': '/v1/chat/completions', 'stream': True, 'tools': False},
+}
+
+TOOLS = [{'type': 'function', 'function': {
+    'name': name, 'description': f'{name} tool',
+    'parameters': {'type': 'object', 'properties': {'command': {'type': 'string'},
+                                                    'path': {'type': 'string'}}}}}
+    for name in ('exec', 'read', 'write', 'edit', 'web_search', 'browser', 'message', 'cron')]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(url, proc, timeout=20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f'{url} exited with {proc.returncode}')
+        try:
+            if requests.get(f'{url}/health', timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f'{url} did not come up within {timeout}s')
+
+
+def chat_body(scenario, prompt_kb):
+    """An OpenClaw-sized request: system prompt plus a history of prompt_kb KB."""
+    filler = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 18     # ~1 KB
+    messages = [{'role': 'system', 'content': 'You are a helpful agent. ' + filler}]
+    for i in range(max(1, prompt_kb)):
+        messages.append({'role': 'user' if i % 2 == 0 else 'assistant', 'content': f'{i}: {filler}'})
+    if messages[-1]['role'] != 'user':
+        messages.append({'role': 'user', 'content': 'Continue.'})
+    body = {'model': 'mock-model', 'messages': messages, 'max_tokens': 1024, 'temperature': 0.7}
+    if scenario['tools']:
+        body['tools'] = TOOLS
+    if scenario['stream']:
+        body['stream'] = True
+        body['stream_options'] = {'include_usage': True}
+    return body
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def summarize(values):
+    if not values:
+        return None
+    return {'p50': round(percentile(values, 50) * 1000, 2), 'p90': round(percentile(values, 90) * 1000, 2),
+            'p99': round(percentile(values, 99) * 1000, 2), 'mean': round(sum(values) / len(values) * 1000, 2)}
+
+
+def one_request(session, url, scenario, payload):
+    """Returns (latency, ttft, completion_tokens) in seconds; raises on failure."""
+    started = time.monotonic()
+    if scenario['method'] == 'GET':
+        resp = session.get(url, timeout=300)
+        resp.raise_for_status()
+        latency = time.monotonic() - started
+        return latency, latency, 0
+    resp = session.post(url, data=payload, headers={'Content-Type': 'application/json'},
+                        stream=scenario['stream'], timeout=300)
+    resp.raise_for_status()
+    if not scenario['stream']:
+        usage = resp.json().get('usage') or {}
+        latency = time.monotonic() - started
+        return latency, latency, usage.get('completion_tokens', 0)
+
+    ttft = None
+    tokens = 0
+    buf = b''
+    for chunk in resp.iter_content(chunk_size=None):
+        buf += chunk
+        while b'\n\n' in buf:
+            event, buf = buf.split(b'\n\n', 1)
+            data = event[5:].strip() if event.startswith(b'data:') else b''
+            if not data or data == b'[DONE]':
+                continue
+            obj = json.loads(data)
+            if obj.get('usage'):
+                tokens = obj['usage'].get('completion_tokens', tokens)
+            if ttft is None:
+                for choice in obj.get('choices') or []:
+                    delta = choice.get('delta') or {}
+                    if delta.get('content') or delta.get('tool_calls'):
+                        ttft = time.monotonic() - started
+    latency = time.monotonic() - started
+    if 'close' in resp.headers.get('Connection', '').lower():
+        # Flask's dev server closes every connection, but the SSE paths still
+        # say "keep-alive, close"; requests would reuse the socket and hang
+        session.close()
+    return latency, ttft if ttft is not None else latency, tokens
+
+
+def process_tree(pid):
+    """pid and its descendants (the workers of a --workers proxy)."""
+    pids = [pid]
+    for p in pids:
+        try:
+            with open(f'/proc/{p}/task/{p}/children') as f:
+                pids += [int(c) for c in f.read().split()]
+        except OSError:
+            pass
+    return pids
+
+
+def proc_stats(pid):
+    """(cpu seconds, rss MB, peak rss MB) of a local process and its children, from /proc."""
+    cpu = rss = peak = 0
+    try:
+        for p in process_tree(pid):
+            with open(f'/proc/{p}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+            with open(f'/proc/{p}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS'):
+                        rss += int(line.split(':')[1].split()[0]) / 1024
+                    elif line.startswith('VmHWM'):
+                        peak += int(line.split(':')[1].split()[0]) / 1024
+        return cpu, rss, peak
+    except (OSError, IndexError, ValueError):
+        return None, None, None
+
+
+def run_load(base_url, scenario, payload, concurrency, total, warmup):
+    url = base_url + scenario['path']
+    latencies, ttfts, tokens, errors = [], [], [], []
+    lock = threading.Lock()
+    remaining = [total]
+
+    def worker():
+        session = requests.Session()
+        for _ in range(warmup):
+            try:
+                one_request(session, url, scenario, payload)
+            except Exception:
+                pass
+        barrier.wait()
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            try:
+                latency, ttft, n = one_request(session, url, scenario, payload)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e)[:200])
+                continue
+            with lock:
+                latencies.append(latency)
+                ttfts.append(ttft)
+                tokens.append(n)
+
+    barrier = threading.Barrier(concurrency + 1)
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    started = time.monotonic()
+    for t in threads:
+        t.join()
+    wall = time.monotonic() - started
+    return {
+        'requests': len(latencies), 'errors': len(errors), 'error_samples': errors[:3],
+        'wall_s': round(wall, 3), 'rps': round(len(latencies) / wall, 2) if wall else None,
+        'latency_ms': summarize(latencies), 'ttft_ms': summarize(ttfts),
+        'completion_tokens_per_s': round(sum(tokens) / wall, 1) if wall else None,
+    }
+
+
+class Proxies:
+    """One proxy process per distinct set of extra flags."""
+
+    def __init__(self, vllm_url, engine, extra_args):
+        self.vllm_url = vllm_url
+        self.engine = engine
+        self.extra_args = extra_args
+        self.procs = {}
+
+    def get(self, scenario_args):
+        key = tuple(scenario_args)
+        if key not in self.procs:
+            port = free_port()
+            cmd = [sys.executable, os.path.join(HERE, 'vllm-tool-proxy.py'), '--host', '127.0.0.1',
+                   '--port', str(port), '--vllm-url', self.vllm_url, '--engine', self.engine,
+                   *self.extra_args, *scenario_args]
+            proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            url = f'http://127.0.0.1:{port}'
+            wait_ready(url, proc)
+            self.procs[key] = (url, proc)
+        return self.procs[key]
+
+    def close(self):
+        for _, proc in self.procs.values():
+            proc.terminate()
+        for _, proc in self.procs.values():
+            proc.wait(timeout=10)
+
+
+def run(args):
+    mock_port = free_port()
+    mock_url = f'http://127.0.0.1:{mock_port}'
+    mock = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, 'mock-vllm.py'), '--port', str(mock_port),
+         '--prefill-ms', str(args.prefill_ms), '--tokens-per-sec', str(args.tokens_per_sec),
+         '--completion-tokens', str(args.completion_tokens), '--tool-format', args.tool_format],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_ready(mock_url, mock)
+    proxies = Proxies(mock_url, args.engine, args.proxy_args.split())
+    results = []
+    try:
+        for name in args.scenarios.split(','):
+            scenario = SCENARIOS[name]
+            payload = json.dumps(chat_body(scenario, args.prompt_kb)).encode()
+            for concurrency in [int(c) for c in args.concurrency.split(',')]:
+                total = max(args.requests, concurrency)
+                direct = None
+                if not args.no_direct:
+                    direct = run_load(mock_url, scenario, payload, concurrency, total, args.warmup)
+                proxy_url, proc = proxies.get(scenario.get('proxy_args', []))
+                cpu_before, _, _ = proc_stats(proc.pid)
+                proxied = run_load(proxy_url, scenario, payload, concurrency, total, args.warmup)
+                cpu_after, rss, peak = proc_stats(proc.pid)
+                result = {'scenario': name, 'concurrency': concurrency, 'proxy': proxied, 'direct': direct,
+                          'proxy_rss_mb': rss and round(rss, 1), 'proxy_peak_rss_mb': peak and round(peak, 1)}
+                if cpu_before is not None and proxied['requests']:
+                    # Includes the warmup requests: a small overestimate, same for every run
+                    result['proxy_cpu_ms_per_request'] = round(
+                        (cpu_after - cpu_before) * 1000 / (proxied['requests'] + args.warmup * concurrency), 3)
+                if direct and direct['latency_ms'] and proxied['latency_ms']:
+                    result['proxy_added_ms'] = {
+                        p: round(proxied['latency_ms'][p] - direct['latency_ms'][p], 2) for p in ('p50', 'p99')}
+                    result['proxy_added_ttft_ms'] = {
+                        p: round(proxied['ttft_ms'][p] - direct['ttft_ms'][p], 2) for p in ('p50', 'p99')}
+                results.append(result)
+                print_result(result)
+    finally:
+        proxies.close()
+        mock.terminate()
+        mock.wait(timeout=10)
+    return {
+        'meta': {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'git': git_revision(),
+            'python': platform.python_version(),
+            'host': platform.node(),
+            'cpus': os.cpu_count(),
+            'args': vars(args),
+        },
+        'results': results,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_result(r):
+    p = r['proxy']
+    lat = p['latency_ms'] or {}
+    ttft = p['ttft_ms'] or {}
+    added = r.get('proxy_added_ms') or {}
+    print(f"{r['scenario']:<15} c={r['concurrency']:<4} "
+          f"{p['rps']:>8} req/s  p50 {lat.get('p50', '-'):>8} ms  p99 {lat.get('p99', '-'):>8} ms  "
+          f"ttft p50 {ttft.get('p50', '-'):>8} ms  added p50/p99 {added.get('p50', '-')}/{added.get('p99', '-')} ms  "
+          f"cpu {r.get('proxy_cpu_ms_per_request', '-')} ms/req  rss {r.get('proxy_rss_mb', '-')} MB  "
+          f"errors {p['errors']}", flush=True)
+
+
+def compare(old, new):
+    """Print per scenario/concurrency changes between two result files."""
+    before = {(r['scenario'], r['concurrency']): r for r in old['results']}
+    print(f"\nchange vs {old['meta'].get('git')} ({old['meta'].get('started')}):")
+    for r in new['results']:
+        o = before.get((r['scenario'], r['concurrency']))
+        if not o:
+            continue
+        cols = []
+        for label, get in (
+                ('rps', lambda x: x['proxy']['rps']),
+                ('p50', lambda x: x['proxy']['latency_ms']['p50']),
+                ('p99', lambda x: x['proxy']['latency_ms']['p99']),
+                ('ttft p50', lambda x: x['proxy']['ttft_ms']['p50']),
+                ('added p50', lambda x: x['proxy_added_ms']['p50']),
+                ('cpu/req', lambda x: x['proxy_cpu_ms_per_request']),
+                ('rss', lambda x: x['proxy_rss_mb'])):
+            try:
+                a, b = get(o), get(r)
+            except (KeyError, TypeError):
+                continue
+            if a is None or b is None:
+                continue
+            pct = f' ({(b - a) / a * 100:+.0f}%)' if a else ''
+            cols.append(f'{label} {a} -> {b}{pct}')
+        print(f"{r['scenario']:<15} c={r['concurrency']:<4} " + '  '.join(cols))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark vllm-tool-proxy.py against a mock vLLM server')
+    parser.add_argument('--scenarios', type=str, default=','.join(SCENARIOS),
+                        help=f'comma-separated subset of: {", ".join(SCENARIOS)}')
+    parser.add_argument('--concurrency', type=str, default='1,8,32',
+                        help='comma-separated client concurrency levels')
+    parser.add_argument('--requests', type=int, default=200, help='measured requests per scenario and level')
+    parser.add_argument('--warmup', type=int, default=2, help='unmeasured requests per client before measuring')
+    parser.add_argument('--engine', choices=['flask', 'asgi'], default='flask')
+    parser.add_argument('--proxy-args', type=str, default='', help='extra flags for vllm-tool-proxy.py')
+    parser.add_argument('--no-direct', action='store_true', help='skip the direct-to-mock baseline runs')
+    parser.add_argument('--prompt-kb', type=int, default=50, help='approximate size of the chat history')
+    parser.add_argument('--prefill-ms', type=float, default=50)
+    parser.add_argument('--tokens-per-sec', type=float, default=200)
+    parser.add_argument('--completion-tokens', type=int, default=64)
+    parser.add_argument('--tool-format', choices=['none', 'native', 'tags', 'bare', 'multiline'], default='tags')
+    parser.add_argument('--output', type=str, default=None, help='write results JSON here')
+    parser.add_argument('--compare', type=str, default=None, help='earlier results JSON to compare against')
+    parser.add_argument('--input', type=str, default=None,
+                        help='with --compare: load these results instead of running')
+    args = parser.parse_args()
+
+    if args.input:
+        with open(args.input) as f:
+            data = json.load(f)
+    else:
+        data = run(args)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(data, f, indent=2)
+            print(f'\nresults written to {args.output}')
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), data)
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""
+Replay traffic captured by vllm-tool-proxy.py --capture-dir
+
+Re-issues the captured chat requests against a proxy, either at their
+original inter-arrival times (scaled by --speed) or as fast as possible with
+--asap, and checks every answer against the captured one: status, content,
+tool calls (name + arguments) and finish_reason.
+
+    python3 proxy-replay.py /var/log/proxy-capture --target http://127.0.0.1:8003
+
+With --serve-upstream PORT the script also plays vLLM: it answers the
+proxy's upstream calls with the replies vLLM gave when the traffic was
+captured, matched by conversation. Start the proxy under test with
+--vllm-url http://127.0.0.1:PORT and the whole exchange is deterministic, so
+any mismatch is a behaviour change in the proxy (e.g. a leaked <|im_start|>
+now being handled differently); replaying against a real vLLM instead is a
+throughput test where only statuses and tool-call names are expected to hold.
+
+    python3 proxy-replay.py capture/ --serve-upstream 8100 --asap --concurrency 16 --output run.json
+
+Capture files are gzip JSONL, one record per sampled request; the file the
+proxy is still writing is read up to its last flush.
+Only needs requests (already a proxy dependency).
+"""
+import argparse
+import collections
+import concurrent.futures
+import glob
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+
+def capture_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(glob.glob(os.path.join(path, 'capture-*.jsonl.gz')))
+        else:
+            files.append(path)
+    return files
+
+
+def read_capture(path):
+    """Records of one capture file; stops quietly where a live file ends."""
+    records = []
+    try:
+        with gzip.open(path, 'rb') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+    except (EOFError, zlib.error):
+        pass
+    return records
+
+
+def load_records(paths, path_types=None, limit=None):
+    records = []
+    for path in capture_files(paths):
+        records += read_capture(path)
+    if path_types:
+        records = [r for r in records if r.get('path_type') in path_types]
+    records.sort(key=lambda r: r['ts'])
+    return records[:limit] if limit else records
+
+
+def conversation_key(request_text):
+    """Matches the proxy's upstream call to a captured one. The proxy rewrites
+    stream/tool_choice but passes model and messages through untouched."""
+    try:
+        body = json.loads(request_text)
+    except ValueError:
+        return None
+    if not isinstance(body, dict):
+        return None
+    return hashlib.sha256(json.dumps([body.get('model'), body.get('messages')],
+                                     sort_keys=True).encode()).hexdigest()
+
+
+def normalize(text):
+    """(content, [(tool name, arguments)], finish_reason) of a chat response,
+    whether it came as one JSON object or as an SSE stream."""
+    text = (text or '').strip()
+    if text.startswith('data:'):
+        content, calls, finish = [], {}, None
+        for line in text.split('\n'):
+            if not line.startswith('data:'):
+                continue
+            data = line[5:].strip()
+            if data == '[DONE]':
+                continue
+            try:
+                chunk = json.loads(data)
+            except ValueError:
+                continue
+            for choice in chunk.get('choices') or []:
+                delta = choice.get('delta') or {}
+                if delta.get('content'):
+                    content.append(delta['content'])
+                for tc in delta.get('tool_calls') or []:
+                    call = calls.setdefault(tc.get('index', 0), ['', ''])
+                    function = tc.get('function') or {}
+                    call[0] += function.get('name') or ''
+                    call[1] += function.get('arguments') or ''
+                finish = choice.get('finish_reason') or finish
+        return ''.join(content), [(n, parse_arguments(a)) for n, a in (calls[i] for i in sorted(calls))], finish
+    try:
+        obj = json.loads(text)
+        choice = obj['choices'][0]
+    except (ValueError, KeyError, IndexError, TypeError):
+        return text, [], None
+    message = choice.get('message') or {}
+    calls = [((tc.get('function') or {}).get('name'), parse_arguments((tc.get('function') or {}).get('arguments')))
+             for tc in message.get('tool_calls') or []]
+    return message.get('content') or '', calls, choice.get('finish_reason')
+
+
+def parse_arguments(arguments):
+    # Compared as data, so a key-order or spacing change isn't a mismatch
+    try:
+        return json.dumps(json.loads(arguments), sort_keys=True)
+    except (TypeError, ValueError):
+        return arguments
+
+
+def differences(captured, replayed):
+    """Fields in which a replayed response differs from the captured one."""
+    fields = []
+    if captured['status'] != replayed['status']:
+        fields.append('status')
+    old, new = normalize(captured['response']), normalize(replayed['response'])
+    if [n for n, _ in old[1]] != [n for n, _ in new[1]]:
+        fields.append('tool_names')
+    elif old[1] != new[1]:
+        fields.append('tool_arguments')
+    if old[0] != new[0]:
+        fields.append('content')
+    if old[2] != new[2]:
+        fields.append('finish_reason')
+    return fields
+
+
+class UpstreamReplay:
+    """Fake vLLM answering each upstream call with the reply captured for
+    the same conversation (cycling when it was captured several times)."""
+
+    def __init__(self, records):
+        self.replies = collections.defaultdict(list)
+        self.next = collections.Counter()
+        self.lock = threading.Lock()
+        self.models = set()
+        self.misses = 0
+        for r in records:
+            key = conversation_key(r['request'])
+            if key and r.get('upstream_status') is not None:
+                self.replies[key].append((r['upstream_status'], r['upstream']))
+                try:
+                    self.models.add(json.loads(r['request']).get('model'))
+                except (ValueError, AttributeError):
+                    pass
+
+    def reply(self, request_bytes):
+        key = conversation_key(request_bytes)
+        with self.lock:
+            replies = self.replies.get(key)
+            if not replies:
+                self.misses += 1
+                return None
+            index = self.next[key] % len(replies)
+            self.next[key] += 1
+        return replies[index]
+
+    def serve(self, host, port):
+        replay = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send(self, status, payload, content_type='application/json'):
+                payload = payload.encode() if isinstance(payload, str) else payload
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                if self.path == '/health':
+                    self.send(200, b'')
+                elif self.path == '/v1/models':
+                    self.send(200, json.dumps({'object': 'list', 'data': [
+                        {'id': m, 'object': 'model'} for m in sorted(replay.models, key=str)]}))
+                else:
+                    self.send(404, json.dumps({'error': f'not captured: {self.path}'}))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                found = replay.reply(body)
+                if found is None:
+                    self.send(404, json.dumps({'error': 'no captured reply for this conversation'}))
+                    return
+                status, payload = found
+                streamed = payload.lstrip().startswith('data:')
+                try:
+                    wants_stream = bool(json.loads(body).get('stream'))
+                except (ValueError, AttributeError):
+                    wants_stream = False
+                if status == 200 and streamed != wants_stream:
+                    # e.g. captured with --tool-streaming incremental, replayed with rewrap
+                    self.send(409, json.dumps({'error': f'captured reply is {"SSE" if streamed else "JSON"}, '
+                                                        f'request has stream={wants_stream}'}))
+                    return
+                self.send(status, payload, 'text/event-stream' if streamed else 'application/json')
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True, name='upstream-replay').start()
+        return server
+
+
+def replay_one(session, target, record):
+    headers = {'Content-Type': 'application/json'}
+    if record.get('priority'):
+        headers['X-Priority'] = record['priority']
+    started = time.monotonic()
+    first = None
+    chunks = []
+    with session.post(f"{target}/v1/{record['path']}", data=record['request'].encode(),
+                      headers=headers, stream=True, timeout=600) as resp:
+        for chunk in resp.iter_content(chunk_size=None):
+            if first is None:
+                first = time.monotonic()
+            chunks.append(chunk)
+        if 'close' in resp.headers.get('Connection', '').lower():
+            # Flask's dev server closes every connection even when it says keep-alive
+            session.close()
+    finished = time.monotonic()
+    return {'status': resp.status_code, 'response': b''.join(chunks).decode('utf-8', 'replace'),
+            'total': finished - started, 'ttfb': (first or finished) - started}
+
+
+def run(records, args):
+    local = threading.local()
+    results = [None] * len(records)
+
+    def task(i, due):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        record = records[i]
+        lag = time.monotonic() - due if due is not None else 0.0
+        try:
+            replayed = replay_one(local.session, args.target, record)
+        except requests.RequestException as e:
+            results[i] = {'id': record['id'], 'error': str(e)[:200], 'lag': lag}
+            return
+        results[i] = {
+            'id': record['id'], 'path_type': record.get('path_type'), 'lag': lag,
+            'status': replayed['status'], 'captured_status': record['status'],
+            'total': replayed['total'], 'ttfb': replayed['ttfb'],
+            'captured_total': record['timing'].get('total'), 'captured_ttfb': record['timing'].get('ttfb'),
+            'diff': differences(record, replayed),
+            'response': replayed['response'],
+        }
+
+    started = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(args.concurrency) as pool:
+        if args.asap:
+            for i in range(len(records)):
+                pool.submit(task, i, None)
+        else:
+            origin = records[0]['ts'] if records else 0
+            for i, record in enumerate(records):
+                due = started + (record['ts'] - origin) / args.speed
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(task, i, due)
+    return results, time.monotonic() - started
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def ms(value):
+    return '-' if value is None else f'{value * 1000:.1f}'
+
+
+def report(records, results, wall, args):
+    done = [r for r in results if 'error' not in r]
+    errors = [r for r in results if 'error' in r]
+    diffs = collections.Counter(field for r in done for field in r['diff'])
+    print(f"replayed {len(results)} requests in {wall:.1f}s ({len(done) / wall if wall else 0:.1f} req/s), "
+          f"{len(errors)} errors, {sum(1 for r in done if r['diff'])} differ from the capture")
+    for label, key in (('latency', 'total'), ('ttfb', 'ttfb')):
+        now = [r[key] for r in done]
+        then = [r['captured_' + key] for r in done if r['captured_' + key] is not None]
+        print(f"  {label:<8} p50 {ms(percentile(now, 50))} ms  p99 {ms(percentile(now, 99))} ms   "
+              f"(captured p50 {ms(percentile(then, 50))} ms  p99 {ms(percentile(then, 99))} ms)")
+    if not args.asap:
+        print(f"  start lag p99 {ms(percentile([r['lag'] for r in results], 99))} ms "
+              f"(raise --concurrency if this grows)")
+    if diffs:
+        print('  differences: ' + ', '.join(f'{field} {n}' for field, n in diffs.most_common()))
+    by_id = {r['id']: r for r in records}
+    shown = 0
+    for r in done:
+        if r['diff'] and shown < args.show:
+            shown += 1
+            record = by_id[r['id']]
+            print(f"  - {r['id']} ({r['path_type']}) {', '.join(r['diff'])}: "
+                  f"status {record['status']} -> {r['status']}")
+            print(f"      captured: {normalize(record['response'])!r:.200}")
+            print(f"      replayed: {normalize(r['response'])!r:.200}")
+    for r in errors[:args.show]:
+        print(f"  ! {r['id']}: {r['error']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a vllm-tool-proxy.py traffic capture')
+    parser.add_argument('capture', nargs='+', help='capture files or --capture-dir directories')
+    parser.add_argument('--target', type=str, default='http://127.0.0.1:8003', help='proxy to replay against')
+    parser.add_argument('--speed', type=float, default=1.0, help='time scale of the original pacing (2 = twice as fast)')
+    parser.add_argument('--asap', action='store_true', help='ignore the original timing, keep --concurrency requests in flight')
+    parser.add_argument('--concurrency', type=int, default=64, help='max requests in flight')
+    parser.add_argument('--path-type', type=str, default='', help='only replay these path types (comma-separated)')
+    parser.add_argument('--limit', type=int, default=None, help='replay only the first N requests')
+    parser.add_argument('--serve-upstream', type=int, default=None, metavar='PORT',
+                        help='also answer as vLLM on this port with the captured replies')
+    parser.add_argument('--serve-only', action='store_true', help='with --serve-upstream: serve, do not replay')
+    parser.add_argument('--show', type=int, default=5, help='differences and errors to print')
+    parser.add_argument('--output', type=str, default=None, help='write per-request results JSON here')
+    args = parser.parse_args()
+
+    path_types = {p.strip() for p in args.path_type.split(',') if p.strip()}
+    records = load_records(args.capture, path_types, args.limit)
+    if not records:
+        raise SystemExit('no captured requests found')
+    print(f'{len(records)} captured requests over {records[-1]["ts"] - records[0]["ts"]:.1f}s')
+
+    if args.serve_upstream:
+        upstream = UpstreamReplay(records)
+        upstream.serve('127.0.0.1', args.serve_upstream)
+        print(f'serving captured vLLM replies on 127.0.0.1:{args.serve_upstream}')
+        if args.serve_only:
+            try:
+                while True:
+                    time.sleep(3600)
+            except KeyboardInterrupt:
+                raise SystemExit(0)
+
+    results, wall = run(records, args)
+    report(records, results, wall, args)
+    if args.serve_upstream and upstream.misses:
+        print(f'  {upstream.misses} upstream calls had no captured reply')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'target': args.target, 'asap': args.asap, 'speed': args.speed,
+                       'wall_s': round(wall, 3), 'results': results}, f, indent=1)
+        print(f'results written to {args.output}')
@@ -0,0 +1,129 @@
+"""Regression tests for vllm-tool-proxy.py: python3 -m pytest proxy/"""
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    'vllm_tool_proxy', os.path.join(os.path.dirname(__file__), 'vllm-tool-proxy.py'))
+proxy = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(proxy)
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(proxy, 'conversations', proxy.ConversationStore())
+
+
+def call(name, **arguments):
+    return {'id': f'call-{name}', 'type': 'function',
+            'function': {'name': name, 'arguments': json.dumps(arguments)}}
+
+
+def agent_turns(*calls):
+    """A conversation in which the assistant made calls, one per turn."""
+    messages = [{'role': 'system', 'content': 'You are an agent.'},
+                {'role': 'user', 'content': 'Fix the failing test.'}]
+    for tc in calls:
+        messages.append({'role': 'assistant', 'content': None, 'tool_calls': [tc]})
+        messages.append({'role': 'tool', 'tool_call_id': tc['id'], 'content': 'ok'})
+    return {'model': 'm', 'messages': messages, 'tools': [{'type': 'function', 'function': {'name': 'exec'}}]}
+
+
+# -- loop detection ---------------------------------------------------------
+
+def test_loop_stops_identical_calls_in_a_row():
+    status = call('exec', command='git status')
+    assert proxy.check_tool_loop(agent_turns(status, status)) is None
+    assert proxy.check_tool_loop(agent_turns(status, status, status)) is not None
+
+
+def test_loop_allows_polling_between_other_calls():
+    status = call('exec', command='git status')
+    body = agent_turns(status, call('edit', path='a.py'), status, call('exec', command='pytest'), status,
+                       call('edit', path='b.py'), status)
+    assert proxy.check_tool_loop(body) is None
+
+
+# -- backend routing --------------------------------------------------------
+
+def test_router_reload_shares_the_inflight_lock():
+    old = proxy.BackendRouter(['http://a:8000', 'http://b:8000'])
+    backend = old.pick()
+    new = proxy.BackendRouter(['http://a:8000', 'http://b:8000', 'http://c:8000'], previous=old)
+    assert new.lock is old.lock
+    assert backend in new.backends and backend.inflight == 1
+    old.release(backend)        # a request picked before the reload finishes
+    assert backend.inflight == 0
+
+
+# -- early cutoff -----------------------------------------------------------
+
+def stream_chunks(*deltas):
+    for text in deltas:
+        yield json.dumps({'id': 'c', 'created': 0, 'model': 'm',
+                          'choices': [{'index': 0, 'delta': {'content': text}, 'finish_reason': None}]})
+
+
+BARE = '{"name": "exec", "arguments": {"command": "ls"}}'
+MULTILINE = '{\n  "name": "exec",\n  "arguments": {"command": "ls"}\n}'
+
+
+@pytest.mark.parametrize('call_text', [BARE, MULTILINE], ids=['bare', 'multiline'])
+def test_repeat_cutoff_trims_the_repeated_call(call_text):
+    # The delta that ends the first call also starts the second, as vLLM sends it
+    deltas = ['Listing the files.\n', call_text[:-3], call_text[-3:] + '\n' + call_text[:3], call_text[3:], '\n']
+    stream = proxy.StreamedCompletion(agent_turns())
+    fed = [stream.feed(d) for d in stream_chunks(*deltas)]
+    assert fed == [True, True, True, True, False]
+    assert stream.reason == 'repeat'
+    message = stream.completion()['choices'][0]['message']
+    assert message['content'] == 'Listing the files.\n' + call_text
+
+
+# -- degeneration check -----------------------------------------------------
+
+def feed_tokens(detector, text, size=3):
+    for i in range(0, len(text), size):
+        if not detector.feed(text[i:i + size]):
+            return text[:detector.keep]
+    return None
+
+
+def test_blocklist_cuts_a_leaked_token():
+    assert feed_tokens(proxy.DegenerationDetector(), 'Done.<|im_end|>\n<|im_start|>user\n') == 'Done.'
+
+
+def test_blocklist_allows_a_quoted_token():
+    reply = ('Qwen closes each turn with `<|im_end|>`:\n'
+             '```jinja\n{{ "<|im_start|>" + message.role }}\n```\n')
+    assert feed_tokens(proxy.DegenerationDetector(), reply) is None
+
+
+def test_blocklist_allows_a_token_in_tool_arguments():
+    text = 'Counting turns.\n' + json.dumps(call('exec', command='grep -c "<|im_start|>" chat.jinja')['function'])
+    stream = proxy.StreamedCompletion(agent_turns())
+    assert all(stream.feed(d) for d in stream_chunks(*(text[i:i + 4] for i in range(0, len(text), 4))))
+    assert stream.reason is None
+    assert ''.join(stream.choices[0][0]) == text
+
+
+@pytest.mark.parametrize('flag', [['--degeneration-threshold', '0'], ['--degeneration-threshold', '1.5'],
+                                  ['--degeneration-window', '0'], ['--degeneration-ngram', '-1']])
+def test_degeneration_settings_must_be_positive(flag):
+    result = subprocess.run([sys.executable, spec.origin, *flag], capture_output=True, text=True, timeout=30)
+    assert result.returncode == 2
+    assert flag[0] in result.stderr
+
+
+def test_only_watched_requests_go_upstream_as_streams(monkeypatch):
+    url = 'http://vllm:8000/v1/chat/completions'
+    plain = {'model': 'm', 'messages': [{'role': 'user', 'content': 'hi'}]}
+    assert proxy.watch_upstream(url, agent_turns())          # early cutoff
+    assert not proxy.watch_upstream(url, plain)
+    monkeypatch.setattr(proxy, 'DEGENERATION_NON_STREAMING', True)
+    assert proxy.watch_upstream(url, plain)
+    assert not proxy.watch_upstream(url, dict(plain, n=2))
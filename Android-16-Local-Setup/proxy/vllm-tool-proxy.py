@@ -1,15 +1,75 @@
 #!/usr/bin/env python3
 """
-vLLM Tool Call Proxy  (v4.0)
+vLLM Tool Call Proxy  (v4.24)
 
 Fixes GPT-OSS-120B parser issues:
 
 GPT-OSS-120B has native OpenAI-format tool calling. Retained safety nets:
 3. Post-processes to extract tool calls from content if output as text
    (<tools> JSON, bare JSON, or multi-line JSON).
-4. Safety net: Aborts after MAX_TOOL_CALLS (20) to prevent runaway loops.
+4. Safety net: Aborts after MAX_TOOL_CALLS (20) to prevent runaway loops,
+   or earlier when the same tool call repeats LOOP_REPEAT_LIMIT (3) times.
 
 CHANGES:
+- v4.24 (2026-10-18): Prefix-cache warm-up (--warmup-file): the most used
+  agent prompts and tool schemas are saved and replayed to vLLM as
+  max_tokens=1 requests at start and when a backend is healthy again
+- v4.23 (2026-10-18): Chat bodies the proxy leaves alone go to vLLM as the
+  client's own bytes; added or flat top-level members are patched into them
+  instead of re-encoding the history; proxy_request_bodies_total
+- v4.22 (2026-10-18): A chat client hanging up closes its upstream request,
+  so vLLM aborts the generation; noticed during prefill and non-streaming
+  calls too; proxy_cancelled_generations_total
+- v4.21 (2026-10-18): Degeneration check on every single-choice generation:
+  rolling-hash n-gram repetition score plus the leaked-token blocklist; vLLM
+  is stopped and the response ends with finish_reason "degenerate"
+- v4.20 (2026-10-18): Early cutoff: tool turns are read from vLLM as a
+  stream and closed once a complete call is followed by a repeat or a leaked
+  <|im_start|>-style token; proxy_cutoff_tokens_saved_total
+- v4.19 (2026-10-18): Per-request stage timings (parse, prepare, queue,
+  upstream, decode, extract, clean, encode, rewrap; connect/prefill/generate
+  for streams) as a Server-Timing header and in GET /debug/slow
+- v4.18 (2026-10-18): Logging through a bounded queue and writer thread;
+  RESPONSE/SSE-REWRAP/STREAM-EXTRACT lines sampled per event (--log-sample)
+  with fields built lazily; rate-limited SLOW line for outliers
+- v4.17 (2026-10-18): Hot-reloadable --config file (backends, loop limits,
+  tool tag, stripped fields) on SIGHUP or file change; in-flight requests
+  keep their snapshot; GET /admin/config, POST /admin/config/reload
+- v4.16 (2026-10-18): Upstream connect/read timeouts set separately; chat
+  requests retried on connection errors and 502/503/504 with jittered
+  backoff under a retry budget; optional hedging (--hedge-percentile)
+- v4.15 (2026-10-18): Pre-fork mode (--workers N) on one shared socket; loop
+  state in SQLite and metrics summed across workers, graceful recycling
+  (SIGUSR2, --worker-max-requests) that lets in-flight streams finish
+- v4.14 (2026-10-18): Opt-in compaction of stale tool results (--compact-after,
+  --compact-max-chars); deterministic, stepped so prefix caching still hits
+- v4.13 (2026-10-18): Context-budget guard: prompt tokens estimated with
+  memoized per-message counts, max_tokens clamped to the remaining window,
+  oversized requests refused before they reach vLLM (X-Prompt-Tokens-Estimate)
+- v4.12 (2026-10-18): Opt-in sampled traffic capture (--capture-dir) to
+  rotating gzip JSONL off the request path; replay with proxy-replay.py
+- v4.11 (2026-10-18): Pluggable JSON codec (orjson when installed); bodies
+  are decoded and encoded once per hop, SSE frames built as bytes
+- v4.10 (2026-10-18): Non-chat passthrough pipes request and response bodies
+  without buffering (flat memory for large embeddings/models payloads)
+- v4.9 (2026-10-18): Prometheus /metrics: latency per path type, upstream
+  TTFB, token throughput, extraction hit rate, loop aborts, in-flight gauges
+- v4.8 (2026-10-18): Admission control (--max-inflight) with interactive/
+  background priority queue, 429 + Retry-After when the queue is full
+- v4.7 (2026-10-18): Several vLLM backends (--vllm-url a,b), routed by
+  consistent hash of the prompt prefix with least-loaded spill-over
+- v4.6 (2026-10-18): Opt-in exact-match response cache (--cache-mb) for
+  temperature-0 requests, with single-flight coalescing
+- v4.5 (2026-10-18): Per-conversation loop detector: identical-call
+  fingerprints, incremental per-turn state in a bounded LRU
+- v4.4 (2026-10-18): Single-pass tool-call scanner (scan_tool_calls) replaces
+  the three line-by-line passes; also recovers pretty-printed JSON calls
+- v4.3 (2026-10-18): Streaming tool-call extraction (--tool-streaming
+  incremental, default); text is no longer held until generation ends
+- v4.2 (2026-10-18): Shared keep-alive connection pool to vLLM with idle
+  eviction, optional Unix-socket transport (--vllm-socket)
+- v4.1 (2026-10-18): Optional async ASGI engine (--engine asgi) for many
+  concurrent long generations; same routes and post-processing as Flask
 - v2.1 (2026-02-09): Fixed loop issue - only force 'required' on first turn
 - v2.1: Added MAX_TOOL_CALLS limit as safety net
 - v2.0: Added multi-line JSON parsing for bare tool calls
@@ -17,25 +77,956 @@ CHANGES:
 Point OpenClaw to this proxy instead of directly to vLLM.
 """
 import argparse
+import asyncio
+import atexit
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import fcntl
+import gzip
+import hashlib
+import heapq
+import itertools
 import json
 import logging
+import logging.handlers
+import math
+import os
+import queue
+import random
 import re
+import select
+import shutil
+import signal
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
 import uuid
 from flask import Flask, request, Response
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import tokenizers
+except ImportError:
+    tokenizers = None
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
 logger = logging.getLogger(__name__)
 
+VERSION = 'v4.24'             # keep in step with the docstring header
+
 VLLM_URL = 'http://192.168.0.122:8000'
+VLLM_URLS = [VLLM_URL]        # every --vllm-url backend; VLLM_URL is the first
+
+# Hot reload (--config FILE): a JSON file whose keys override the flags for
+# vllm_url, max_tool_calls, loop_repeat_limit, backend_max_inflight, tool_tag
+# and strip_fields. Re-read on SIGHUP, when the file changes, or on
+# POST /admin/config/reload; requests in flight keep the settings they started
+# with, see ProxyConfig
+CONFIG_FILE = None
+CONFIG_POLL_INTERVAL = 2.0
+
+# Multiple vLLM backends (--vllm-url a,b,...): requests stick to the backend
+# that already holds their prompt prefix in its KV cache, see BackendRouter
+BACKEND_MAX_INFLIGHT = 16     # above this a sticky backend counts as saturated
+HEALTH_CHECK_INTERVAL = 5.0
+
+# Prefix-cache warm-up (off unless --warmup-file is given): the agent prompts
+# (system messages and tool schemas) forwarded most often are kept in the file
+# and sent to vLLM again as max_tokens=1 requests when the proxy starts and
+# when a backend comes back up, see PrefixWarmer
+WARMUP_FILE = None
+WARMUP_PREFIXES = 8           # prefixes kept in the file and replayed
+WARMUP_INTERVAL = 1.0         # seconds between warm-up requests to a backend
+WARMUP_HALF_LIFE = 3600.0     # seconds for a prefix's request count to halve
+WARMUP_SAVE_INTERVAL = 60.0
+
+# Admission control for chat requests (off unless --max-inflight is given):
+# at most ADMISSION_MAX_INFLIGHT go upstream, up to ADMISSION_MAX_QUEUE wait
+# (interactive before background), everything beyond gets 429 + Retry-After
+ADMISSION_MAX_INFLIGHT = 0
+ADMISSION_MAX_QUEUE = 32
+ADMISSION_QUEUE_TIMEOUT = 120.0
+BACKGROUND_MODELS = set()     # models whose requests are always background
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
 
 # Max tool calls per conversation - safety net for loops
 # Count tool results in messages and abort if too many
 MAX_TOOL_CALLS = 20
 
-TOOLS_REGEX = re.compile(r'<tools>(.*?)</tools>', re.DOTALL)
+# Identical calls (same name + arguments) allowed in a row before a
+# conversation is cut off; any other call in between, or a new user message,
+# starts the count over. LOOP_WINDOW calls are remembered per conversation
+LOOP_REPEAT_LIMIT = 3
+LOOP_WINDOW = 10
+LOOP_STATE_MAX = 1024     # conversations tracked (LRU)
+
+# Stale tool-result compaction: old exec/read outputs are re-sent every turn;
+# shrink them on the way upstream (off unless one of the limits is set)
+COMPACT_AFTER_TURNS = 0     # elide tool results this many assistant turns old (0 = off)
+COMPACT_MAX_CHARS = 0       # cut tool results the model has already read down to this size (0 = off)
+COMPACT_STEP = 4            # the elision cutoff advances this many turns at a time (prefix-cache friendly)
+COMPACT_MIN_CHARS = 300     # shorter results are left alone
+
+# Context-budget guard: estimate prompt tokens before sending, clamp max_tokens
+# to what is left of the window, refuse requests whose prompt cannot fit
+CONTEXT_GUARD = True
+CONTEXT_WINDOW = 0          # tokens; 0 = max_model_len from vLLM's /v1/models
+CONTEXT_MARGIN = 256        # tokens left free for template overhead the estimate misses
+TOKENS_PER_MESSAGE = 4      # chat-template framing per message (role markers, separators)
+CHARS_PER_TOKEN = 4.0       # estimate without a tokenizer; low for code/JSON, high for English prose
+ESTIMATE_SLACK = 0.25       # without a tokenizer, refuse and clamp on estimate * (1 - slack) only:
+                            # prose runs nearer 5 chars per token, so 4.0 can overcount by this much
+TOKEN_CACHE_MAX = 65536     # memoized per-message token counts (LRU)
+
+# Exact-match response cache for deterministic (temperature 0) requests.
+# Off unless --cache-mb is given.
+CACHE_MAX_MB = 0
+CACHE_TTL = 300.0
+
+# Traffic capture (--capture-dir): sampled chat requests, vLLM's reply and what
+# the client got, written as rotating gzip JSONL by a background thread
+CAPTURE_SAMPLE = 1.0
+CAPTURE_FILE_MB = 64
+CAPTURE_KEEP = 20         # newest files kept (0 = never delete)
+CAPTURE_QUEUE = 1024      # records waiting for the writer; beyond this they are dropped
+
+# Logging: records are handed to a writer thread through a bounded queue, so
+# a slow console never stalls a request. The per-request summaries (RESPONSE,
+# SSE-REWRAP, STREAM-EXTRACT) are sampled per event (--log-sample); requests
+# slower than SLOW_LOG_SECONDS are always logged in full as SLOW, at most
+# SLOW_LOG_PER_MINUTE times a minute per process
+LOG_QUEUE = 10000         # records waiting for the writer; beyond this they are dropped
+LOG_SAMPLE = {}           # event -> fraction logged; '*' for the rest (default 1.0)
+SLOW_LOG_SECONDS = 60.0   # 0 = off
+SLOW_LOG_PER_MINUTE = 10
+
+# Per-request stage timings (parse, prepare, queue, upstream/connect/prefill/
+# generate, decode, extract, clean, encode, rewrap): sent as a Server-Timing
+# header, and the slowest requests are kept for GET /debug/slow
+SERVER_TIMING = True
+DEBUG_SLOW_SIZE = 20         # requests kept (0 = off)
+DEBUG_SLOW_WINDOW = 3600.0   # seconds a request stays eligible
+
+# Pre-fork mode (--workers N): N processes accept on one listening socket so
+# JSON, regex and SSE work is not capped by a single GIL. Loop-detector state
+# and metrics are shared through a directory in /dev/shm, see WorkerPool
+WORKERS = 1
+WORKER_MAX_REQUESTS = 0        # recycle a worker after about this many requests (0 = never)
+WORKER_DRAIN_TIMEOUT = 600.0   # seconds a retiring worker waits for in-flight streams
+WORKER_INDEX = None            # this process's worker slot (None = single process)
+
+# JSON codec for request/response bodies and SSE frames: orjson when it is
+# installed, stdlib json otherwise (see configure_json / --json-codec)
+JSON_CODEC = 'orjson' if orjson else 'stdlib'
+
+# Tag the model wraps text-mode tool calls in: <tools>{...}</tools>
+TOOL_TAG = 'tools'
+
+# Fields removed from vLLM responses (and stream chunks) for OpenClaw, by level
+STRIP_FIELDS = {
+    'response': ['prompt_logprobs', 'prompt_token_ids', 'kv_transfer_params', 'service_tier', 'system_fingerprint'],
+    'choice': ['stop_reason', 'token_ids'],
+    'message': ['reasoning', 'reasoning_content', 'refusal', 'annotations', 'audio', 'function_call'],
+    'usage': ['prompt_tokens_details'],
+}
+
+# Early cutoff (--no-early-cutoff to disable): tool turns are read from vLLM
+# as a stream, and once a complete tool call is followed by a repeat of a call
+# or a leaked chat-template token the upstream request is closed, so vLLM
+# frees the slot instead of generating text the extractor would throw away.
+# Streamed tool turns are never hedged (--hedge-percentile)
+EARLY_CUTOFF = True
+CUTOFF_TOKENS = ['<|im_start|>', '<|im_end|>', '<|endoftext|>', '<|eot_id|>', '<|start_header_id|>',
+                 '<|start|>', '<|end|>', '<|channel|>', '<|message|>', '<|call|>', '<|return|>']
+
+# Degeneration check (--no-degeneration-check to disable): choice 0 of every
+# single-choice chat generation is scored as it arrives, content and reasoning
+# alike. When DEGENERATION_THRESHOLD of the last DEGENERATION_WINDOW token
+# n-grams already occurred in that window, or a CUTOFF_TOKENS entry leaks into
+# the text (outside code spans and braces, where a reply or a tool call may
+# quote one), vLLM is stopped and the response ends with finish_reason
+# 'degenerate', see DegenerationDetector. Streaming requests, and tool turns
+# already read as a stream for early cutoff, are checked as they come; other
+# non-streaming requests only with --degeneration-non-streaming, which sends
+# them to vLLM as streams too
+DEGENERATION_CHECK = True
+DEGENERATION_NON_STREAMING = False
+DEGENERATION_WINDOW = 256       # n-grams scored
+DEGENERATION_NGRAM = 8          # tokens per n-gram
+DEGENERATION_THRESHOLD = 0.9    # fraction of the window that must be repeats
+
+# How streaming requests with tools are handled:
+#   'incremental' - stream from vLLM and extract tool calls on the fly
+#   'rewrap'      - force stream=False, fix the whole response, re-wrap as SSE
+TOOL_STREAMING = 'incremental'
+
+# Upstream connection pool (see configure_upstream / --pool-* flags)
+POOL_SIZE = 32            # Max idle keep-alive connections kept to vLLM
+POOL_IDLE_TIMEOUT = 4.0   # Drop idle connections before vLLM's 5s keep-alive does
+VLLM_SOCKET = None        # Unix socket path; when set, VLLM_URL only supplies Host
+
+# Upstream timeouts and retries for chat requests (see post_upstream). A
+# request is sent again only when vLLM produced no answer for it: connection
+# failures and 502/503/504. Read timeouts are not retried (vLLM may still be
+# generating), nor is anything once a stream has started reaching the client.
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 300.0          # longest silence from vLLM, prefill included
+RETRY_MAX = 2                 # retries per request
+RETRY_BACKOFF = 0.25          # seconds; full jitter over RETRY_BACKOFF * 2^attempt
+RETRY_BUDGET = 0.1            # retries + hedges allowed per request sent
+RETRY_BUDGET_RESERVE = 10     # ...and as a burst when traffic has been quiet
+RETRY_STATUSES = {502, 503, 504}
+# Hedging, for non-streaming requests with several backends: if the first
+# backend hasn't answered within HEDGE_PERCENTILE of recent latencies, send a
+# copy to another one, keep the first answer and cut the other off
+HEDGE_PERCENTILE = 0          # e.g. 95; 0 = off
+HEDGE_MIN_DELAY = 1.0         # seconds; lower bound on the hedge delay
+# Client disconnects (--no-disconnect-cancel to disable): when a chat client
+# hangs up before its response is done, the upstream request is closed so
+# vLLM aborts the generation instead of finishing it for nobody
+DISCONNECT_CANCEL = True
+DISCONNECT_POLL_INTERVAL = 0.5   # seconds between looks at the clients' sockets (Flask engine)
+
+# Non-chat passthrough (forward_request): bodies are piped, never buffered.
+# Upstream chunks are relayed as they arrive; fixed-length bodies are read
+# PASSTHROUGH_CHUNK bytes at a time.
+PASSTHROUGH_CHUNK = 256 * 1024
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'transfer-encoding'}
+
+
+
+class UpstreamConnection(HTTPConnection):
+    """HTTP connection to vLLM over TCP (with TCP_NODELAY/keepalive) or a Unix socket."""
+
+    default_socket_options = HTTPConnection.default_socket_options + [
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+    ]
+
+    def _new_conn(self):
+        if not VLLM_SOCKET:
+            return super()._new_conn()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        sock.connect(VLLM_SOCKET)
+        return sock
+
+
+class UpstreamConnectionPool(HTTPConnectionPool):
+    """Keep-alive pool that evicts connections idle longer than POOL_IDLE_TIMEOUT,
+    so we never reuse a socket vLLM is about to close."""
+
+    ConnectionCls = UpstreamConnection
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        idle_since = getattr(conn, 'idle_since', None)
+        if idle_since is not None and time.monotonic() - idle_since > POOL_IDLE_TIMEOUT:
+            conn.close()
+        call = getattr(upstream_call, 'current', None)
+        if call is not None:
+            call.checkout(conn)
+        return conn
+
+    def _put_conn(self, conn):
+        if conn is not None:
+            conn.idle_since = time.monotonic()
+        call = getattr(upstream_call, 'current', None)
+        if call is not None:
+            call.checkin(conn)
+        super()._put_conn(conn)
+
+
+class UpstreamAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            **self.poolmanager.pool_classes_by_scheme,
+            'http': UpstreamConnectionPool,
+        }
+
+
+def create_upstream_session():
+    session = requests.Session()
+    # One pool per backend host; extra concurrent requests beyond POOL_SIZE
+    # still go through but their connections aren't kept afterwards.
+    adapter = UpstreamAdapter(pool_connections=16, pool_maxsize=POOL_SIZE, pool_block=False)
+    session.mount('http://', adapter)
+    return session
+
+
+upstream = create_upstream_session()
+# The UpstreamCall of the request (or HedgedAttempt) on this thread, if any:
+# it is told which pooled connections it holds, so the request can be cut off
+# when its client hangs up or it loses a hedge
+upstream_call = threading.local()
+
+
+def configure_upstream(pool_size, idle_timeout, socket_path):
+    global POOL_SIZE, POOL_IDLE_TIMEOUT, VLLM_SOCKET, upstream
+    POOL_SIZE = pool_size
+    POOL_IDLE_TIMEOUT = idle_timeout
+    VLLM_SOCKET = socket_path
+    upstream = create_upstream_session()
+
+
+# Prometheus metrics served on /metrics: name -> (type, help, histogram buckets)
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+TOKEN_RATE_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 250, 500)
+TOKENS_SAVED_BUCKETS = (100, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+METRIC_DEFS = {
+    'proxy_requests_total': ('counter', 'Requests answered, by path type and status', None),
+    'proxy_request_duration_seconds': ('histogram', 'Time from request arrival to the last byte sent, by path type', LATENCY_BUCKETS),
+    'proxy_requests_in_flight': ('gauge', 'Requests currently being served, by path type', None),
+    'proxy_upstream_ttfb_seconds': ('histogram', 'Time from sending upstream to the first response byte (first SSE chunk for streams)', LATENCY_BUCKETS),
+    'proxy_prompt_tokens_total': ('counter', 'Prompt tokens reported in usage', None),
+    'proxy_completion_tokens_total': ('counter', 'Completion tokens reported in usage', None),
+    'proxy_completion_tokens_per_second': ('histogram', 'Per-request generation speed from usage', TOKEN_RATE_BUCKETS),
+    'proxy_tool_extraction_scans_total': ('counter', 'Tool-enabled choices checked for calls written as text; result is hit, miss or native', None),
+    'proxy_tool_calls_extracted_total': ('counter', 'Tool calls recovered from content, by strategy', None),
+    'proxy_loop_aborts_total': ('counter', 'Conversations cut off by the loop detector, by reason', None),
+    'proxy_tool_results_compacted_total': ('counter', 'Tool results shrunk before forwarding, by kind (elided or truncated)', None),
+    'proxy_compaction_tokens_saved': ('histogram', 'Prompt tokens removed from a request by tool-result compaction', TOKENS_SAVED_BUCKETS),
+    'proxy_log_dropped_total': ('counter', 'Log records dropped because the log writer queue was full', None),
+    'proxy_slow_requests_total': ('counter', 'Requests slower than --slow-log-seconds, by whether a SLOW line was written (rate limit)', None),
+    'proxy_early_cutoffs_total': ('counter', 'Tool turns whose upstream generation was stopped after a complete call, by reason (repeat, junk)', None),
+    'proxy_cutoff_tokens_saved_total': ('counter', 'Completion tokens early cutoffs kept vLLM from generating, at most (max_tokens or context room left at the cutoff)', None),
+    'proxy_degenerations_total': ('counter', 'Generations stopped as degenerate, by reason (repetition, blocklist)', None),
+    'proxy_degeneration_tokens_saved_total': ('counter', 'Completion tokens the degeneration check kept vLLM from generating, at most (max_tokens or context room left when stopped)', None),
+    'proxy_cancelled_generations_total': ('counter', 'Chat requests whose upstream generation was cancelled because the client hung up, by path type', None),
+    'proxy_cancelled_tokens_avoided_total': ('counter', 'Completion tokens cancelled generations did not produce, at most (max_tokens or context room left at the cancel)', None),
+    'proxy_config_reloads_total': ('counter', 'Config file reloads, by result (ok, error); an unchanged file is not counted', None),
+    'proxy_upstream_retries_total': ('counter', 'Chat requests sent to vLLM again after a connection error or a 502/503/504, by reason', None),
+    'proxy_upstream_retries_denied_total': ('counter', 'Retries and hedges skipped because the retry budget was spent', None),
+    'proxy_upstream_hedges_total': ('counter', 'Non-streaming requests duplicated to a second backend, by which copy answered first (primary, hedge, neither)', None),
+    'proxy_context_guard_total': ('counter', 'Chat requests whose max_tokens was clamped to the context window, or that were refused as too long', None),
+    'proxy_warmup_requests_total': ('counter', 'Prefix-cache warm-up requests, by trigger (start, recovered) and result (ok, error, unreachable, busy)', None),
+    'proxy_warmup_prompt_tokens_total': ('counter', 'Prompt tokens vLLM prefilled for warm-up requests', None),
+    'proxy_request_bodies_total': ('counter', 'Chat bodies sent to vLLM, by encoding: unchanged (the client\'s bytes), patched (top-level members spliced in) or reencoded', None),
+}
+
+
+class Metrics:
+    """Small Prometheus registry that stays off the request path's locks.
+
+    inc()/observe() only append an event to a deque (atomic in CPython, no
+    lock); events are folded into the totals when /metrics is scraped, or
+    early once FOLD_AT of them have piled up."""
+
+    FOLD_AT = 10000
+    SHARE_INTERVAL = 2.0
+
+    def __init__(self):
+        self.events = collections.deque()
+        self.lock = threading.Lock()
+        self.values = collections.defaultdict(float)   # (name, labels) -> counter/gauge value
+        self.histograms = {}                           # (name, labels) -> [count per bucket..., +Inf, sum]
+        self.shared_dir = None                         # --workers: snapshot directory, see share()
+        self.worker = None
+        self.live = None
+
+    def inc(self, name, value=1, **labels):
+        self.events.append((name, tuple(sorted(labels.items())), value, False))
+        if len(self.events) > self.FOLD_AT:
+            self.fold()
+
+    def observe(self, name, value, **labels):
+        self.events.append((name, tuple(sorted(labels.items())), value, True))
+        if len(self.events) > self.FOLD_AT:
+            self.fold()
+
+    def fold(self):
+        with self.lock:
+            while True:
+                try:
+                    name, labels, value, is_observation = self.events.popleft()
+                except IndexError:
+                    return
+                if not is_observation:
+                    self.values[(name, labels)] += value
+                    continue
+                buckets = METRIC_DEFS[name][2]
+                hist = self.histograms.get((name, labels))
+                if hist is None:
+                    hist = self.histograms[(name, labels)] = [0] * (len(buckets) + 2)
+                hist[bisect.bisect_left(buckets, value)] += 1
+                hist[-1] += value
+
+    def totals(self):
+        """This process's folded (values, histograms), sorted."""
+        self.fold()
+        with self.lock:
+            values = sorted(self.values.items())
+            histograms = sorted((key, list(hist)) for key, hist in self.histograms.items())
+        return values, histograms
+
+    def share(self, directory, worker, live):
+        """--workers: publish this process's totals to directory every
+        SHARE_INTERVAL so whichever worker gets scraped can report all of them."""
+        self.shared_dir, self.worker, self.live = directory, worker, live
+        threading.Thread(target=self.share_loop, daemon=True, name='metrics-share').start()
+
+    def share_loop(self):
+        while True:
+            try:
+                self.publish()
+            except Exception as e:
+                logger.error(f'Metrics snapshot error: {e}')
+            time.sleep(self.SHARE_INTERVAL)
+
+    def publish(self, live=None):
+        values, histograms = self.totals()
+        snapshot = {'worker': self.worker,
+                    'values': [[name, labels, value] for (name, labels), value in values],
+                    'histograms': [[name, labels, hist] for (name, labels), hist in histograms],
+                    'live': self.live() if live is None else live}
+        write_atomic(os.path.join(self.shared_dir, f'metrics-{os.getpid()}.json'), json_dumps(snapshot))
+
+    def collect(self, live):
+        """Sum every worker's snapshot (and retired workers' totals); live
+        samples are not summable (backend_up, limits) so they get a worker label."""
+        self.publish(live)
+        values, histograms, samples = collections.defaultdict(float), {}, []
+        for snapshot in read_metric_snapshots(self.shared_dir):
+            for name, labels, value in snapshot['values']:
+                values[(name, tuple(map(tuple, labels)))] += value
+            for name, labels, hist in snapshot['histograms']:
+                key = (name, tuple(map(tuple, labels)))
+                total = histograms.get(key)
+                histograms[key] = hist if total is None else [a + b for a, b in zip(total, hist)]
+            for name, kind, text, labels, value in snapshot['live']:
+                samples.append((name, kind, text, dict(labels, worker=str(snapshot['worker'])), value))
+        return sorted(values.items()), sorted(histograms.items()), samples
+
+    def render(self, live=()):
+        """Prometheus text format; live is extra (name, type, help, labels, value)
+        samples read from current state (router, admission, cache)."""
+        if self.shared_dir:
+            values, histograms, live = self.collect(live)
+        else:
+            values, histograms = self.totals()
+        families = collections.defaultdict(list)
+        for (name, labels), value in values:
+            families[name].append(f'{name}{format_labels(labels)} {format_value(value)}')
+        for (name, labels), hist in histograms:
+            cumulative = 0
+            for bound, count in zip(METRIC_DEFS[name][2] + ('+Inf',), hist):
+                cumulative += count
+                families[name].append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {cumulative}')
+            families[name].append(f'{name}_sum{format_labels(labels)} {format_value(hist[-1])}')
+            families[name].append(f'{name}_count{format_labels(labels)} {cumulative}')
+        types = {name: (kind, text) for name, (kind, text, _) in METRIC_DEFS.items()}
+        for name, kind, text, labels, value in live:
+            types.setdefault(name, (kind, text))
+            families[name].append(f'{name}{format_labels(tuple(labels.items()))} {format_value(value)}')
+        lines = []
+        for name in sorted(families):
+            kind, text = types[name]
+            lines += [f'# HELP {name} {text}', f'# TYPE {name} {kind}'] + families[name]
+        return '\n'.join(lines) + '\n'
+
+
+def write_atomic(path, data):
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+@contextlib.contextmanager
+def metric_snapshots_locked(directory, exclusive=False):
+    """Scrapes read the snapshots under a shared lock while the master folds
+    a finished worker into the retired totals under an exclusive one, so a
+    counter is never seen twice or not at all."""
+    with open(os.path.join(directory, 'metrics.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_metric_snapshots(directory):
+    snapshots = []
+    with metric_snapshots_locked(directory):
+        for name in os.listdir(directory):
+            if name.startswith('metrics-') and name.endswith('.json'):
+                try:
+                    with open(os.path.join(directory, name), 'rb') as f:
+                        snapshots.append(json_loads(f.read()))
+                except (OSError, ValueError):
+                    continue
+    return snapshots
+
+
+def retire_worker_metrics(directory, pid):
+    """Fold a finished worker's counters and histograms into
+    metrics-retired.json so totals never go backwards; its gauges (nothing
+    is in flight any more) and live samples are dropped."""
+    path = os.path.join(directory, f'metrics-{pid}.json')
+    retired_path = os.path.join(directory, 'metrics-retired.json')
+    with metric_snapshots_locked(directory, exclusive=True):
+        try:
+            with open(path, 'rb') as f:
+                snapshot = json_loads(f.read())
+        except (OSError, ValueError):
+            return
+        try:
+            with open(retired_path, 'rb') as f:
+                retired = json_loads(f.read())
+        except (OSError, ValueError):
+            retired = {'worker': 'retired', 'values': [], 'histograms': [], 'live': []}
+        values = {(name, json_dumps(labels)): value for name, labels, value in retired['values']}
+        for name, labels, value in snapshot['values']:
+            if METRIC_DEFS[name][0] == 'counter':
+                key = (name, json_dumps(labels))
+                values[key] = values.get(key, 0) + value
+        histograms = {(name, json_dumps(labels)): hist for name, labels, hist in retired['histograms']}
+        for name, labels, hist in snapshot['histograms']:
+            key = (name, json_dumps(labels))
+            total = histograms.get(key)
+            histograms[key] = hist if total is None else [a + b for a, b in zip(total, hist)]
+        retired['values'] = [[name, json_loads(labels), value] for (name, labels), value in values.items()]
+        retired['histograms'] = [[name, json_loads(labels), hist] for (name, labels), hist in histograms.items()]
+        write_atomic(retired_path, json_dumps(retired))
+        os.remove(path)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+
+def format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+metrics = Metrics()
+
+
+class QueueLogHandler(logging.handlers.QueueHandler):
+    """Hands records to the log writer thread without blocking: formatting
+    (and LogEvent fields) happen on that thread, and when the queue is full
+    the record is dropped and counted."""
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc('proxy_log_dropped_total')
+
+
+log_writer = None
+
+
+def start_log_writer():
+    """Move the root logger's handlers behind a QueueLogHandler and a writer
+    thread. Threads do not survive a fork: with --workers each worker calls
+    this itself."""
+    global log_writer
+    root = logging.getLogger()
+    handlers = [h for h in root.handlers if not isinstance(h, QueueLogHandler)]
+    log_queue = queue.Queue(LOG_QUEUE)
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(QueueLogHandler(log_queue))
+    log_writer = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    log_writer.start()
+    atexit.register(stop_log_writer)
+
+
+def stop_log_writer():
+    """Write out what is queued (the listener's stop() drains the queue)."""
+    global log_writer
+    if log_writer:
+        log_writer.stop()
+        log_writer = None
+
+
+class LogEvent:
+    """A structured log line, EVENT: {json}. `fields` is a callable that is
+    only run when the writer thread formats the record."""
+
+    __slots__ = ('event', 'fields')
+
+    def __init__(self, event, fields):
+        self.event = event
+        self.fields = fields
+
+    def __str__(self):
+        return f'{self.event}: {json_dumps(self.fields()).decode()}'
+
 
+def log_event(event, fields):
+    """Log a per-request summary, subject to LOG_SAMPLE, and keep it for the
+    request's SLOW line either way."""
+    info = request_log.get()
+    if info is not None:
+        info.summary = fields
+    rate = LOG_SAMPLE.get(event, LOG_SAMPLE.get('*', 1.0))
+    if rate < 1.0 and random.random() >= rate:
+        return
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(LogEvent(event, fields))
+
+
+class RequestLog:
+    """What the SLOW line and /debug/slow report about the request being
+    served. Filled in by reference as the request goes along (stage() adds
+    the timings); fields() only runs if it is logged."""
+
+    __slots__ = ('started', 'stages', 'body', 'backend', 'estimate', 'summary', 'tokens')
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.stages = {}
+        self.body = self.backend = self.estimate = self.summary = None
+        self.tokens = 0          # SSE events received from vLLM so far, about one token each
+
+    def fields(self, path_type, status, seconds):
+        body = self.body if isinstance(self.body, dict) else {}
+        fields = {'path': path_type, 's': status, 'ms': round(seconds * 1000),
+                  'model': body.get('model'), 'messages': len(body.get('messages') or []),
+                  'tools': len(body.get('tools') or []), 'max_tokens': body.get('max_tokens'),
+                  'backend': self.backend, 'estimate': self.estimate, 'tokens': self.tokens,
+                  'stages': {name: round(t * 1000, 2) for name, t in self.stages.items()}}
+        if self.summary:
+            fields.update(self.summary())
+        return fields
+
+    def server_timing(self):
+        """The stages so far as a Server-Timing header value (milliseconds)."""
+        timings = [f'{name};dur={t * 1000:.2f}' for name, t in self.stages.items()]
+        timings.append(f'total;dur={(time.monotonic() - self.started) * 1000:.2f}')
+        return ', '.join(timings)
+
+
+# The RequestLog of the request being served; set at the top of proxy()
+request_log = contextvars.ContextVar('request_log', default=None)
+
+
+def stage(name, since, now=None):
+    """Count now - since (monotonic seconds) towards stage `name` of the
+    request being served. Returns now, where the next stage starts."""
+    if now is None:
+        now = time.monotonic()
+    info = request_log.get()
+    if info is not None:
+        info.stages[name] = info.stages.get(name, 0.0) + now - since
+    return now
+
+
+def with_server_timing(response, info):
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = info.server_timing()
+    return response
+
+
+class SlowRequests:
+    """The DEBUG_SLOW_SIZE slowest requests of the last DEBUG_SLOW_WINDOW
+    seconds, with their stage timings, for GET /debug/slow. A min-heap on
+    duration, so a request that does not make the cut costs one comparison."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap = []      # (seconds, seq, finished at, fields)
+        self.seq = itertools.count()
+
+    def offer(self, info, path_type, status, seconds):
+        now = time.time()
+        with self.lock:
+            if (len(self.heap) >= DEBUG_SLOW_SIZE and seconds <= self.heap[0][0]
+                    and now - self.heap[0][2] < DEBUG_SLOW_WINDOW):
+                return
+        fields = info.fields(path_type, status, seconds)
+        fields['at'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(now))
+        with self.lock:
+            if any(now - entry[2] >= DEBUG_SLOW_WINDOW for entry in self.heap):
+                self.heap = [entry for entry in self.heap if now - entry[2] < DEBUG_SLOW_WINDOW]
+                heapq.heapify(self.heap)
+            entry = (seconds, next(self.seq), now, fields)
+            if len(self.heap) < DEBUG_SLOW_SIZE:
+                heapq.heappush(self.heap, entry)
+            elif seconds > self.heap[0][0]:
+                heapq.heapreplace(self.heap, entry)
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            entries = [entry for entry in self.heap if now - entry[2] < DEBUG_SLOW_WINDOW]
+        return [entry[3] for entry in sorted(entries, key=lambda entry: -entry[0])]
+
+
+slow_requests = SlowRequests()
+
+
+class SlowLog:
+    """Token bucket that keeps SLOW lines to SLOW_LOG_PER_MINUTE."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tokens = None
+        self.updated = time.monotonic()
+
+    def allow(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.tokens is None:
+                self.tokens = float(SLOW_LOG_PER_MINUTE)
+            self.tokens = min(SLOW_LOG_PER_MINUTE, self.tokens + (now - self.updated) * SLOW_LOG_PER_MINUTE / 60)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+slow_log = SlowLog()
+
+
+def log_slow(path_type, status, seconds):
+    info = request_log.get() or RequestLog()
+    logged = slow_log.allow()
+    metrics.inc('proxy_slow_requests_total', logged='yes' if logged else 'no')
+    if logged:
+        logger.warning(LogEvent('SLOW', lambda: info.fields(path_type, status, seconds)))
+
+
+def request_started(path_type):
+    metrics.inc('proxy_requests_in_flight', path=path_type)
+    return time.monotonic()
+
+
+def request_finished(path_type, started, status):
+    metrics.inc('proxy_requests_in_flight', -1, path=path_type)
+    metrics.inc('proxy_requests_total', path=path_type, status=str(status))
+    seconds = time.monotonic() - started
+    metrics.observe('proxy_request_duration_seconds', seconds, path=path_type)
+    if SLOW_LOG_SECONDS and seconds >= SLOW_LOG_SECONDS:
+        log_slow(path_type, status, seconds)
+    info = request_log.get()
+    if DEBUG_SLOW_SIZE and info is not None:
+        slow_requests.offer(info, path_type, status, seconds)
+
+
+def observe_ttfb(path_type, sent_at):
+    metrics.observe('proxy_upstream_ttfb_seconds', time.monotonic() - sent_at, path=path_type)
+
+
+def observe_usage(usage, seconds):
+    """Token counters plus per-request generation speed from a usage object."""
+    if not isinstance(usage, dict):
+        return
+    prompt = usage.get('prompt_tokens') or 0
+    completion = usage.get('completion_tokens') or 0
+    metrics.inc('proxy_prompt_tokens_total', prompt)
+    metrics.inc('proxy_completion_tokens_total', completion)
+    if completion and seconds > 0:
+        metrics.observe('proxy_completion_tokens_per_second', completion / seconds)
+
+
+def observe_extraction(mode, result, strategies=None):
+    metrics.inc('proxy_tool_extraction_scans_total', mode=mode, result=result)
+    for strategy, count in (strategies or {}).items():
+        metrics.inc('proxy_tool_calls_extracted_total', count, mode=mode, strategy=strategy)
+
+
+def usage_from_sse_tail(tail):
+    """usage object from the last SSE events of a relayed stream, if vLLM sent one."""
+    for line in reversed(tail.split(b'\n')):
+        if line.startswith(b'data: {') and b'"usage"' in line:
+            try:
+                return json_loads(line[6:]).get('usage')
+            except ValueError:
+                return None
+    return None
+
+
+
+def stdlib_loads(data):
+    return json.loads(data)
+
+
+def stdlib_dumps(obj, sort_keys=False):
+    return json.dumps(obj, sort_keys=sort_keys, separators=(',', ':')).encode()
+
+
+def orjson_loads(data):
+    return orjson.loads(data)
+
+
+def orjson_dumps(obj, sort_keys=False):
+    try:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    except TypeError:
+        # Non-string keys or integers beyond 64 bits
+        return stdlib_dumps(obj, sort_keys)
+
+
+# json_loads(str | bytes) -> object, json_dumps(obj) -> compact UTF-8 bytes
+json_loads, json_dumps = (orjson_loads, orjson_dumps) if orjson else (stdlib_loads, stdlib_dumps)
+
+
+def configure_json(codec):
+    """codec: 'auto', 'orjson' or 'stdlib'."""
+    global JSON_CODEC, json_loads, json_dumps
+    if codec == 'auto':
+        codec = 'orjson' if orjson else 'stdlib'
+    if codec == 'orjson' and not orjson:
+        raise SystemExit('--json-codec orjson needs: pip3 install orjson')
+    JSON_CODEC = codec
+    json_loads, json_dumps = (orjson_loads, orjson_dumps) if codec == 'orjson' else (stdlib_loads, stdlib_dumps)
+
+
+def sse_event(obj):
+    return b'data: ' + json_dumps(obj) + b'\n\n'
+
+
+# A top-level key written with \u escapes would hide from the literal search
+# in ClientBody.locate; letters, digits and '_' are all the keys it looks for
+ESCAPED_WORD_CHAR = re.compile(rb'\\u00(?:3[0-9]|4[1-9a-fA-F]|5[0-9aAfF]|6[1-9a-fA-F]|7[0-9aA])')
+WORD_KEY = re.compile(r'\w+', re.ASCII)
+JSON_SCALAR = re.compile(rb'\s*(?:true|false|null|-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?|"[^"\\]*(?:\\.[^"\\]*)*")')
+JSON_FLAT_CONTAINER = re.compile(rb'\s*(?:\{[^"\[\]{}]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]{}]*)*\}'
+                                 rb'|\[[^"\[\]{}]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]{}]*)*\])')
+
+
+def is_flat(value):
+    """A scalar, or a list/dict of scalars (stream_options, stop, ...)."""
+    if isinstance(value, dict):
+        value = value.values()
+    elif not isinstance(value, list):
+        return True
+    return not any(isinstance(v, (dict, list)) for v in value)
+
+
+class ClientBody:
+    """A chat request body as the client sent it: the raw bytes and a
+    shallow copy of the top-level members they decoded to.
+
+    encode() compares a body about to go upstream with that copy, member by
+    member and by identity, so it costs nothing per message. An unchanged
+    body is sent as the client's own bytes, and added members are written
+    in after the opening brace. With the stdlib codec, changed or removed
+    flat members (stream, stream_options, max_tokens, ...) are spliced in
+    place too. Edits inside the history (tool-result compaction, see
+    touched) re-encode the whole body."""
+
+    def __init__(self, raw, body):
+        self.raw = raw
+        self.fields = dict(body)
+        self.touched = set()     # members edited in place, e.g. messages by compaction
+
+    def encode(self, body):
+        fields = self.fields
+        changed = {k: v for k, v in body.items() if k in self.touched or k not in fields or fields[k] is not v}
+        removed = [k for k in fields if k not in body]
+        if not changed and not removed:
+            metrics.inc('proxy_request_bodies_total', encoding='unchanged')
+            return self.raw
+        data = self.patch(changed, removed)
+        if data is None:
+            metrics.inc('proxy_request_bodies_total', encoding='reencoded')
+            return json_dumps(body)
+        metrics.inc('proxy_request_bodies_total', encoding='patched')
+        return data
+
+    def patch(self, changed, removed):
+        """raw with the changed members replaced or added and the removed ones
+        cut out, or None when that can't be done safely."""
+        raw = self.raw
+        existing = [k for k in changed if k in self.fields] + removed
+        if existing:
+            # Finding a member means searching the whole body, which takes
+            # about as long as orjson re-encoding it; one cut at a time, as
+            # two removed neighbours would both claim the comma between them
+            if JSON_CODEC == 'orjson' or len(removed) > 1:
+                return None
+            if any(k in self.touched or not is_flat(self.fields[k]) for k in existing):
+                return None
+        spans = self.locate(existing) if existing else {}
+        if spans is None:
+            return None
+        edits = []       # (start, end, replacement), applied back to front
+        for key, (start, end) in spans.items():
+            if key in changed:
+                edits.append((start, end, json_dumps(key) + b':' + json_dumps(changed[key])))
+                continue
+            # Cut the member with the comma after it, or the one before it if it is last
+            after = len(raw) - len(raw[end:].lstrip())
+            if raw[after:after + 1] == b',':
+                edits.append((start, after + 1, b''))
+            else:
+                before = len(raw[:start].rstrip())
+                edits.append((before - 1 if raw[before - 1:before] == b',' else start, end, b''))
+        opening = len(raw) - len(raw.lstrip())
+        if raw[opening:opening + 1] != b'{':
+            return None
+        added = [json_dumps(k) + b':' + json_dumps(v) for k, v in changed.items() if k not in self.fields]
+        parts, pos = [], len(raw)
+        for start, end, replacement in sorted(edits, reverse=True):
+            parts += [raw[end:pos], replacement]
+            pos = start
+        parts.append(raw[opening + 1:pos])
+        rest = b''.join(reversed(parts))
+        if added:
+            rest = b','.join(added) + (b',' if rest.lstrip()[:1] != b'}' else b'') + rest
+        return raw[:opening + 1] + rest
+
+    def locate(self, keys):
+        """{key: (start, end)} byte span of each top-level member named in
+        keys, found by a literal search: a key that occurs exactly once as
+        a key, and isn't written escaped anywhere, must be the top-level one.
+        None if any key is ambiguous."""
+        raw, found = self.raw, {}
+        if not all(WORD_KEY.fullmatch(k) for k in keys) or ESCAPED_WORD_CHAR.search(raw):
+            return None
+        pattern = rb'"(' + b'|'.join(re.escape(k.encode()) for k in keys) + rb')"\s*:'
+        for m in re.finditer(pattern, raw):
+            start = m.start()
+            if raw[start - 1:start] == b'\\' and (start - len(raw[:start].rstrip(b'\\'))) % 2:
+                continue        # an escaped quote inside a string
+            key = m.group(1).decode()
+            if key in found:
+                return None
+            value = JSON_SCALAR.match(raw, m.end()) or JSON_FLAT_CONTAINER.match(raw, m.end())
+            if value is None:
+                return None
+            found[key] = (start, value.end())
+        return found if len(found) == len(keys) else None
+
+
+# The ClientBody of the chat request being served; set in proxy() and read
+# by post_upstream when the body goes to vLLM
+client_body = contextvars.ContextVar('client_body', default=None)
+
+
+def encode_body(body):
+    """The bytes to send vLLM for chat body, reusing the client's where
+    they still hold (see ClientBody)."""
+    source = client_body.get()
+    if source is None or not isinstance(body, dict):
+        return json_dumps(body)
+    return source.encode(body)
 
 
 def has_tools(body):
@@ -60,31 +1051,866 @@ def count_tool_results(messages):
 
 
 
+class ConversationState:
+    """What the loop detector remembers about one conversation."""
+
+    def __init__(self):
+        self.seen = 0                   # messages already processed
+        self.last_hash = None           # hash of messages[seen - 1]
+        self.tool_results = 0
+        self.recent = collections.deque(maxlen=LOOP_WINDOW)  # fingerprints since last user turn
+
+    def dump(self):
+        return json_dumps([self.seen, self.last_hash, self.tool_results, list(self.recent)])
+
+    @classmethod
+    def load(cls, data):
+        state = cls()
+        state.seen, state.last_hash, state.tool_results, recent = json_loads(data)
+        state.recent.extend(recent)
+        return state
+
+
+class ConversationStore:
+    """Loop-detector state of the last LOOP_STATE_MAX conversations (LRU),
+    in this process."""
+
+    def __init__(self):
+        self.states = collections.OrderedDict()   # conversation id -> ConversationState
+        self.lock = threading.Lock()
+
+    def update(self, conv_id, messages):
+        """Fold messages into the conversation's state.
+        Returns (tool results so far, recent call fingerprints)."""
+        with self.lock:
+            state = self.states.pop(conv_id, None) or ConversationState()
+            self.states[conv_id] = state
+            while len(self.states) > LOOP_STATE_MAX:
+                self.states.popitem(last=False)
+            update_conversation(state, messages)
+            return state.tool_results, list(state.recent)
+
+
+class SharedConversationStore:
+    """The same, in a SQLite file every --workers process opens, so the
+    counters are right whichever worker a conversation's next request lands
+    on. Each update is one short IMMEDIATE transaction: read, fold, write."""
+
+    PRUNE_EVERY = 256
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.updates = itertools.count(1)
+
+    @staticmethod
+    def create(path):
+        db = sqlite3.connect(path)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS conversations '
+                   '(id TEXT PRIMARY KEY, state BLOB NOT NULL, touched REAL NOT NULL)')
+        db.execute('CREATE INDEX IF NOT EXISTS conversations_touched ON conversations (touched)')
+        db.commit()
+        db.close()
+
+    def connection(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA synchronous=OFF')
+        return db
+
+    def update(self, conv_id, messages):
+        db = self.connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute('SELECT state FROM conversations WHERE id = ?', (conv_id,)).fetchone()
+            state = ConversationState.load(row[0]) if row else ConversationState()
+            update_conversation(state, messages)
+            db.execute('INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)',
+                       (conv_id, state.dump(), time.time()))
+            if next(self.updates) % self.PRUNE_EVERY == 0:
+                db.execute('DELETE FROM conversations WHERE id IN (SELECT id FROM conversations '
+                           'ORDER BY touched DESC LIMIT -1 OFFSET ?)', (LOOP_STATE_MAX,))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return state.tool_results, list(state.recent)
+
+
+conversations = ConversationStore()
+
+
+def stable_hash(obj):
+    return hashlib.blake2b(json_dumps(obj, sort_keys=True), digest_size=16).hexdigest()
+
+
+def conversation_id(body, messages):
+    """Identify a conversation by its stable prefix: model plus every message
+    up to and including the first user message (system prompt, bootstrap)."""
+    prefix = []
+    for msg in messages:
+        prefix.append(msg)
+        if msg.get('role') == 'user':
+            break
+    return stable_hash([body.get('model'), prefix])
+
+
+def tool_call_fingerprint(tool_call):
+    """Hash of name + arguments, with arguments canonicalized when they are JSON."""
+    fn = tool_call.get('function') or {}
+    args = fn.get('arguments')
+    if isinstance(args, str):
+        try:
+            args = json_loads(args)
+        except ValueError:
+            pass
+    return stable_hash([fn.get('name'), args])
+
+
+def update_conversation(state, messages):
+    """Fold the messages added since the last request into state.
+    Rebuilds from scratch if the history no longer extends what we saw
+    (client-side compaction, edits, or a hash collision on the id)."""
+    if state.seen and (len(messages) < state.seen
+                       or stable_hash(messages[state.seen - 1]) != state.last_hash):
+        state.__init__()
+    new = messages[state.seen:]
+    if not new:
+        return
+    state.tool_results += count_tool_results(new)
+    for msg in new:
+        if msg.get('role') == 'user':
+            state.recent.clear()        # new instruction: repeats start over
+        for tc in msg.get('tool_calls') or []:
+            state.recent.append(tool_call_fingerprint(tc))
+    state.seen = len(messages)
+    state.last_hash = stable_hash(messages[-1])
+
+
+class ProxyConfig:
+    """The settings --config can change while the proxy runs, as one
+    immutable snapshot. A reload builds a new snapshot and swaps it in; each
+    request keeps the one it started with (see active_config), so it finishes
+    under the rules it began under."""
+
+    def __init__(self, settings, version, digest=None):
+        self.settings = settings          # validated values, as shown by /admin/config
+        self.version = version
+        self.digest = digest              # of the file it came from
+        self.loaded_at = time.time()
+        self.backends = settings['vllm_url']
+        self.max_tool_calls = settings['max_tool_calls']
+        self.loop_repeat_limit = settings['loop_repeat_limit']
+        self.backend_max_inflight = settings['backend_max_inflight']
+        tag = settings['tool_tag']
+        self.tag_open, self.tag_close = f'<{tag}>', f'</{tag}>'
+        self.tools_regex = re.compile(rf'<{re.escape(tag)}>(.*?)</{re.escape(tag)}>', re.DOTALL)
+        # Where a tool call can start: a tag block anywhere, or '{' opening a line
+        self.tool_candidate_regex = re.compile(rf'<{re.escape(tag)}>|^[^\S\n]*\{{', re.MULTILINE)
+        self.strip_fields = {level: tuple(fields) for level, fields in settings['strip_fields'].items()}
+
+
+def base_settings():
+    """The settings as given on the command line (or the defaults)."""
+    return {
+        'vllm_url': list(VLLM_URLS),
+        'max_tool_calls': MAX_TOOL_CALLS,
+        'loop_repeat_limit': LOOP_REPEAT_LIMIT,
+        'backend_max_inflight': BACKEND_MAX_INFLIGHT,
+        'tool_tag': TOOL_TAG,
+        'strip_fields': {level: list(fields) for level, fields in STRIP_FIELDS.items()},
+    }
+
+
+def merge_settings(settings, overrides):
+    """Validate a config file's keys and apply them over settings.
+    Raises ValueError naming the first bad key; nothing is half-applied."""
+    if not isinstance(overrides, dict):
+        raise ValueError('config must be a JSON object')
+    settings = dict(settings)
+    for key, value in overrides.items():
+        if key == 'vllm_url':
+            urls = value.split(',') if isinstance(value, str) else value
+            if not isinstance(urls, list) or not all(isinstance(u, str) and u.strip() for u in urls) or not urls:
+                raise ValueError('vllm_url: expected a URL, a comma-separated string or a list of URLs')
+            settings[key] = [u.strip().rstrip('/') for u in urls]
+        elif key in ('max_tool_calls', 'loop_repeat_limit', 'backend_max_inflight'):
+            if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+                raise ValueError(f'{key}: expected a positive integer')
+            settings[key] = value
+        elif key == 'tool_tag':
+            if not isinstance(value, str) or not re.fullmatch(r'[A-Za-z_][\w.:-]*', value):
+                raise ValueError('tool_tag: expected a tag name such as "tools" or "tool_call"')
+            settings[key] = value
+        elif key == 'strip_fields':
+            if not isinstance(value, dict):
+                raise ValueError('strip_fields: expected an object of field lists')
+            fields = dict(settings[key])
+            for level, names in value.items():
+                if level not in STRIP_FIELDS:
+                    raise ValueError(f'strip_fields: unknown level {level!r} (one of {", ".join(STRIP_FIELDS)})')
+                if not isinstance(names, list) or not all(isinstance(n, str) for n in names):
+                    raise ValueError(f'strip_fields.{level}: expected a list of field names')
+                fields[level] = names
+            settings[key] = fields
+        else:
+            raise ValueError(f'unknown key {key!r}')
+    return settings
+
+
+config_generation = 0
+config_lock = threading.Lock()
+
+
+def load_config(path):
+    """A ProxyConfig for the file at path, or the running one if the file
+    has not changed. Versions are '<generation>-<sha256 prefix>'."""
+    global config_generation
+    with open(path, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    if digest == current_config.digest:
+        return current_config
+    try:
+        overrides = json_loads(data)
+    except ValueError as e:
+        raise ValueError(f'not valid JSON: {e}')
+    settings = merge_settings(base_settings(), overrides)
+    config_generation += 1
+    return ProxyConfig(settings, f'{config_generation}-{digest[:8]}', digest)
+
+
+current_config = ProxyConfig(base_settings(), 'default')
+# The config snapshot of the request being served; set at the top of proxy()
+request_config = contextvars.ContextVar('request_config', default=None)
+
+
+def active_config():
+    return request_config.get() or current_config
+
+
+def apply_config(config):
+    global current_config, router, VLLM_URL
+    if config.backends != current_config.backends:
+        router = BackendRouter(config.backends, previous=router)
+        router.start_health_checks()
+        VLLM_URL = config.backends[0]
+        logger.info(f'Backends now: {", ".join(config.backends)}')
+    current_config = config
+
+
+def reload_config(reason):
+    """Re-read CONFIG_FILE and swap it in if it is valid, else keep the
+    running config. Returns (ok, version or error)."""
+    with config_lock:
+        try:
+            config = load_config(CONFIG_FILE)
+        except (OSError, ValueError) as e:
+            logger.error(f'Config reload ({reason}) failed, keeping version {current_config.version}: {e}')
+            metrics.inc('proxy_config_reloads_total', result='error')
+            return False, str(e)
+        if config is current_config:
+            return True, config.version
+        apply_config(config)
+        logger.info(f'Config version {config.version} active ({reason})')
+        metrics.inc('proxy_config_reloads_total', result='ok')
+        return True, config.version
+
+
+def reload_config_soon(signum=None, frame=None):
+    # From the SIGHUP handler: reloading logs and takes locks, so not in here
+    threading.Thread(target=reload_config, args=('SIGHUP',), daemon=True, name='config-reload').start()
+
+
+def watch_config():
+    def signature():
+        try:
+            st = os.stat(CONFIG_FILE)
+            return st.st_mtime_ns, st.st_size, st.st_ino
+        except OSError:
+            return None
+    seen = signature()
+    while True:
+        time.sleep(CONFIG_POLL_INTERVAL)
+        now = signature()
+        if now != seen and now is not None:
+            reload_config('file changed')
+        seen = now
+
+
+def start_config_watch():
+    if CONFIG_FILE:
+        threading.Thread(target=watch_config, daemon=True, name='config-watch').start()
+        # Catch an edit made between loading the file and starting to watch it
+        reload_config('start')
+
+
+class Backend:
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.inflight = 0
+        self.healthy = True
+
+
+class BackendRouter:
+    """Prefix-cache-affinity routing over one or more vLLM backends.
+
+    Requests are placed on a consistent-hash ring (VNODES points per backend)
+    by a hash of their stable prefix (model, tools, system prompt and first
+    user turn), so each agent keeps landing on the node whose vLLM already
+    has that prefix cached. Adding or removing a backend only moves the keys
+    on its own ring segments. If the sticky backend is saturated
+    (backend_max_inflight) or down, the request spills over to the least
+    loaded healthy backend."""
+
+    VNODES = 100
+
+    def __init__(self, urls, previous=None):
+        # On a config reload, backends that stay keep their health and in-flight
+        # counts. Requests still in flight release through the router they
+        # picked from, so every generation guards the counts with one lock
+        self.lock = previous.lock if previous else threading.Lock()
+        kept = {b.url: b for b in previous.backends} if previous else {}
+        self.backends = [kept.get(u.rstrip('/')) or Backend(u) for u in urls]
+        ring = []
+        for backend in self.backends:
+            for i in range(self.VNODES):
+                ring.append((int(stable_hash(f'{backend.url}#{i}'), 16), backend))
+        ring.sort(key=lambda point: point[0])
+        self.ring_keys = [point[0] for point in ring]
+        self.ring = [point[1] for point in ring]
+
+    def pick(self, key=None):
+        """Choose a backend and count the request as in flight on it;
+        the caller must release() it when the response is done."""
+        with self.lock:
+            healthy = [b for b in self.backends if b.healthy] or self.backends
+            least_loaded = min(healthy, key=lambda b: b.inflight)
+            backend = least_loaded
+            if key is not None and len(self.backends) > 1:
+                start = bisect.bisect(self.ring_keys, int(key, 16)) % len(self.ring)
+                for i in range(len(self.ring)):
+                    candidate = self.ring[(start + i) % len(self.ring)]
+                    if candidate.healthy:
+                        backend = candidate
+                        break
+                if (backend.inflight >= active_config().backend_max_inflight
+                        and least_loaded.inflight < backend.inflight):
+                    backend = least_loaded
+            elif len(self.backends) == 1:
+                backend = self.backends[0]
+            backend.inflight += 1
+            return backend
+
+    def release(self, backend):
+        with self.lock:
+            backend.inflight -= 1
+
+    def alternate(self, url):
+        """The least loaded healthy backend other than url's, for a hedged
+        copy; counted in flight like pick(). None if there is no other."""
+        with self.lock:
+            others = [b for b in self.backends if b.healthy and not url.startswith(b.url + '/')]
+            if not others:
+                return None
+            backend = min(others, key=lambda b: b.inflight)
+            backend.inflight += 1
+            return backend
+
+    def mark(self, backend, healthy):
+        if backend.healthy != healthy:
+            logger.warning(f'Backend {backend.url} is {"healthy again" if healthy else "DOWN"}')
+            if healthy and prefix_warmer is not None:
+                # A restarted vLLM has an empty prefix cache
+                prefix_warmer.warm([backend], 'recovered')
+        backend.healthy = healthy
+
+    def track(self, backend, response):
+        """Release backend once a Flask response has been fully sent."""
+        if getattr(response, 'forward_error', False):
+            self.mark(backend, False)       # not a 502 relayed from vLLM
+        response.call_on_close(lambda: self.release(backend))
+        return response
+
+    def health_loop(self):
+        while router is self:       # until a config reload replaces us
+            time.sleep(HEALTH_CHECK_INTERVAL)
+            for backend in self.backends:
+                try:
+                    ok = upstream.get(f'{backend.url}/health', timeout=2).status_code == 200
+                except Exception:
+                    ok = False
+                self.mark(backend, ok)
+
+    def start_health_checks(self):
+        # One backend is checked too when warm-up needs to see it come back
+        if len(self.backends) > 1 or prefix_warmer is not None:
+            threading.Thread(target=self.health_loop, daemon=True, name='backend-health').start()
+
+    def info(self):
+        return [{'url': b.url, 'healthy': b.healthy, 'inflight': b.inflight} for b in self.backends]
+
+
+router = BackendRouter([VLLM_URL])
+
+
+def affinity_key(body):
+    """Routing key: everything that makes up the cacheable prompt prefix."""
+    if not body:
+        return None
+    messages = body.get('messages') or []
+    return stable_hash([conversation_id(body, messages), body.get('tools')])
+
+
+class PrefixWarmer:
+    """Keeps vLLM's prefix cache warm for the agents that use it most.
+
+    observe() counts every chat request under its agent prefix: the model,
+    the system/developer messages the conversation opens with (OpenClaw's
+    prompt and workspace bootstrap) and the tool schemas. That is what every
+    agent's first turn after a vLLM restart has to prefill again. Counts
+    decay with WARMUP_HALF_LIFE so prompts no longer in use drop out, and the
+    top WARMUP_PREFIXES are saved to WARMUP_FILE.
+
+    warm() replays them to a backend as max_tokens=1 requests on a
+    background thread: one at a time, WARMUP_INTERVAL apart, and admitted as
+    background priority, so real traffic goes first."""
+
+    TRACKED = 4         # candidates tracked per prefix kept
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.prefixes = {}          # stable_hash(prefix) -> [count, prefix]
+        self.decayed = time.monotonic()
+        self.dirty = False
+        self.warming = set()        # backend URLs with a warm-up running
+        self.load()
+
+    @staticmethod
+    def prefix(body):
+        """The agent prefix of a chat request, None if it has neither a
+        system prompt nor tools."""
+        if not isinstance(body, dict) or not isinstance(body.get('messages'), list):
+            return None
+        system = []
+        for msg in body['messages']:
+            if not isinstance(msg, dict) or msg.get('role') not in ('system', 'developer'):
+                break
+            system.append(msg)
+        if not system and not body.get('tools'):
+            return None
+        prefix = {'model': body.get('model'), 'messages': system}
+        if body.get('tools'):
+            prefix['tools'] = body['tools']
+        return prefix
+
+    def observe(self, body):
+        prefix = self.prefix(body)
+        if prefix is None:
+            return
+        key = stable_hash(prefix)
+        with self.lock:
+            entry = self.prefixes.get(key)
+            if entry is None:
+                if len(self.prefixes) >= self.TRACKED * WARMUP_PREFIXES:
+                    del self.prefixes[min(self.prefixes, key=lambda k: self.prefixes[k][0])]
+                entry = self.prefixes[key] = [0.0, prefix]
+            entry[0] += 1
+            self.dirty = True
+
+    def top(self):
+        with self.lock:
+            ranked = sorted(self.prefixes.values(), key=lambda entry: entry[0], reverse=True)
+        return ranked[:WARMUP_PREFIXES]
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                saved = json_loads(f.read())
+            for item in saved['prefixes']:
+                prefix = item['request']
+                if isinstance(prefix, dict) and isinstance(prefix.get('messages'), list):
+                    self.prefixes[stable_hash(prefix)] = [float(item['count']), prefix]
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f'Ignoring warm-up file {self.path}: {e}')
+            return
+        logger.info(f'Loaded {len(self.prefixes)} prompt prefixes to warm up from {self.path}')
+
+    def save(self):
+        now = time.monotonic()
+        with self.lock:
+            for entry in self.prefixes.values():
+                entry[0] *= 0.5 ** ((now - self.decayed) / WARMUP_HALF_LIFE)
+            self.decayed = now
+            if not self.dirty:
+                return
+            self.dirty = False
+        data = json_dumps({'saved': time.time(),
+                           'prefixes': [{'count': round(count, 3), 'request': prefix} for count, prefix in self.top()]})
+        try:
+            write_atomic(self.path, data)
+        except OSError as e:
+            logger.warning(f'Could not save warm-up prefixes to {self.path}: {e}')
+
+    def save_loop(self):
+        while True:
+            time.sleep(WARMUP_SAVE_INTERVAL)
+            self.save()
+
+    def start(self):
+        threading.Thread(target=self.save_loop, daemon=True, name='warmup-save').start()
+        self.warm(router.backends, 'start')
+
+    def warm(self, backends, trigger):
+        """Replay the top prefixes to each of backends in the background,
+        unless a warm-up of that backend is already running."""
+        prefixes = [prefix for _, prefix in self.top()]
+        if not prefixes:
+            return
+        for backend in backends:
+            with self.lock:
+                if backend.url in self.warming:
+                    continue
+                self.warming.add(backend.url)
+            threading.Thread(target=self.run, args=(backend, prefixes, trigger),
+                             daemon=True, name='prefix-warmup').start()
+
+    def run(self, backend, prefixes, trigger):
+        started = time.monotonic()
+        warmed = tokens = 0
+        try:
+            for i, prefix in enumerate(prefixes):
+                if i:
+                    time.sleep(WARMUP_INTERVAL)
+                result, prompt_tokens = self.send(backend, prefix)
+                metrics.inc('proxy_warmup_requests_total', trigger=trigger, result=result)
+                if result == 'ok':
+                    warmed += 1
+                    tokens += prompt_tokens
+                    metrics.inc('proxy_warmup_prompt_tokens_total', prompt_tokens)
+                elif result == 'unreachable':
+                    # Most likely still loading; the health check warms it once it answers
+                    router.mark(backend, False)
+                    break
+                elif result == 'busy':
+                    break
+        finally:
+            with self.lock:
+                self.warming.discard(backend.url)
+        logger.info(f'Warm-up ({trigger}) of {backend.url}: {warmed}/{len(prefixes)} prompt prefixes, '
+                    f'~{tokens} prompt tokens in {time.monotonic() - started:.1f}s')
+
+    def send(self, backend, prefix):
+        """One warm-up request. Returns (result, prompt tokens): result is
+        ok, error (vLLM refused it), unreachable or busy (not admitted)."""
+        # Some chat templates refuse a conversation without a user turn
+        body = dict(prefix, messages=prefix['messages'] + [{'role': 'user', 'content': 'Hi'}],
+                    max_tokens=1, temperature=0, stream=False)
+        if not admission.acquire(PRIORITY_BACKGROUND):
+            return 'busy', 0
+        try:
+            resp = upstream.post(f'{backend.url}/v1/chat/completions', data=json_dumps(body),
+                                 headers={'Content-Type': 'application/json'},
+                                 timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        except requests.RequestException as e:
+            logger.info(f'Warm-up request to {backend.url} failed: {e}')
+            return 'unreachable', 0
+        finally:
+            admission.release(None)
+        if resp.status_code != 200:
+            logger.info(f'Warm-up request to {backend.url} answered {resp.status_code}: {resp.text[:200]}')
+            return 'error', 0
+        try:
+            return 'ok', int(json_loads(resp.content)['usage']['prompt_tokens'])
+        except (ValueError, KeyError, TypeError):
+            return 'ok', 0
+
+
+prefix_warmer = None
+
+
+class _AdmissionWaiter:
+    __slots__ = ('loop', 'signal', 'granted', 'cancelled')
+
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.signal = loop.create_future() if loop else threading.Event()
+        self.granted = False
+        self.cancelled = False
+
+    def wake(self):
+        if self.loop:
+            self.loop.call_soon_threadsafe(self._resolve)
+        else:
+            self.signal.set()
+
+    def _resolve(self):
+        if not self.signal.done():
+            self.signal.set_result(True)
+
+
+class AdmissionController:
+    """Concurrency limit in front of vLLM with a bounded priority queue.
+
+    Keeping excess requests here instead of in vLLM's own queue means a late
+    interactive turn can overtake queued heartbeats, and long prompts aren't
+    preempted by a pile-up. With adaptive=True the limit follows vLLM's
+    reported queue depth (AIMD on vllm:num_requests_waiting)."""
+
+    def __init__(self, max_inflight, max_queue, queue_timeout):
+        self.max_limit = max_inflight
+        self.limit = max_inflight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.inflight = 0
+        self.queued = 0
+        self.waiters = []             # heap of (priority, seq, waiter)
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+        self.avg_duration = 10.0      # EWMA of admitted request durations, for Retry-After
+        self.rejected = 0
+
+    @property
+    def enabled(self):
+        return self.max_limit > 0
+
+    def _try_admit(self, priority, loop=None):
+        """Returns True (admitted), False (queue full) or a waiter to wait on."""
+        with self.lock:
+            if self.inflight < self.limit and not self.queued:
+                self.inflight += 1
+                return True
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                return False
+            waiter = _AdmissionWaiter(loop)
+            heapq.heappush(self.waiters, (priority, next(self.seq), waiter))
+            self.queued += 1
+            return waiter
+
+    def _give_up(self, waiter):
+        with self.lock:
+            if waiter.granted:
+                return True
+            waiter.cancelled = True
+            self.queued -= 1
+            self.rejected += 1
+            return False
+
+    def acquire(self, priority):
+        if not self.enabled:
+            return True
+        waiter = self._try_admit(priority)
+        if waiter is True or waiter is False:
+            return waiter
+        if waiter.signal.wait(self.queue_timeout):
+            return True
+        return self._give_up(waiter)
+
+    async def acquire_async(self, priority):
+        if not self.enabled:
+            return True
+        waiter = self._try_admit(priority, asyncio.get_running_loop())
+        if waiter is True or waiter is False:
+            return waiter
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.signal), self.queue_timeout)
+            return True
+        except asyncio.TimeoutError:
+            return self._give_up(waiter)
+        except BaseException:
+            # Client went away while queued
+            if self._give_up(waiter):
+                self.release(None)
+            raise
+
+    def release(self, started):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.inflight -= 1
+            if started is not None:
+                self.avg_duration = 0.9 * self.avg_duration + 0.1 * (time.monotonic() - started)
+            self._grant()
+
+    def _grant(self):
+        while self.waiters and self.inflight < self.limit:
+            _, _, waiter = heapq.heappop(self.waiters)
+            if waiter.cancelled:
+                continue
+            waiter.granted = True
+            self.queued -= 1
+            self.inflight += 1
+            waiter.wake()
+
+    def retry_after(self):
+        """Seconds until a slot is likely free: the queue ahead drained at the current limit."""
+        return max(1, math.ceil(self.avg_duration * (self.queued + 1) / max(1, self.limit)))
+
+    def adapt(self, vllm_waiting):
+        """AIMD step from vLLM's own queue depth."""
+        with self.lock:
+            if vllm_waiting > 0:
+                self.limit = max(1, self.limit // 2 if vllm_waiting > self.limit else self.limit - 1)
+            elif self.limit < self.max_limit:
+                self.limit += 1
+            self._grant()
+
+    def adapt_loop(self, interval=2.0):
+        while True:
+            time.sleep(interval)
+            waiting = 0.0
+            for backend in router.backends:
+                try:
+                    text = upstream.get(f'{backend.url}/metrics', timeout=2).text
+                except Exception:
+                    continue
+                for line in text.splitlines():
+                    if line.startswith('vllm:num_requests_waiting'):
+                        waiting += float(line.rsplit(' ', 1)[1])
+            self.adapt(waiting)
+
+    def start_adaptive(self):
+        threading.Thread(target=self.adapt_loop, daemon=True, name='admission-adapt').start()
+
+
+admission = AdmissionController(ADMISSION_MAX_INFLIGHT, ADMISSION_MAX_QUEUE, ADMISSION_QUEUE_TIMEOUT)
+
+
+def request_priority(headers, body):
+    """X-Priority header wins; otherwise background models and OpenClaw
+    heartbeat turns are background, everything else interactive."""
+    value = (headers.get('X-Priority') or '').strip().lower()
+    if value in ('background', 'low', 'batch'):
+        return PRIORITY_BACKGROUND
+    if value in ('interactive', 'high'):
+        return PRIORITY_INTERACTIVE
+    if body:
+        if body.get('model') in BACKGROUND_MODELS:
+            return PRIORITY_BACKGROUND
+        for msg in reversed(body.get('messages') or []):
+            if msg.get('role') == 'user':
+                if 'HEARTBEAT' in str(msg.get('content') or ''):
+                    return PRIORITY_BACKGROUND
+                break
+    return PRIORITY_INTERACTIVE
+
+
+def busy_error():
+    return json.dumps({'error': f'Proxy busy: {admission.queued} requests queued, try again later'})
+
+
+def loop_abort_response(body, reason):
+    return {
+        'id': 'chatcmpl-loop-abort',
+        'object': 'chat.completion',
+        'created': 0,
+        'model': body.get('model', 'unknown'),
+        'choices': [{
+            'index': 0,
+            'message': {
+                'role': 'assistant',
+                'content': f'[Loop detected: {reason}. Task should be complete - please provide final response.]'
+            },
+            'finish_reason': 'stop'
+        }]
+    }
+
+
 def check_tool_loop(body):
-    """Check if we've hit the max tool calls limit.
-    Returns error response if limit exceeded, None otherwise."""
-    messages = body.get('messages', [])
-    tool_count = count_tool_results(messages)
-    
-    if tool_count >= MAX_TOOL_CALLS:
-        logger.warning(f'Tool call limit exceeded: {tool_count} >= {MAX_TOOL_CALLS}')
-        return {
-            'id': 'chatcmpl-loop-abort',
-            'object': 'chat.completion',
-            'created': 0,
-            'model': body.get('model', 'unknown'),
-            'choices': [{
-                'index': 0,
-                'message': {
-                    'role': 'assistant',
-                    'content': f'[Loop detected: {tool_count} tool calls exceeded limit of {MAX_TOOL_CALLS}. Task should be complete - please provide final response.]'
-                },
-                'finish_reason': 'stop'
-            }]
-        }
+    """Check for runaway tool use in this conversation.
+    Returns error response if the same call keeps repeating or the total
+    tool call limit is exceeded, None otherwise. Only messages that are new
+    since the conversation's previous request are examined."""
+    messages = body.get('messages') or []
+    if not messages:
+        return None
+    conv_id = conversation_id(body, messages)
+    tool_count, recent = conversations.update(conv_id, messages)
+    # Only the latest run counts: polling (git status, edit, git status, ...) is progress
+    run = next((i for i, fp in enumerate(reversed(recent)) if fp != recent[-1]), len(recent))
+
+    config = active_config()
+    if run >= config.loop_repeat_limit:
+        logger.warning(f'Repeated tool call in conversation {conv_id[:8]}: {run} identical calls in a row')
+        metrics.inc('proxy_loop_aborts_total', reason='repeat')
+        return loop_abort_response(body, f'the same tool call was repeated {run} times in a row with identical arguments')
+    if tool_count >= config.max_tool_calls:
+        logger.warning(f'Tool call limit exceeded: {tool_count} >= {config.max_tool_calls}')
+        metrics.inc('proxy_loop_aborts_total', reason='limit')
+        return loop_abort_response(body, f'{tool_count} tool calls exceeded limit of {config.max_tool_calls}')
     return None
 
 
+def compact_tool_results(messages):
+    """Shrink tool results the model no longer needs in full, in place;
+    tool_call_id and name stay so call/result pairing is untouched.
+
+    A result COMPACT_AFTER_TURNS assistant turns old is replaced by a short
+    marker; a result the model has already answered to and that is longer
+    than COMPACT_MAX_CHARS keeps only its head and tail. Both depend only on
+    the messages, and the elision cutoff moves in COMPACT_STEP turns, so the
+    rewritten history is the same prefix from one turn to the next and
+    vLLM's prefix cache keeps hitting. Returns tokens saved."""
+    if not (COMPACT_AFTER_TURNS or COMPACT_MAX_CHARS):
+        return 0
+    turns = sum(1 for m in messages if isinstance(m, dict) and m.get('role') == 'assistant')
+    cutoff = 0
+    if COMPACT_AFTER_TURNS and turns > COMPACT_AFTER_TURNS:
+        cutoff = (turns - COMPACT_AFTER_TURNS) // COMPACT_STEP * COMPACT_STEP
+    turn = saved = 0
+    for msg in messages:
+        if not isinstance(msg, dict):
+            continue
+        if msg.get('role') == 'assistant':
+            turn += 1
+            continue
+        content = msg.get('content')
+        if msg.get('role') != 'tool' or not isinstance(content, str) or len(content) < COMPACT_MIN_CHARS:
+            continue
+        if turn < cutoff:
+            kind, compacted = 'elided', elided_tool_result(content)
+        elif COMPACT_MAX_CHARS and len(content) > COMPACT_MAX_CHARS and turn < turns:
+            kind, compacted = 'truncated', truncated_tool_result(content, COMPACT_MAX_CHARS)
+        else:
+            continue
+        msg['content'] = compacted
+        saved += context_guard.count(content) - context_guard.count(compacted)
+        metrics.inc('proxy_tool_results_compacted_total', kind=kind)
+    if saved:
+        metrics.observe('proxy_compaction_tokens_saved', saved)
+    return saved
+
+
+def elided_tool_result(content):
+    preview = content.strip().split('\n', 1)[0][:80]
+    return (f'[Tool output from an earlier step removed by the proxy to save context '
+            f'({len(content)} chars, began: {preview!r}). Run the tool again if you need it.]')
+
+
+def truncated_tool_result(content, max_chars):
+    half = max_chars // 2
+    return (f'{content[:half]}\n[... {len(content) - 2 * half} chars of tool output removed by the proxy ...]\n'
+            f'{content[-half:]}')
+
+
+def tool_call_from_json(call):
+    """Build an OpenAI tool_calls entry from a decoded {"name": ..., "arguments": ...}."""
+    if not isinstance(call, dict) or 'name' not in call:
+        return None
+    args = call.get('arguments', {})
+    if isinstance(args, dict):
+        args = json_dumps(args).decode()
+    return {
+        'id': f'chatcmpl-tool-{uuid.uuid4().hex[:16]}',
+        'type': 'function',
+        'function': {'name': call['name'], 'arguments': args}
+    }
 
 
 def parse_single_tool_call(text):
@@ -93,16 +1919,7 @@ def parse_single_tool_call(text):
     if not text:
         return None
     try:
-        call = json.loads(text)
-        if isinstance(call, dict) and 'name' in call:
-            args = call.get('arguments', {})
-            if isinstance(args, dict):
-                args = json.dumps(args)
-            return {
-                'id': f'chatcmpl-tool-{uuid.uuid4().hex[:16]}',
-                'type': 'function',
-                'function': {'name': call['name'], 'arguments': args}
-            }
+        return tool_call_from_json(json_loads(text))
     except (json.JSONDecodeError, ValueError):
         pass
     return None
@@ -110,21 +1927,20 @@ def parse_single_tool_call(text):
 
 def clean_response_for_openclaw(resp_json):
     """Strip vLLM and GPT-OSS specific fields for clean OpenAI format."""
+    strip = active_config().strip_fields
     try:
         # Clean top-level vLLM-specific fields
-        for field in ["prompt_logprobs", "prompt_token_ids", "kv_transfer_params",
-                       "service_tier", "system_fingerprint"]:
+        for field in strip['response']:
             resp_json.pop(field, None)
 
         for choice in resp_json.get("choices", []):
             # Clean choice-level vLLM fields
-            for field in ["stop_reason", "token_ids"]:
+            for field in strip['choice']:
                 choice.pop(field, None)
 
             msg = choice.get("message", {})
             # Remove fields OpenClaw doesn't expect
-            for field in ["reasoning", "reasoning_content", "refusal",
-                          "annotations", "audio", "function_call"]:
+            for field in strip['message']:
                 msg.pop(field, None)
             # Ensure tool_calls is absent (not empty list) when no tools
             if not msg.get("tool_calls"):
@@ -133,68 +1949,440 @@ def clean_response_for_openclaw(resp_json):
         # Clean usage fields
         usage = resp_json.get("usage", {})
         if usage:
-            usage.pop("prompt_tokens_details", None)
+            for field in strip['usage']:
+                usage.pop(field, None)
     except Exception as e:
         logger.error(f"Error cleaning response: {e}")
 
 
 
-def extract_tools_from_content(response_json):
-    """Post-process: if tool_calls is empty but content has tool JSON, fix it."""
-    try:
-        choices = response_json.get('choices', [])
-        for choice in choices:
-            msg = choice.get('message', {})
-            content = msg.get('content', '') or ''
-            tool_calls = msg.get('tool_calls') or []
+_json_decoder = json.JSONDecoder()
+
+
+def scan_tool_calls(content, strategies=None):
+    """Single pass over content. Returns (tool_calls, cleaned_content).
+
+    Jumps between candidate positions and decodes each bare object in place
+    with raw_decode, so every character is looked at a bounded number of
+    times however long the message is. Rules (shared with
+    ToolCallStreamScanner):
+      - <tools>...</tools>: each line inside that parses is a call; the
+        block is cut out of the content
+      - a line that is exactly one JSON object with a "name" is a call and
+        the line is dropped. Pretty-printed objects spanning several lines
+        count too, provided "name" is their first key or the object is the
+        whole content
+    Unlike the old three passes, bare calls next to <tools> calls are
+    extracted as well, and a <tools> block without a valid call stays.
+    cleaned_content is only stripped when calls were found. If given, the
+    strategies Counter is bumped per call: tools_tag, bare_json, multiline_json."""
+    config = active_config()
+    calls = []
+    kept = []
+    keep_from = 0
+    pos = 0
+    while True:
+        m = config.tool_candidate_regex.search(content, pos)
+        if not m:
+            break
+        if m.group() == config.tag_open:
+            block = config.tools_regex.match(content, m.start())
+            if not block:
+                pos = m.end()           # unclosed: plain text
+                continue
+            block_calls = [c for c in map(parse_single_tool_call, block.group(1).strip().split('\n')) if c]
+            if block_calls:
+                calls.extend(block_calls)
+                if strategies is not None:
+                    strategies['tools_tag'] += len(block_calls)
+                kept.append(content[keep_from:m.start()])
+                keep_from = block.end()
+            pos = block.end()
+            continue
+
+        brace = m.end() - 1
+        try:
+            obj, obj_end = _json_decoder.raw_decode(content, brace)
+        except ValueError:
+            pos = m.end()
+            continue
+        line_end = content.find('\n', obj_end)
+        if line_end < 0:
+            line_end = len(content)
+        call = None
+        if not content[obj_end:line_end].strip():
+            multi_line = '\n' in content[brace:obj_end]
+            if (not multi_line or (isinstance(obj, dict) and next(iter(obj), None) == 'name')
+                    or not (content[:m.start()].strip() or content[obj_end:].strip())):
+                call = tool_call_from_json(obj)
+        if not call:
+            pos = obj_end
+            continue
+        calls.append(call)
+        if strategies is not None:
+            strategies['multiline_json' if multi_line else 'bare_json'] += 1
+        kept.append(content[keep_from:m.start()])
+        keep_from = pos = line_end + 1
+    if not calls:
+        return calls, content
+    kept.append(content[keep_from:])
+    return calls, ''.join(kept).strip()
+
+
+def extract_tools_from_content(response_json):
+    """Post-process: if tool_calls is empty but content has tool JSON, fix it."""
+    try:
+        choices = response_json.get('choices', [])
+        for choice in choices:
+            msg = choice.get('message', {})
+            content = msg.get('content', '') or ''
+            tool_calls = msg.get('tool_calls') or []
+
+            if tool_calls:
+                observe_extraction('batch', 'native')
+                continue
+            if not content.strip():
+                continue
+
+            strategies = collections.Counter()
+            extracted_calls, cleaned = scan_tool_calls(content, strategies)
+            observe_extraction('batch', 'hit' if extracted_calls else 'miss', strategies)
+            if extracted_calls:
+                logger.info(f'Extracted {len(extracted_calls)} tool call(s) from content')
+                msg['content'] = cleaned if cleaned else None
+                msg['tool_calls'] = extracted_calls
+                choice['finish_reason'] = 'tool_calls'
+    except Exception as e:
+        logger.error(f'Error in post-processing: {e}')
+
+
+
+class ToolCallStreamScanner:
+    """Incremental counterpart of extract_tools_from_content for streamed content.
+
+    feed() takes content deltas as they arrive and returns a list of events,
+    ('text', str) or ('call', tool_call). Plain text is released immediately;
+    only spans that could still turn into a tool call are held back:
+      - '<tools>' ... '</tools>' anywhere in the text
+      - a line starting with '{' (a bare call; may span lines if its first
+        key is "name", or in any order when it is all of the content)
+    Removed spans follow the batch rules: a <tools> block is cut out in place,
+    a bare call line is dropped together with its newline, and once any call
+    was found the leading and trailing whitespace is dropped as well. Only
+    leading whitespace released with text before the first call can't be
+    taken back.
+    """
+
+    # Outside a bare JSON candidate only these characters need attention
+    NORMAL_SPECIALS = re.compile(r'[\n<]')
+    JSON_SPECIALS = re.compile(r'[{}"\\\n]')
+    STRING_SPECIALS = re.compile(r'["\\\n]')
+
+    def __init__(self):
+        config = active_config()
+        self.tag_open, self.tag_close = config.tag_open, config.tag_close
+        self.mode = 'normal'      # normal | tag | tools | bare | tail
+        self.buf = ''             # held-back candidate span
+        self.pending_ws = ''      # whitespace not yet released
+        self.line_ws_start = 0    # index in pending_ws where the current line begins
+        self.line_start = True    # only whitespace seen since the last newline
+        self.indent = ''          # leading whitespace of a bare candidate line
+        self.whole = False        # bare candidate opened the content
+        self.calls = 0
+        self.call_ends = []       # content offset where each call's text ends
+        self.fed = 0              # content chars fed so far
+        self.base = 0             # content chars fed before the current feed()
+        self.emitted = False      # any text released yet
+        self.strategies = collections.Counter()   # calls found, as in scan_tool_calls
+        self.finished = False
+        self._reset_json()
+
+    def _reset_json(self):
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.key_start = None
+        self.first_key = None
+        self.saw_newline = False
+
+    # -- output helpers ----------------------------------------------------
+
+    def _emit(self, out, s):
+        """Release the held whitespace and s. Content that begins with a call
+        loses its leading whitespace, as the batch pass strips it."""
+        s = self.pending_ws + s
+        if not self.emitted and self.calls:
+            s = s.lstrip()
+        out.append(('text', s))
+        self.emitted = True
+
+    def _text(self, out, s):
+        """Release s as content, holding back its trailing whitespace."""
+        body = s.rstrip()
+        if not body:
+            self.pending_ws += s
+            return
+        self._emit(out, body)
+        self.pending_ws = s[len(body):]
+        self.line_ws_start = len(self.pending_ws)
+        self.line_start = False
+
+    def _newline(self):
+        self.pending_ws += '\n'
+        self.line_ws_start = len(self.pending_ws)
+        self.line_start = True
+
+    def _call(self, out, call, strategy, end):
+        self.calls += 1
+        self.call_ends.append(end)
+        self.strategies[strategy] += 1
+        out.append(('call', call))
+
+    # -- feeding -----------------------------------------------------------
+
+    def feed(self, text):
+        out = []
+        pos = 0
+        n = len(text)
+        self.base = self.fed
+        while pos < n:
+            if self.mode == 'normal':
+                pos = self._feed_normal(text, pos, out)
+            elif self.mode == 'tag':
+                pos = self._feed_tag(text, pos, out)
+            elif self.mode == 'tools':
+                pos = self._feed_tools(text, pos, out)
+            else:
+                pos = self._feed_bare(text, pos, out)
+        self.fed += n
+        return out
+
+    def _feed_normal(self, text, pos, out):
+        if self.line_start:
+            stripped = len(text) - len(text[pos:].lstrip())
+            if stripped > pos:
+                for ch in text[pos:stripped]:
+                    if ch == '\n':
+                        self._newline()
+                    else:
+                        self.pending_ws += ch
+                pos = stripped
+                if pos >= len(text):
+                    return pos
+            if text[pos] == '{':
+                self.indent = self.pending_ws[self.line_ws_start:]
+                self.pending_ws = self.pending_ws[:self.line_ws_start]
+                self.mode = 'bare'
+                self.whole = not (self.emitted or self.calls)
+                self.buf = ''
+                self._reset_json()
+                return pos
+        m = self.NORMAL_SPECIALS.search(text, pos)
+        end = m.start() if m else len(text)
+        if end > pos:
+            self._text(out, text[pos:end])
+        if not m:
+            return end
+        if text[end] == '\n':
+            self._newline()
+            return end + 1
+        self.mode = 'tag'
+        self.buf = '<'
+        return end + 1
+
+    def _feed_tag(self, text, pos, out):
+        while pos < len(text) and len(self.buf) < len(self.tag_open):
+            if text[pos] != self.tag_open[len(self.buf)]:
+                # Not a tag after all: release what we held and rescan from here
+                self.mode = 'normal'
+                self._text(out, self.buf)
+                self.buf = ''
+                return pos
+            self.buf += text[pos]
+            pos += 1
+        if self.buf == self.tag_open:
+            self.mode = 'tools'
+        return pos
+
+    def _feed_tools(self, text, pos, out):
+        search_from = max(len(self.tag_open), len(self.buf) - len(self.tag_close) + 1)
+        self.buf += text[pos:]
+        end = self.buf.find(self.tag_close, search_from)
+        if end < 0:
+            return len(text)
+        block_end = end + len(self.tag_close)
+        rest = self.buf[block_end:]
+        block = self.buf[:block_end]
+        self.buf = ''
+        self.mode = 'normal'
+        calls = [c for c in map(parse_single_tool_call, block[len(self.tag_open):end].strip().split('\n')) if c]
+        if calls:
+            for call in calls:
+                self._call(out, call, 'tools_tag', self.base + len(text) - len(rest))
+            # The rest of the line is not a line start, as in the batch pass
+            self.line_start = False
+        else:
+            self._text(out, block)
+        # Hand the text after </tools> back to the caller's loop
+        return len(text) - len(rest)
+
+    def _feed_bare(self, text, pos, out):
+        n = len(text)
+        while pos < n:
+            if self.mode == 'tail':
+                ch = text[pos]
+                if ch == '\n' and self.whole and self.saw_newline and self.first_key != 'name':
+                    # Only a call if nothing follows it: decided by finish()
+                    self.buf += ch
+                    pos += 1
+                    continue
+                if ch == '\n':
+                    # A call's newline goes with it; otherwise normal mode handles it
+                    return pos + 1 if self._finish_bare(out, self.base + pos) else pos
+                if not ch.isspace():
+                    self._abort_bare(out)
+                    return pos
+                self.buf += ch
+                pos += 1
+                continue
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                    self.buf += text[pos]
+                    pos += 1
+                    continue
+                m = self.STRING_SPECIALS.search(text, pos)
+                end = m.start() if m else n
+                self.buf += text[pos:end]
+                pos = end
+                if not m:
+                    return pos
+                ch = text[pos]
+                if ch == '\n':
+                    # Raw newline inside a JSON string: not a tool call
+                    self._abort_bare(out)
+                    return pos
+                self.buf += ch
+                pos += 1
+                if ch == '\\':
+                    self.escape = True
+                else:
+                    self.in_string = False
+                    if self.depth == 1 and self.first_key is None:
+                        self.first_key = self.buf[self.key_start:-1]
+                        if self.first_key != 'name' and self.saw_newline and not self.whole:
+                            self._abort_bare(out)
+                            return pos
+                continue
 
-            if tool_calls or not content.strip():
+            if self.depth == 1 and self.key_start is None:
+                ch = text[pos]
+                if ch.isspace():
+                    self.saw_newline = self.saw_newline or ch == '\n'
+                    self.buf += ch
+                    pos += 1
+                    continue
+                if ch not in '"}':
+                    # '{' followed by something that can't start a JSON key (code block etc.)
+                    self._abort_bare(out)
+                    return pos
+            m = self.JSON_SPECIALS.search(text, pos)
+            end = m.start() if m else n
+            self.buf += text[pos:end]
+            pos = end
+            if not m:
+                return pos
+            ch = text[pos]
+            if ch == '\n':
+                if self.first_key is not None and self.first_key != 'name' and not self.whole:
+                    self._abort_bare(out)
+                    return pos
+                self.saw_newline = True
+                self.buf += ch
+                pos += 1
                 continue
+            self.buf += ch
+            pos += 1
+            if ch == '"':
+                self.in_string = True
+                if self.depth == 1 and self.key_start is None:
+                    self.key_start = len(self.buf)
+            elif ch == '{':
+                self.depth += 1
+            elif ch == '}':
+                self.depth -= 1
+                if self.depth == 0:
+                    self.mode = 'tail'
+        return pos
 
-            extracted_calls = []
-
-            # Try <tools> tag extraction first
-            matches = TOOLS_REGEX.findall(content)
-            if matches:
-                for match in matches:
-                    for line in match.strip().split('\n'):
-                        call = parse_single_tool_call(line)
-                        if call:
-                            extracted_calls.append(call)
-
-            # Try bare JSON extraction - single object first
-            if not extracted_calls:
-                stripped = content.strip()
-                call = parse_single_tool_call(stripped)
-                if call:
-                    extracted_calls.append(call)
-
-            # NEW in v2: Try multi-line JSON extraction
-            # Model sometimes outputs multiple tool calls on separate lines
-            if not extracted_calls:
-                lines = content.strip().split('\n')
-                for line in lines:
-                    call = parse_single_tool_call(line)
-                    if call:
-                        extracted_calls.append(call)
+    def _abort_bare(self, out):
+        """Candidate turned out to be ordinary text: release it verbatim."""
+        held, self.buf = self.indent + self.buf, ''
+        self.indent = ''
+        self.mode = 'normal'
+        if held.strip():
+            self._emit(out, held.rstrip())
+            self.pending_ws = held[len(held.rstrip()):]
+            # A whole-content candidate may have held the following newlines too
+            self.line_ws_start = self.pending_ws.rfind('\n') + 1
+            self.line_start = self.line_ws_start > 0
+            if not self.line_start:
+                self.line_ws_start = len(self.pending_ws)
+        else:
+            self.pending_ws += held
 
-            if extracted_calls:
-                logger.info(f'Extracted {len(extracted_calls)} tool call(s) from content')
-                # Clean the content - remove extracted JSON
-                cleaned = TOOLS_REGEX.sub('', content).strip()
-                # If content is just JSON, clear it
-                remaining_lines = []
-                for line in cleaned.split('\n'):
-                    if not parse_single_tool_call(line):
-                        remaining_lines.append(line)
-                cleaned = '\n'.join(remaining_lines).strip()
-                
-                msg['content'] = cleaned if cleaned else None
-                msg['tool_calls'] = extracted_calls
-                choice['finish_reason'] = 'tool_calls'
-    except Exception as e:
-        logger.error(f'Error in post-processing: {e}')
+    def _finish_bare(self, out, end):
+        """Decide a closed bare candidate at end of line. Returns True if it was a call."""
+        call = parse_single_tool_call(self.buf)
+        if call:
+            # Drop the whole line, including its newline
+            self.buf = ''
+            self.indent = ''
+            self.mode = 'normal'
+            self.line_ws_start = len(self.pending_ws)
+            self.line_start = True
+            self._call(out, call, 'multiline_json' if self.saw_newline else 'bare_json', end)
+            return True
+        self._abort_bare(out)
+        return False
+
+    def release(self):
+        """Give up scanning (e.g. upstream sent native tool_calls): return
+        everything still held back as plain text."""
+        held = self.pending_ws + self.indent + self.buf
+        self.pending_ws = self.indent = self.buf = ''
+        self.mode = 'normal'
+        return held
 
+    def finish(self):
+        """End of content: resolve anything still held. Safe to call twice."""
+        if self.finished:
+            return []
+        out = []
+        if self.mode == 'tag':
+            self.mode = 'normal'
+            self._text(out, self.buf)
+        elif self.mode == 'tools':
+            # Unclosed <tools>: the batch pass treats it as plain lines
+            held, self.buf = self.buf, ''
+            self.mode = 'normal'
+            self._text(out, self.tag_open)
+            self.fed -= len(held) - len(self.tag_open)     # fed again below
+            out.extend(self.feed(held[len(self.tag_open):]))
+            out.extend(self.finish())
+            self.finished = True
+            return out
+        elif self.mode == 'tail':
+            self._finish_bare(out, self.fed)
+        elif self.mode == 'bare':
+            self._abort_bare(out)
+        self.buf = ''
+        if not self.calls and self.pending_ws:
+            out.append(('text', self.pending_ws))
+        self.pending_ws = ''
+        self.finished = True
+        return out
 
 
 def convert_to_sse_stream(resp_json):
@@ -226,7 +2414,7 @@ def convert_to_sse_stream(resp_json):
                     "finish_reason": None
                 }]
             }
-            yield f"data: {json.dumps(first_chunk)}\n\n"
+            yield sse_event(first_chunk)
 
             # Content chunks
             if content_text:
@@ -242,7 +2430,7 @@ def convert_to_sse_stream(resp_json):
                         "finish_reason": None
                     }]
                 }
-                yield f"data: {json.dumps(content_chunk)}\n\n"
+                yield sse_event(content_chunk)
 
             # Tool call chunks
             if tool_calls:
@@ -269,7 +2457,7 @@ def convert_to_sse_stream(resp_json):
                             "finish_reason": None
                         }]
                     }
-                    yield f"data: {json.dumps(tc_chunk)}\n\n"
+                    yield sse_event(tc_chunk)
 
             # Finish chunk
             finish_chunk = {
@@ -284,84 +2472,1844 @@ def convert_to_sse_stream(resp_json):
                     "finish_reason": finish_reason
                 }]
             }
-            yield f"data: {json.dumps(finish_chunk)}\n\n"
+            yield sse_event(finish_chunk)
+
+        # Usage chunk
+        usage = resp_json.get("usage")
+        if usage:
+            usage_chunk = {
+                "id": resp_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [],
+                "usage": usage
+            }
+            yield sse_event(usage_chunk)
+
+        yield b"data: [DONE]\n\n"
+
+    return generate()
+
+
+def clean_chunk_for_openclaw(chunk):
+    """Streaming counterpart of clean_response_for_openclaw for one SSE chunk.
+    Returns False when nothing OpenClaw cares about is left (e.g. a pure
+    reasoning delta), so the caller can drop the chunk."""
+    strip = active_config().strip_fields
+    for field in strip['response']:
+        chunk.pop(field, None)
+    usage = chunk.get("usage")
+    if usage:
+        for field in strip['usage']:
+            usage.pop(field, None)
+    keep = bool(usage) or not chunk.get("choices")
+    for choice in chunk.get("choices", []):
+        for field in strip['choice']:
+            choice.pop(field, None)
+        delta = choice.get("delta", {})
+        for field in strip['message']:
+            delta.pop(field, None)
+        if not delta.get("tool_calls"):
+            delta.pop("tool_calls", None)
+        if delta or choice.get("finish_reason") or choice.get("logprobs"):
+            keep = True
+    return keep
+
+
+class SSEDecoder:
+    """Splits an upstream byte stream into SSE data payloads."""
+
+    def __init__(self):
+        self.buf = b''
+
+    def feed(self, chunk):
+        self.buf += chunk
+        events = []
+        while True:
+            end = self.buf.find(b'\n\n')
+            if end < 0:
+                if b'\r\n' not in self.buf:
+                    return events
+                self.buf = self.buf.replace(b'\r\n', b'\n')
+                continue
+            event, self.buf = self.buf[:end], self.buf[end + 2:]
+            data = [line[5:].lstrip() for line in event.split(b'\n') if line.startswith(b'data:')]
+            if data:
+                events.append(b'\n'.join(data).decode('utf-8'))
+
+    def close(self):
+        tail, self.buf = self.buf.strip(), b''
+        return [tail[5:].lstrip().decode('utf-8')] if tail.startswith(b'data:') else []
+
+
+def tee_chunks(chunks, tap):
+    for chunk in chunks:
+        tap.append(chunk)
+        yield chunk
+
+
+async def tee_chunks_async(chunks, tap):
+    async for chunk in chunks:
+        tap.append(chunk)
+        yield chunk
+
+
+def iter_sse_data(chunks):
+    decoder = SSEDecoder()
+    info = request_log.get() or RequestLog()
+    for chunk in chunks:
+        events = decoder.feed(chunk)
+        info.tokens += len(events)
+        yield from events
+    yield from decoder.close()
+
+
+async def aiter_sse_data(chunks):
+    decoder = SSEDecoder()
+    info = request_log.get() or RequestLog()
+    async for chunk in chunks:
+        events = decoder.feed(chunk)
+        info.tokens += len(events)
+        for data in events:
+            yield data
+    for data in decoder.close():
+        yield data
+
+
+class StreamingToolExtractor:
+    """Re-frames an upstream chat.completion.chunk stream for OpenClaw:
+    content deltas run through a ToolCallStreamScanner so tool calls written
+    as text come out as proper tool_calls deltas, everything else is cleaned
+    and passed on as soon as it arrives.
+
+    process(data) takes one SSE data payload and returns the SSE frames to
+    send; finish() flushes anything still held if upstream ended early."""
+
+    def __init__(self, body=None):
+        self.scanners = {}       # choice index -> ToolCallStreamScanner
+        self.native = set()      # choice indexes where vLLM sent real tool_calls
+        self.envelope = None     # id/object/created/model of the upstream stream
+        self.call_counts = {}    # choice index -> tool_calls deltas emitted so far
+        self.extracted = 0
+        self.usage = None
+        self.body = body
+        self.watcher = CutoffWatcher() if cutoff_enabled(body) else None
+        self.degeneration = DegenerationCheck() if degeneration_enabled(body) else None
+        self.tokens = 0          # content deltas seen, for the cutoff's tokens-saved estimate
+        self.cut = None          # why the stream was cut short (see CutoffWatcher, DegenerationDetector)
+        self.held = []           # frames that might end in the start of a blocklisted token
+
+    def _scan(self, index, events, final=False):
+        """Scanner events of one choice, through the cutoff watcher (choice 0 only)."""
+        if self.watcher is None or index != 0:
+            return events
+        events = self.watcher.filter(events)
+        if self.watcher.reason:
+            self.cut = self.watcher.reason
+            observe_cutoff(self.cut, self.tokens, self.body)
+        elif final:
+            events += self.watcher.flush()
+        return events
+
+    def _degenerated(self):
+        """End the stream where choice 0 degenerated; its held text is dropped."""
+        self.cut = self.degeneration.reason
+        observe_degeneration(self.cut, self.degeneration.tokens, self.body)
+        done = self.call_counts.get(0) or 0 in self.native
+        return [self._frame(0, {}, 'tool_calls' if done else 'degenerate'), b"data: [DONE]\n\n"]
+
+    def _frame(self, index, delta, finish_reason=None):
+        chunk = dict(self.envelope or {'object': 'chat.completion.chunk'})
+        chunk['choices'] = [{
+            'index': index,
+            'delta': delta,
+            'logprobs': None,
+            'finish_reason': finish_reason
+        }]
+        return sse_event(chunk)
+
+    def _frames(self, index, events):
+        frames = []
+        for kind, value in events:
+            if kind == 'text':
+                frames.append(self._frame(index, {'content': value}))
+            else:
+                frames.append(self._frame(index, {'tool_calls': [{
+                    'index': self.call_counts.get(index, 0),
+                    'id': value['id'],
+                    'type': 'function',
+                    'function': value['function']
+                }]}))
+                self.call_counts[index] = self.call_counts.get(index, 0) + 1
+                self.extracted += 1
+        return frames
+
+    def process(self, data):
+        frames = self._process(data)
+        if self.degeneration is None:
+            return frames
+        if self.degeneration.field:
+            self.held = []      # degenerate: the held text goes with the rest
+            return frames
+        if self.degeneration.pending and frames[-1:] != [b"data: [DONE]\n\n"]:
+            self.held += frames
+            return []
+        frames, self.held = self.held + frames, []
+        return frames
+
+    def _process(self, data):
+        if data.strip() == '[DONE]':
+            return self.finish() + [b"data: [DONE]\n\n"]
+        try:
+            chunk = json_loads(data)
+        except ValueError:
+            return [f"data: {data}\n\n".encode()]
+        if not isinstance(chunk, dict) or 'choices' not in chunk:
+            return [f"data: {data}\n\n".encode()]
+        if self.envelope is None:
+            self.envelope = {k: chunk[k] for k in ('id', 'object', 'created', 'model') if k in chunk}
+        if chunk.get('usage'):
+            self.usage = chunk['usage']
+        # After a call the cutoff watcher owns leaked tokens (it cuts more precisely)
+        if self.degeneration is not None and not self.degeneration.feed(
+                choice_delta(chunk), blocklist=not (self.watcher and self.watcher.seen)):
+            return self._degenerated()
+        if not clean_chunk_for_openclaw(chunk):
+            return []
+
+        frames = []
+        passthrough = []
+        for choice in chunk['choices']:
+            index = choice.get('index', 0)
+            delta = choice.get('delta', {})
+            scanner = self.scanners.setdefault(index, ToolCallStreamScanner())
+
+            if delta.get('tool_calls') and index not in self.native:
+                # vLLM parsed the calls itself: stop scanning this choice,
+                # same as extract_tools_from_content skipping native tool_calls
+                self.native.add(index)
+                held = scanner.release()
+                if held:
+                    frames.append(self._frame(index, {'content': held}))
+            if index in self.native:
+                for tc in delta.get('tool_calls', []):
+                    tc['index'] = tc.get('index', 0) + self.call_counts.get(index, 0)
+                passthrough.append(choice)
+                continue
+
+            content = delta.pop('content', None)
+            if content:
+                self.tokens += 1
+                frames.extend(self._frames(index, self._scan(index, scanner.feed(content))))
+                if self.cut:
+                    # The turn is over: end the stream here, the caller closes the upstream
+                    frames.append(self._frame(index, {}, 'tool_calls'))
+                    frames.append(b"data: [DONE]\n\n")
+                    return frames
+            elif content is not None and delta:
+                delta['content'] = content     # keep the role chunk's "" content
+            if choice.get('finish_reason'):
+                frames.extend(self._frames(index, self._scan(index, scanner.finish(), final=True)))
+                if self.call_counts.get(index):
+                    choice['finish_reason'] = 'tool_calls'
+            if delta or choice.get('finish_reason') or choice.get('logprobs'):
+                passthrough.append(choice)
+
+        if passthrough or not chunk['choices']:
+            chunk['choices'] = passthrough
+            frames.append(sse_event(chunk))
+        return frames
+
+    def finish(self):
+        """Flush every choice whose stream ended without a finish_reason."""
+        frames, self.held = self.held, []
+        if self.cut:
+            return frames
+        for index, scanner in self.scanners.items():
+            if index not in self.native:
+                frames.extend(self._frames(index, self._scan(index, scanner.finish(), final=True)))
+        return frames
+
+    def observe(self, seconds):
+        """Record extraction results and usage in the metrics once the stream is done."""
+        for index, scanner in self.scanners.items():
+            if index in self.native:
+                observe_extraction('stream', 'native')
+            else:
+                observe_extraction('stream', 'hit' if scanner.calls else 'miss', scanner.strategies)
+        observe_usage(self.usage, seconds)
+
+
+def configure_cutoff_tokens(tokens):
+    global CUTOFF_TOKENS, cutoff_token_regex, cutoff_token_tail, cutoff_token_starts, cutoff_token_prefixes
+    CUTOFF_TOKENS = [t for t in tokens if t]
+    cutoff_token_regex = re.compile('|'.join(map(re.escape, CUTOFF_TOKENS))) if CUTOFF_TOKENS else None
+    cutoff_token_tail = max(map(len, CUTOFF_TOKENS), default=1) - 1   # chars a token can start before a delta
+    cutoff_token_starts = {t[0] for t in CUTOFF_TOKENS}
+    cutoff_token_prefixes = {t[:i] for t in CUTOFF_TOKENS for i in range(1, len(t) + 1)}
+
+
+configure_cutoff_tokens(CUTOFF_TOKENS)
+
+
+def partial_token_suffix(text):
+    """Length of the longest end of text that could be the start of a CUTOFF_TOKENS entry."""
+    for start in range(max(0, len(text) - cutoff_token_tail - 1), len(text)):
+        if text[start] in cutoff_token_starts and text[start:] in cutoff_token_prefixes:
+            return len(text) - start
+    return 0
+
+
+def cutoff_enabled(body):
+    """Early cutoff watches choice 0, so only single-choice tool requests qualify."""
+    return EARLY_CUTOFF and bool(has_tools(body)) and body.get('n') in (None, 1)
+
+
+def generation_budget(body, info=None):
+    """Tokens vLLM was allowed to generate for body: max_tokens, or what the
+    context window leaves after the prompt estimate. None if unknown."""
+    for field in ('max_completion_tokens', 'max_tokens'):
+        if isinstance(body.get(field), int):
+            return body[field]
+    if info is None:
+        info = request_log.get()
+    if context_guard and info is not None and info.estimate is not None:
+        window = context_guard.window_for(body.get('model'))
+        if window:
+            return max(0, window - info.estimate)
+    return None
+
+
+def observe_cutoff(reason, generated, body):
+    metrics.inc('proxy_early_cutoffs_total', reason=reason)
+    budget = generation_budget(body)
+    if budget:
+        metrics.inc('proxy_cutoff_tokens_saved_total', max(0, budget - generated))
+    logger.info(f'Early cutoff ({reason}) after {generated} tokens')
+
+
+class CutoffWatcher:
+    """Watches the scanner events of one choice for the end of a text-mode
+    tool-call turn: a complete call followed by a repeat of a call already
+    made, or by a leaked chat-template token (CUTOFF_TOKENS). filter()
+    returns the events to pass on; once `reason` is set ('repeat' or 'junk')
+    the rest of the generation is dropped. After a call, text ending in
+    what could be the start of such a token (and whitespace before it) is
+    held until it is decided."""
+
+    def __init__(self):
+        self.seen = set()        # fingerprints of the calls made
+        self.held = ''
+        self.reason = None
+
+    def filter(self, events):
+        kept = []
+        for kind, value in events:
+            if self.reason:
+                break
+            if kind == 'call':
+                fingerprint = tool_call_fingerprint(value)
+                if fingerprint in self.seen:
+                    self.reason = 'repeat'
+                    break
+                self.seen.add(fingerprint)
+                kept.extend(self.flush())
+                kept.append((kind, value))
+                continue
+            if not self.seen or cutoff_token_regex is None:
+                kept.append((kind, value))
+                continue
+            text = self.held + value
+            m = cutoff_token_regex.search(text)
+            if m:
+                self.reason = 'junk'
+                text = text[:m.start()].rstrip()
+                self.held = ''
+                if text:
+                    kept.append(('text', text))
+                break
+            # Whitespace is held too: dropped with the junk, as the batch rules drop it after a call
+            keep = len(text[:len(text) - partial_token_suffix(text)].rstrip())
+            if keep:
+                kept.append(('text', text[:keep]))
+            self.held = text[keep:]
+        return kept
+
+    def flush(self):
+        held, self.held = self.held, ''
+        return [('text', held)] if held and not self.reason else []
+
+
+def degeneration_enabled(body):
+    """The degeneration check watches choice 0, so only single-choice requests qualify."""
+    return DEGENERATION_CHECK and bool(body) and body.get('n') in (None, 1)
+
+
+def observe_degeneration(reason, generated, body):
+    metrics.inc('proxy_degenerations_total', reason=reason)
+    budget = generation_budget(body)
+    if budget:
+        metrics.inc('proxy_degeneration_tokens_saved_total', max(0, budget - generated))
+    logger.warning(f'Degenerate generation ({reason}) stopped after {generated} tokens')
+
+
+class DegenerationDetector:
+    """Scores one stream of generated text for degeneration, a delta (about
+    one token) at a time. feed() returns False once `reason` is set:
+    'repetition' when DEGENERATION_THRESHOLD of the last DEGENERATION_WINDOW
+    n-grams of DEGENERATION_NGRAM tokens already occurred in the window, or
+    'blocklist' when a CUTOFF_TOKENS entry appears where the model would emit
+    a control token, outside a code span and outside braces (a tool call or
+    its arguments written as text): quoting one is fine. `keep` is then how
+    many chars of the text fed are worth keeping: up to where the first
+    repeated n-gram in the window (the second copy of the loop) or the token
+    began.
+
+    The work per token is constant: each n-gram's hash is rolled from the
+    previous one (Rabin-Karp), occurrences are counted in a dict as n-grams
+    enter and leave the window, and the blocklist is searched only in the new
+    text plus the few chars before it a token could have started in, and only
+    backticks, braces, quotes and newlines move the code/JSON state. `pending`
+    says the text ends in what could be the start of one."""
+
+    MOD = (1 << 61) - 1
+    BASE = 1000003
+    # What moves the code span / JSON state: outside JSON strings, and in them (an escape may be cut
+    # off by the end of a delta)
+    CONTEXT_SPECIALS = re.compile(r'`+|[{}"\n]')
+    STRING_SPECIALS = re.compile(r'\\.?|"', re.DOTALL)
+
+    def __init__(self):
+        self.n = DEGENERATION_NGRAM
+        self.window = DEGENERATION_WINDOW
+        self.limit = math.ceil(DEGENERATION_THRESHOLD * DEGENERATION_WINDOW)
+        self.drop = pow(self.BASE, self.n - 1, self.MOD)   # weight of the token leaving the n-gram
+        self.gram = collections.deque()      # (token hash, start offset) of the last n tokens
+        self.hash = 0
+        self.counts = {}                     # n-gram hash -> occurrences in the window
+        self.recent = collections.deque()    # (n-gram hash, repeated, start offset), oldest first
+        self.repeats = 0
+        self.length = 0                      # chars fed
+        self.tail = ''
+        self.pending = False
+        self.reason = None
+        self.keep = None
+        self.ticks = 0                       # backticks that opened the code span we are in (0 = none)
+        self.run = 0                         # backticks ending the text so far, not yet applied
+        self.depth = 0                       # open braces outside code and JSON strings
+        self.in_string = False               # in a JSON string inside braces
+        self.escape = False                  # the text so far ends in a backslash in that string
+
+    @property
+    def quoted(self):
+        return bool(self.ticks or self.depth)
+
+    def feed(self, text, blocklist=True):
+        start, self.length = self.length, self.length + len(text)
+        self.pending = False
+        if cutoff_token_regex is not None:
+            scan = self.tail + text
+            done = 0
+            for m in cutoff_token_regex.finditer(scan) if blocklist else ():
+                end = m.end() - len(self.tail)
+                if end <= 0:
+                    continue     # judged with the text before
+                # Tokens hold no backticks, braces or quotes: the state where one ends is where it began
+                self._track(text, done, end)
+                done = end
+                if not self.quoted:
+                    self.reason, self.keep = 'blocklist', start - len(self.tail) + m.start()
+                    return False
+            self._track(text, done, len(text))
+            self.tail = scan[-cutoff_token_tail:] if cutoff_token_tail else ''
+            self.pending = (blocklist and not self.quoted and not cutoff_token_starts.isdisjoint(self.tail)
+                            and partial_token_suffix(self.tail) > 0)
+
+        token = hash(text) % self.MOD
+        if len(self.gram) == self.n:
+            self.hash = (self.hash - self.gram.popleft()[0] * self.drop) % self.MOD
+        self.hash = (self.hash * self.BASE + token) % self.MOD
+        self.gram.append((token, start))
+        if len(self.gram) < self.n:
+            return True
+        repeated = self.hash in self.counts
+        self.counts[self.hash] = self.counts.get(self.hash, 0) + 1
+        self.recent.append((self.hash, repeated, self.gram[0][1]))
+        self.repeats += repeated
+        if len(self.recent) > self.window:
+            old, old_repeated, _ = self.recent.popleft()
+            self.repeats -= old_repeated
+            if self.counts[old] == 1:
+                del self.counts[old]
+            else:
+                self.counts[old] -= 1
+        if self.repeats >= self.limit and len(self.recent) == self.window:
+            self.reason = 'repetition'
+            self.keep = next(offset for _, was_repeated, offset in self.recent if was_repeated)
+            return False
+        return True
+
+    def _track(self, text, pos, end):
+        """Move the code span / JSON state over text[pos:end]."""
+        if self.escape and pos < end:
+            self.escape, pos = False, pos + 1
+        if self.run and pos < end and text[pos] != '`':
+            self._ticks(self.run)
+        while True:
+            m = (self.STRING_SPECIALS if self.in_string else self.CONTEXT_SPECIALS).search(text, pos, end)
+            if not m:
+                return
+            c = m.group()
+            if self.in_string:
+                if c == '"':
+                    self.in_string = False
+                elif len(c) == 1:
+                    self.escape = True       # the escaped char comes with the next delta
+            elif c[0] == '`':
+                run = len(c) + (self.run if m.start() == pos else 0)
+                self.run = 0
+                if m.end() == end:
+                    self.run = run           # may go on in the next delta
+                else:
+                    self._ticks(run)
+            elif self.ticks:
+                if c == '\n' and self.ticks < 3:
+                    self.ticks = 0           # an inline span left open ends with its line
+            elif c == '{':
+                self.depth += 1
+            elif c == '}':
+                self.depth = max(0, self.depth - 1)
+            elif c == '"' and self.depth:
+                self.in_string = True
+            pos = m.end()
+
+    def _ticks(self, run):
+        self.run = 0
+        if not self.ticks:
+            self.ticks = run
+        elif run == self.ticks:
+            self.ticks = 0
+
+
+class DegenerationCheck:
+    """A DegenerationDetector per text field of choice 0 (content and the
+    reasoning fields). feed() takes the choice's delta and returns False once
+    one of them trips; `field` is then the one that did."""
+
+    FIELDS = ('reasoning_content', 'reasoning', 'content')
+
+    def __init__(self):
+        self.detectors = {}
+        self.field = None
+        self.tokens = 0          # deltas with text, for the tokens-saved estimate
+
+    @property
+    def reason(self):
+        return self.detectors[self.field].reason if self.field else None
+
+    @property
+    def keep(self):
+        return self.detectors[self.field].keep if self.field else None
+
+    @property
+    def pending(self):
+        """Whether text sent now could turn out to be the start of a blocklisted token."""
+        return any(detector.pending for detector in self.detectors.values())
+
+    def feed(self, delta, blocklist=True):
+        for field in self.FIELDS:
+            text = delta.get(field)
+            if not text:
+                continue
+            self.tokens += 1
+            detector = self.detectors.get(field)
+            if detector is None:
+                detector = self.detectors[field] = DegenerationDetector()
+            if not detector.feed(text, blocklist):
+                self.field = field
+                return False
+        return True
+
+
+class DegenerationStream:
+    """Relays a plain chat stream (stream_response) event by event while
+    choice 0 is checked for degeneration. feed() takes upstream bytes and
+    returns the SSE frames to send; once `cut` is set the last of them end
+    the stream (finish_reason 'degenerate', then [DONE]) and the caller
+    closes the upstream. Events that might end in the start of a
+    blocklisted token are held until the next one decides."""
+
+    def __init__(self, body):
+        self.body = body
+        self.decoder = SSEDecoder()
+        self.check = DegenerationCheck()
+        self.envelope = None
+        self.held = []
+        self.cut = None
+
+    def feed(self, chunk):
+        frames = []
+        for data in self.decoder.feed(chunk):
+            frames.extend(self._release(self._event(data)))
+            if self.cut:
+                break
+        return frames
+
+    def close(self):
+        frames = [frame for data in self.decoder.close() for frame in self._release(self._event(data))]
+        held, self.held = self.held, []
+        return frames + held
+
+    def _release(self, frames):
+        if self.cut:
+            self.held = []
+        elif self.check.pending:
+            self.held += frames
+            return []
+        elif self.held:
+            frames, self.held = self.held + frames, []
+        return frames
+
+    def _event(self, data):
+        try:
+            chunk = json_loads(data)
+        except ValueError:
+            chunk = None
+        if isinstance(chunk, dict):
+            if self.envelope is None:
+                self.envelope = {k: chunk[k] for k in ('id', 'object', 'created', 'model') if k in chunk}
+            if not self.check.feed(choice_delta(chunk)):
+                self.cut = self.check.reason
+                observe_degeneration(self.cut, self.check.tokens, self.body)
+                finish = dict(self.envelope, choices=[{'index': 0, 'delta': {}, 'logprobs': None,
+                                                       'finish_reason': 'degenerate'}])
+                return [sse_event(finish), b"data: [DONE]\n\n"]
+        return [b'data: ' + data.encode() + b'\n\n']
+
+
+def choice_delta(chunk, index=0):
+    for choice in chunk.get('choices') or []:
+        if choice.get('index', 0) == index:
+            return choice.get('delta') or {}
+    return {}
+
+
+def merge_tool_call_delta(calls, delta):
+    """Fold one streamed tool_calls delta into calls (index -> tool call)."""
+    call = calls.setdefault(delta.get('index', 0), {'id': None, 'type': 'function',
+                                                     'function': {'name': '', 'arguments': ''}})
+    if delta.get('id'):
+        call['id'] = delta['id']
+    fn = delta.get('function') or {}
+    if fn.get('name'):
+        call['function']['name'] = fn['name']
+    if fn.get('arguments'):
+        call['function']['arguments'] += fn['arguments']
+
+
+class StreamedCompletion:
+    """A non-streaming request that went to vLLM as a stream so it can be
+    cut short, rebuilt into the chat.completion vLLM would have returned.
+
+    feed() takes one SSE data payload and returns False once the turn is
+    over (see CutoffWatcher) or choice 0 degenerated (DegenerationDetector);
+    completion() then has choice 0's text cut where the junk, the repeated
+    call or the repetition began. Stands in for the upstream Response in the
+    non-streaming forwarders (status_code, content). An error event from vLLM
+    mid-stream becomes that error, with its code as the status, and
+    completion() raises ValueError so the forwarders relay it as they do a
+    non-200 answer."""
+
+    status_code = 200
+
+    def __init__(self, body):
+        self.body = body
+        self.envelope = {}
+        self.choices = {}        # index -> content parts, reasoning parts by key, tool calls, finish_reason, logprobs
+        self.error = None        # vLLM's error event, if the stream ended in one
+        self.usage = None
+        self.tokens = 0          # deltas seen, when vLLM sends no running usage
+        self.scanner = ToolCallStreamScanner()
+        self.watcher = CutoffWatcher() if cutoff_enabled(body) else None
+        self.degeneration = DegenerationCheck() if degeneration_enabled(body) else None
+        self.length = 0          # chars of choice 0's content so far
+        self.call_span = (0, 0)  # choice 0's content offsets of the delta that completed the last call
+        self.cut_at = None
+
+    @property
+    def reason(self):
+        if self.degeneration is not None and self.degeneration.reason:
+            return self.degeneration.reason
+        return self.watcher.reason if self.watcher is not None else None
+
+    def feed(self, data):
+        try:
+            chunk = json_loads(data)
+        except ValueError:
+            return True         # [DONE]
+        if not isinstance(chunk, dict):
+            return True
+        if chunk.get('object') == 'error' or isinstance(chunk.get('error'), dict):
+            self.error = chunk
+            code = (chunk['error'] if isinstance(chunk.get('error'), dict) else chunk).get('code')
+            self.status_code = code if isinstance(code, int) and 400 <= code < 600 else 500
+            logger.warning(f'vLLM stream ended in an error ({self.status_code})')
+            return False
+        if not self.envelope:
+            self.envelope = {k: chunk[k] for k in ('id', 'created', 'model') if k in chunk}
+        if chunk.get('usage'):
+            self.usage = chunk['usage']
+        for choice in chunk.get('choices') or []:
+            index = choice.get('index', 0)
+            state = self.choices.setdefault(index, ([], {}, {}, [None], []))
+            content_parts, reasoning, tool_calls, finish_reason, logprobs = state
+            delta = choice.get('delta') or {}
+            logprobs.extend((choice.get('logprobs') or {}).get('content') or [])
+            for key in ('reasoning_content', 'reasoning'):
+                if delta.get(key):
+                    reasoning.setdefault(key, []).append(delta[key])
+                    self.tokens += 1
+            for tc in delta.get('tool_calls') or []:
+                merge_tool_call_delta(tool_calls, tc)
+            if choice.get('finish_reason'):
+                finish_reason[0] = choice['finish_reason']
+            content = delta.get('content')
+            if content:
+                content_parts.append(content)
+                self.tokens += 1
+            if index == 0 and self.degeneration is not None and not self.degeneration.feed(
+                    delta, blocklist=not (self.watcher and self.watcher.seen)):
+                observe_degeneration(self.reason, self.generated(), self.body)
+                return False
+            if content and index == 0 and self.watcher is not None and not tool_calls and not self._watch(content):
+                observe_cutoff(self.reason, self.generated(), self.body)
+                return False
+        return True
+
+    def _watch(self, content):
+        start, self.length = self.length, self.length + len(content)
+        calls = len(self.watcher.seen)
+        self.watcher.filter(self.scanner.feed(content))
+        if self.watcher.reason == 'repeat':
+            # Right after the last call kept: the delta that closed it may hold the repeat's start
+            self.cut_at = self.scanner.call_ends[len(self.watcher.seen) - 1]
+        elif self.watcher.reason == 'junk':
+            m = cutoff_token_regex.search(''.join(self.choices[0][0]), self.call_span[0])
+            self.cut_at = m.start() if m else self.length
+        elif len(self.watcher.seen) > calls:
+            self.call_span = (start, self.length)
+        return self.watcher.reason is None
+
+    def generated(self):
+        return (self.usage or {}).get('completion_tokens') or self.tokens
+
+    def completion(self):
+        if self.error is not None:
+            raise ValueError('vLLM stream ended in an error')
+        choices = []
+        for index in sorted(self.choices):
+            content_parts, reasoning, tool_calls, finish_reason, logprobs = self.choices[index]
+            content = ''.join(content_parts)
+            full = len(content)
+            if index == 0 and self.cut_at is not None:
+                content = content[:self.cut_at].rstrip()
+            message = {'role': 'assistant', 'content': content or None}
+            for key, parts in reasoning.items():
+                message[key] = ''.join(parts)
+            message['tool_calls'] = [tool_calls[i] for i in sorted(tool_calls)]
+            choice = {'index': index, 'message': message, 'logprobs': None,
+                      'finish_reason': finish_reason[0] or 'stop'}
+            if index == 0 and self.degeneration is not None and self.degeneration.field:
+                # extract_tools_from_content turns this back into tool_calls if a call came first
+                field = self.degeneration.field
+                message[field] = (message[field] or '')[:self.degeneration.keep].rstrip() or None
+                choice['finish_reason'] = 'tool_calls' if tool_calls else 'degenerate'
+            if logprobs:
+                kept = len(message['content'] or '')
+                choice['logprobs'] = {'content': logprobs if kept >= full else kept_logprobs(logprobs, kept)}
+            choices.append(choice)
+        usage = self.usage
+        if self.reason and usage is None:
+            # Cut before vLLM's usage chunk: count what we saw
+            prompt = (request_log.get() or RequestLog()).estimate or 0
+            usage = {'prompt_tokens': prompt, 'completion_tokens': self.tokens, 'total_tokens': prompt + self.tokens}
+        return dict(self.envelope, object='chat.completion', choices=choices, usage=usage)
+
+    @property
+    def content(self):
+        if self.error is not None:
+            return json_dumps(self.error)
+        return json_dumps(self.completion())
+
+
+def kept_logprobs(entries, chars):
+    """The logprobs entries of the tokens that start within the first chars
+    characters of content that was cut."""
+    kept = []
+    for entry in entries:
+        if chars <= 0:
+            break
+        kept.append(entry)
+        chars -= len(entry.get('token') or '')
+    return kept
+
+
+def streamed_body(body):
+    """body as a stream with running usage, for StreamedCompletion."""
+    return dict(body, stream=True, stream_options={'include_usage': True, 'continuous_usage_stats': True})
+
+
+def completion_json(resp):
+    """The chat.completion from post_chat's result."""
+    if isinstance(resp, StreamedCompletion):
+        return resp.completion()
+    return json_loads(resp.content)
+
+
+class ContextGuard:
+    """Prompt-size check made before a chat request goes upstream, so an
+    overflowing history fails here instead of after shipping the whole body.
+
+    Each message's token count is memoized by a hash of its text, so a turn
+    only tokenizes the messages added since the previous one. With a
+    tokenizer (--tokenizer) counts are exact up to the chat template; without
+    one they come from CHARS_PER_TOKEN, which can be off either way, so the
+    guard only acts on the estimate less ESTIMATE_SLACK."""
+
+    def __init__(self, window, tokenizer=None):
+        self.window = window
+        self.windows = {}          # model id -> max_model_len reported by vLLM
+        self.tokenizer = tokenizer
+        self.counts = collections.OrderedDict()   # text hash -> tokens (LRU)
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def count(self, text):
+        if not text:
+            return 0
+        if self.tokenizer is None:
+            return int(len(text) / CHARS_PER_TOKEN)
+        data = text.encode('utf-8', 'surrogatepass')
+        key = hashlib.blake2b(data, digest_size=16).digest()
+        with self.lock:
+            n = self.counts.get(key)
+            if n is not None:
+                self.counts.move_to_end(key)
+                self.hits += 1
+                return n
+        try:
+            n = len(self.tokenizer.encode(text, add_special_tokens=False).ids)
+        except Exception:
+            n = int(len(text) / CHARS_PER_TOKEN)
+        with self.lock:
+            self.misses += 1
+            self.counts[key] = n
+            while len(self.counts) > TOKEN_CACHE_MAX:
+                self.counts.popitem(last=False)
+        return n
+
+    def estimate(self, body):
+        """Prompt tokens of a chat request: messages, tool schemas and framing."""
+        messages = [m for m in body['messages'] if isinstance(m, dict)]
+        n = sum(self.count(message_text(m)) for m in messages) + TOKENS_PER_MESSAGE * (len(messages) + 1)
+        if body.get('tools'):
+            n += self.count(json_dumps(body['tools']).decode())
+        return n
+
+    def window_for(self, model):
+        return self.window or self.windows.get(model) or max(self.windows.values(), default=0)
+
+    def apply(self, body):
+        """Estimate the prompt and clamp max_tokens/max_completion_tokens to
+        the room left. Returns (estimate, error body); the error is set when
+        the prompt alone is over the window."""
+        estimate = self.estimate(body)
+        window = self.window_for(body.get('model'))
+        if not window:
+            return estimate, None
+        # The least the prompt can be: a length estimate may overcount prose
+        floor = estimate if self.tokenizer is not None else int(estimate * (1 - ESTIMATE_SLACK))
+        if floor >= window:
+            logger.warning(f'Refusing request: prompt ~{estimate} tokens, context window {window}')
+            metrics.inc('proxy_context_guard_total', result='rejected')
+            return estimate, context_overflow_error(window, estimate)
+        room = window - floor - CONTEXT_MARGIN
+        if room < CONTEXT_MARGIN:
+            # Too close to call: vLLM decides with the client's own max_tokens
+            return estimate, None
+        for field in ('max_tokens', 'max_completion_tokens'):
+            requested = body.get(field)
+            if isinstance(requested, int) and requested > room:
+                logger.info(f'Clamping {field} {requested} -> {room} (prompt ~{estimate} of {window} tokens)')
+                body[field] = room
+                metrics.inc('proxy_context_guard_total', result='clamped')
+        return estimate, None
+
+    def fetch_windows(self):
+        for backend in router.backends:
+            try:
+                models = upstream.get(f'{backend.url}/v1/models', timeout=5).json().get('data') or []
+            except Exception:
+                continue
+            windows = {m.get('id'): m['max_model_len'] for m in models
+                       if isinstance(m, dict) and isinstance(m.get('max_model_len'), int)}
+            if windows:
+                self.windows = windows
+                return True
+        return False
+
+    def discover_loop(self, interval=10.0):
+        while not self.fetch_windows():
+            time.sleep(interval)
+        logger.info(f'Context windows from vLLM: {self.windows}')
+
+    def start(self):
+        """Learn max_model_len from vLLM in the background unless --context-window was given."""
+        if not self.window:
+            threading.Thread(target=self.discover_loop, daemon=True, name='context-window').start()
+
+
+def message_text(msg):
+    """The parts of a chat message the template turns into tokens."""
+    content = msg.get('content')
+    if isinstance(content, list):
+        content = ''.join(p.get('text') or '' for p in content if isinstance(p, dict))
+    parts = [content if isinstance(content, str) else '']
+    for tc in msg.get('tool_calls') or []:
+        fn = (tc.get('function') or {}) if isinstance(tc, dict) else {}
+        args = fn.get('arguments')
+        parts += [fn.get('name') or '', args if isinstance(args, str) else json_dumps(args).decode()]
+    return '\n'.join(parts)
+
+
+def context_overflow_error(window, estimate):
+    # Same shape and wording as vLLM's own 400, so clients handle it the same way
+    return json.dumps({
+        'object': 'error',
+        'message': (f"This model's maximum context length is {window} tokens. However, your request has "
+                    f"about {estimate} input tokens (estimated by the proxy). Please reduce the length "
+                    f"of the input messages."),
+        'type': 'BadRequestError',
+        'param': None,
+        'code': 400,
+    })
+
+
+def load_tokenizer(name):
+    """A tokenizers.Tokenizer from a tokenizer.json (or the model directory
+    holding it), or from a Hugging Face model id. None when unavailable."""
+    if tokenizers is None:
+        logger.warning('--tokenizer needs: pip3 install tokenizers (falling back to a length estimate)')
+        return None
+    try:
+        path = os.path.join(name, 'tokenizer.json') if os.path.isdir(name) else name
+        if os.path.exists(path):
+            return tokenizers.Tokenizer.from_file(path)
+        return tokenizers.Tokenizer.from_pretrained(name)
+    except Exception as e:
+        logger.warning(f'Could not load tokenizer {name}: {e} (falling back to a length estimate)')
+        return None
+
+
+context_guard = ContextGuard(CONTEXT_WINDOW)
+
+
+def check_context(body):
+    """(prompt token estimate, overflow error body) for a chat request."""
+    if not CONTEXT_GUARD or not isinstance(body, dict) or not isinstance(body.get('messages'), list):
+        return None, None
+    return context_guard.apply(body)
+
+
+def prepare_chat_body(body):
+    """Apply the request-side fixes shared by both engines.
+
+    Mutates body in place. Returns (loop_response, was_streaming, is_streaming);
+    loop_response is a ready-made stop message when check_tool_loop trips."""
+    # Check for tool call loop
+    if body and has_tools(body):
+        loop_response = check_tool_loop(body)
+        if loop_response:
+            return loop_response, body.get("stream", False), False
+    # Shrink stale tool results (opt-in, --compact-after / --compact-max-chars)
+    if body and isinstance(body.get('messages'), list):
+        saved = compact_tool_results(body['messages'])
+        if saved:
+            logger.info(f'Compacted tool results: ~{saved} prompt tokens saved')
+            source = client_body.get()
+            if source is not None:
+                source.touched.add('messages')
+
+    # Track if client originally requested streaming
+    was_streaming = body.get("stream", False) if body else False
+    # Force non-streaming when tools are present so post-processor can extract tool calls from text
+    if body and has_tools(body) and was_streaming and TOOL_STREAMING == 'rewrap':
+        logger.info("Forcing non-streaming for tool call post-processing (will re-wrap as SSE)")
+        body["stream"] = False
+        body.pop("stream_options", None)
+    is_streaming = body.get("stream", False) if body else False
+    # Always strip stream_options when stream is false (vLLM 0.14+ rejects this combo)
+    if body and not body.get("stream", False) and "stream_options" in body:
+        logger.info("Stripping stream_options from non-streaming request")
+        body.pop("stream_options", None)
+    return None, was_streaming, is_streaming
+
+
+def forward_headers(headers):
+    # 'connection' is hop-by-hop: a client's "close" must not kill our pooled upstream socket
+    return {k: v for k, v in headers if k.lower() not in ('host', 'content-length', 'connection')}
+
+
+def json_headers(headers):
+    """forward_headers for requests whose body we re-encode ourselves."""
+    headers = {k: v for k, v in forward_headers(headers).items() if k.lower() != 'content-type'}
+    headers['Content-Type'] = 'application/json'
+    return headers
+
+
+def fix_response(resp_json, body):
+    """Post-process an upstream chat completion in place."""
+    t = time.monotonic()
+    if body and has_tools(body):
+        extract_tools_from_content(resp_json)  # Only when tools present
+        t = stage('extract', t)
+    clean_response_for_openclaw(resp_json)
+    stage('clean', t)
+
+
+def encode_response(resp_json):
+    t = time.monotonic()
+    payload = json_dumps(resp_json)
+    stage('encode', t)
+    return payload
+
+
+def rewrap_frames(resp_json):
+    """convert_to_sse_stream, run to completion so its time is a stage of its own."""
+    t = time.monotonic()
+    frames = list(convert_to_sse_stream(resp_json))
+    stage('rewrap', t)
+    return frames
+
+
+def first_choice(resp_json):
+    choice = (resp_json.get('choices') or [{}])[0]
+    return choice, choice.get('message') or {}
+
+
+def log_response_summary(resp_json, status):
+    choice, message = first_choice(resp_json)
+    log_event('RESPONSE', lambda: {'c': str(message.get('content'))[:200], 'r': str(message.get('reasoning', ''))[:100],
+                                   'f': choice.get('finish_reason'), 's': status})
+
+
+def log_rewrap_summary(resp_json, status):
+    choice, message = first_choice(resp_json)
+    log_event('SSE-REWRAP', lambda: {'c': str(message.get('content'))[:200], 'tc': len(message.get('tool_calls') or []),
+                                     'f': choice.get('finish_reason'), 's': status})
+
+
+def log_stream_summary(extractor, status):
+    calls, native = extractor.extracted, bool(extractor.native)
+    log_event('STREAM-EXTRACT', lambda: {'tc': calls, 'native': native, 's': status})
+
+
+class ResponseCache:
+    """LRU + TTL cache of fixed, cleaned chat completions (JSON bytes),
+    capped by total payload size, with single-flight coalescing: concurrent
+    identical requests share one upstream call."""
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()   # key -> (expires_at, payload)
+        self.size = 0
+        self.lock = threading.Lock()
+        self.inflight = {}            # key -> threading.Event / asyncio.Future
+        self.hits = self.misses = self.coalesced = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, payload):
+        if len(payload) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.monotonic() + self.ttl, payload)
+            self.size += len(payload)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        _, payload = self.entries.pop(key)
+        self.size -= len(payload)
+
+    def get_or_fetch(self, key, fetch):
+        """Return (status, payload) from cache, from an identical request
+        already in flight, or by calling fetch() ourselves."""
+        payload = self.get(key)
+        if payload is not None:
+            return 200, payload
+        with self.lock:
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = threading.Event()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.wait(timeout=READ_TIMEOUT)
+            if getattr(flight, 'result', None):
+                return flight.result
+            return fetch()
+        try:
+            flight.result = fetch()
+            if flight.result[0] == 200:
+                self.put(key, flight.result[1])
+            return flight.result
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            flight.set()
+
+    async def get_or_fetch_async(self, key, fetch):
+        """get_or_fetch for the ASGI engine; fetch is a coroutine function."""
+        payload = self.get(key)
+        if payload is not None:
+            return 200, payload
+        flight = self.inflight.get(key)
+        if flight is not None:
+            self.coalesced += 1
+            result = await asyncio.shield(flight)
+            return result if result else await fetch()
+        self.misses += 1
+        flight = self.inflight[key] = asyncio.get_running_loop().create_future()
+        result = None
+        try:
+            result = await fetch()
+            if result[0] == 200:
+                self.put(key, result[1])
+            return result
+        finally:
+            # On failure the waiters get None and fetch for themselves
+            del self.inflight[key]
+            flight.set_result(result)
+
+
+response_cache = None
+
+
+def is_cacheable(body):
+    return bool(response_cache and body and body.get('temperature') == 0 and body.get('n', 1) == 1)
+
+
+def response_cache_key(body):
+    """Cache key for a deterministic chat request, None if it isn't cacheable.
+    Streaming flags are left out so a streaming and a non-streaming client
+    asking the same thing share one entry."""
+    if not is_cacheable(body):
+        return None
+    return stable_hash({k: v for k, v in body.items() if k not in ('stream', 'stream_options')})
+
+
+class CaptureRecord:
+    """One sampled chat exchange. The request path only stores references
+    (raw body bytes, chunk lists); decoding and encoding happen in the writer."""
+
+    def __init__(self, path, raw_body, headers):
+        self.id = uuid.uuid4().hex[:16]
+        self.ts = time.time()
+        self.started = time.monotonic()
+        self.path = path
+        self.request = raw_body
+        self.priority = headers.get('X-Priority')
+        self.path_type = None
+        self.backend = None
+        self.upstream_status = None
+        self.upstream = []        # vLLM's body: one chunk, or the SSE chunks as relayed
+        self.status = None
+        self.response = []       # what the client got
+        self.first_byte = None
+        self.finished = None
+
+    def sent(self, chunk):
+        if self.first_byte is None:
+            self.first_byte = time.monotonic()
+        self.response.append(chunk)
+
+    def tee(self, chunks):
+        try:
+            for chunk in chunks:
+                self.sent(chunk)
+                yield chunk
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+    async def tee_async(self, chunks):
+        try:
+            async for chunk in chunks:
+                self.sent(chunk)
+                yield chunk
+        finally:
+            if hasattr(chunks, 'aclose'):
+                await chunks.aclose()
+
+    def to_json(self):
+        timing = {'total': round(self.finished - self.started, 4)}
+        if self.first_byte is not None:
+            timing['ttfb'] = round(self.first_byte - self.started, 4)
+        return json_dumps({
+            'id': self.id, 'ts': self.ts, 'path': self.path, 'path_type': self.path_type,
+            'priority': self.priority, 'backend': self.backend,
+            'request': capture_text([self.request]),
+            'upstream_status': self.upstream_status,
+            'upstream': capture_text(self.upstream) if self.upstream_status is not None else None,
+            'status': self.status, 'response': capture_text(self.response),
+            'timing': timing,
+        })
+
+
+def capture_text(chunks):
+    return b''.join(c.encode() if isinstance(c, str) else c for c in chunks).decode('utf-8', 'replace')
+
+
+class TrafficCapture:
+    """Samples chat requests into capture-*.jsonl.gz files in a directory,
+    rotated at file_bytes (compressed) with only the newest `keep` kept.
+
+    submit() never blocks: records go on a bounded queue that a daemon
+    thread encodes, compresses and writes; if it falls behind, records are
+    dropped and counted instead of slowing requests down."""
+
+    FLUSH_INTERVAL = 5.0
+
+    def __init__(self, directory, sample, file_bytes, keep):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.sample = sample
+        self.file_bytes = file_bytes
+        self.keep = keep
+        self.queue = queue.Queue(CAPTURE_QUEUE)
+        self.lock = threading.Lock()
+        self.raw = self.file = None
+        self.sequence = 0
+        self.written = self.dropped = 0
+        threading.Thread(target=self.write_loop, daemon=True, name='capture-writer').start()
+
+    def start(self, path, raw_body, headers):
+        if self.sample < 1 and random.random() >= self.sample:
+            return None
+        return CaptureRecord(path, raw_body, headers)
+
+    def submit(self, record):
+        record.finished = time.monotonic()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def write_loop(self):
+        flushed = time.monotonic()
+        while True:
+            try:
+                record = self.queue.get(timeout=1.0)
+            except queue.Empty:
+                record = None
+            with self.lock:
+                try:
+                    if record is not None:
+                        self.write(record)
+                    # Flush when idle or every few seconds so the file can be read while we run
+                    if self.file and (record is None or time.monotonic() - flushed > self.FLUSH_INTERVAL):
+                        self.file.flush()
+                        flushed = time.monotonic()
+                except Exception as e:
+                    logger.error(f'Capture write error: {e}')
+
+    def write(self, record):
+        line = record.to_json() + b'\n'
+        if self.file is None or self.raw.tell() >= self.file_bytes:
+            self.rotate()
+        self.file.write(line)
+        self.written += 1
+
+    def rotate(self):
+        self.close_file()
+        self.sequence += 1
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        path = os.path.join(self.directory, f'capture-{stamp}-{os.getpid()}-{self.sequence:04d}.jsonl.gz')
+        self.raw = open(path, 'wb')
+        self.file = gzip.GzipFile(fileobj=self.raw, mode='wb', compresslevel=5)
+        if self.keep:
+            names = sorted((n for n in os.listdir(self.directory)
+                            if n.startswith('capture-') and n.endswith('.jsonl.gz')),
+                           key=lambda n: os.path.getmtime(os.path.join(self.directory, n)))
+            for name in names[:-self.keep]:
+                os.remove(os.path.join(self.directory, name))
+
+    def close_file(self):
+        if self.file:
+            self.file.close()
+            self.raw.close()
+            self.raw = self.file = None
+
+    def close(self):
+        """Write out what is queued and finish the gzip stream (at exit)."""
+        with self.lock:
+            while True:
+                try:
+                    self.write(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.close_file()
+
+
+traffic_capture = None
+# The sampled record of the chat request being served, if any. Set per request
+# in proxy(), read by the upstream calls to tee vLLM's reply into it.
+capture_record = contextvars.ContextVar('capture_record', default=None)
+
+
+def upstream_tap(resp):
+    """Chunk list to append vLLM's reply to, or None when not capturing."""
+    record = capture_record.get()
+    if record is None:
+        return None
+    record.upstream_status = resp.status_code
+    return record.upstream
+
+
+def capture_upstream(resp):
+    if isinstance(resp, StreamedCompletion):
+        return      # teed chunk by chunk as it was read
+    tap = upstream_tap(resp)
+    if tap is not None:
+        tap.append(resp.content)
+
+
+def capture_response(record, response):
+    """Tee the client's response body into record; it is queued once sent."""
+    if record is None:
+        return response
+    record.status = response.status_code
+    if response.is_streamed:
+        response.response = record.tee(response.response)
+    else:
+        record.sent(response.get_data())
+    response.call_on_close(lambda: traffic_capture.submit(record))
+    return response
 
-        # Usage chunk
-        usage = resp_json.get("usage")
-        if usage:
-            usage_chunk = {
-                "id": resp_id,
-                "object": "chat.completion.chunk",
-                "created": created,
-                "model": model,
-                "choices": [],
-                "usage": usage
-            }
-            yield f"data: {json.dumps(usage_chunk)}\n\n"
 
-        yield "data: [DONE]\n\n"
+def non_streaming_body(body):
+    body = dict(body, stream=False)
+    body.pop('stream_options', None)
+    return body
 
-    return generate()
+
+def cached_json_response(status, payload, was_streaming):
+    if status == 200 and was_streaming:
+        return Response(convert_to_sse_stream(json_loads(payload)), status=200, mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'Connection': 'keep-alive'})
+    return Response(payload, status=status, mimetype='application/json')
 
 
 @app.route('/v1/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS'])
 def proxy(path):
-    url = f'{VLLM_URL}/v1/{path}'
-
+    request_config.set(current_config)
+    info = RequestLog()
+    request_log.set(info)
+    upstream_call.current = None
     if request.method == 'OPTIONS':
         return Response('', status=204)
 
     if path not in ('chat/completions', 'responses'):
-        return forward_request(url)
+        started = request_started('passthrough')
+        backend = router.pick()
+        info.backend = backend.url
+        response = router.track(backend, forward_request(f'{backend.url}/v1/{path}'))
+        response.call_on_close(lambda: request_finished('passthrough', started, response.status_code))
+        return with_server_timing(response, info)
 
+    raw_body = request.get_data()
+    record = traffic_capture.start(path, raw_body, request.headers) if traffic_capture else None
+    capture_record.set(record)
     try:
-        body = request.get_json()
+        body = json_loads(raw_body)
     except Exception:
         body = None
+    info.body = body
+    client_body.set(ClientBody(raw_body, body) if isinstance(body, dict) else None)
+    t = stage('parse', info.started)
 
-    # Check for tool call loop
-    if body and has_tools(body):
-        loop_response = check_tool_loop(body)
-        if loop_response:
-            return Response(json.dumps(loop_response), status=200, mimetype='application/json')
+    loop_response, was_streaming, is_streaming = prepare_chat_body(body)
+    if loop_response:
+        if was_streaming:
+            return capture_response(record, Response(convert_to_sse_stream(loop_response),
+                                                     mimetype='text/event-stream'))
+        return capture_response(record, Response(json_dumps(loop_response), status=200,
+                                                 mimetype='application/json'))
+    estimate, overflow = check_context(body)
+    if overflow:
+        return capture_response(record, Response(overflow, status=400, mimetype='application/json',
+                                                 headers={'X-Prompt-Tokens-Estimate': str(estimate)}))
+    headers = json_headers(request.headers)
+    if prefix_warmer is not None and path == 'chat/completions':
+        prefix_warmer.observe(body)
+
+    path_type = chat_path_type(body, was_streaming, is_streaming)
+    started = request_started(path_type)
+    if record:
+        record.path_type = path_type
+    t = stage('prepare', t)
+    admitted = admission.acquire(request_priority(request.headers, body))
+    stage('queue', t)
+    if not admitted:
+        request_finished(path_type, started, 429)
+        return capture_response(record, Response(busy_error(), status=429, mimetype='application/json',
+                                                 headers={'Retry-After': str(admission.retry_after())}))
+    backend = router.pick(affinity_key(body))
+    info.backend, info.estimate = backend.url, estimate
+    if record:
+        record.backend = backend.url
+    url = f'{backend.url}/v1/{path}'
+    call = upstream_call.current = UpstreamCall(path_type)
+    # A cached fetch is shared with the requests coalesced onto it, so it is never cancelled
+    sock = request.environ.get('werkzeug.socket') if DISCONNECT_CANCEL and path_type != 'cache' else None
+    if sock is not None:
+        disconnect_watcher.watch(sock, call)
+    try:
+        response = router.track(backend, dispatch_chat(url, headers, body, path_type, was_streaming))
+    except BaseException:
+        # No response to hang the releases on: give the slot and the backend back now
+        if sock is not None:
+            disconnect_watcher.unwatch(sock)
+        router.release(backend)
+        admission.release(None)
+        request_finished(path_type, started, 500)
+        raise
+    if sock is not None:
+        response.call_on_close(lambda: disconnect_watcher.unwatch(sock))
+    response.call_on_close(lambda: admission.release(started))
+    response.call_on_close(lambda: request_finished(path_type, started, response.status_code))
+    if estimate is not None:
+        response.headers['X-Prompt-Tokens-Estimate'] = str(estimate)
+    return capture_response(record, with_server_timing(response, info))
 
-    # Track if client originally requested streaming
-    was_streaming = body.get("stream", False) if body else False
-    # Force non-streaming when tools are present so post-processor can extract tool calls from text
-    if body and has_tools(body) and was_streaming:
-        logger.info("Forcing non-streaming for tool call post-processing (will re-wrap as SSE)")
-        body["stream"] = False
-        body.pop("stream_options", None)
-    is_streaming = body.get("stream", False) if body else False
-    # Always strip stream_options when stream is false (vLLM 0.14+ rejects this combo)
-    if body and not body.get("stream", False) and "stream_options" in body:
-        logger.info("Stripping stream_options from non-streaming request")
-        body.pop("stream_options", None)
-    headers = {k: v for k, v in request.headers if k.lower() not in ('host', 'content-length')}
 
+def chat_path_type(body, was_streaming, is_streaming):
+    """Which dispatch_chat branch serves this request; also its metrics label."""
+    if is_cacheable(body):
+        # Served whole from the cache (or one shared upstream call), re-wrapped for streaming clients
+        return 'cache'
+    if is_streaming and has_tools(body):
+        # Extract tool calls from the stream as it arrives
+        return 'stream_extract'
     if is_streaming:
-        return stream_response(url, headers, body)
-    elif was_streaming and body and has_tools(body):
+        return 'stream'
+    if was_streaming and body and has_tools(body):
         # Client wanted streaming but we forced non-streaming for tool extraction
         # Get the response, fix it, then re-wrap as SSE
+        return 'rewrap_sse'
+    return 'fix'
+
+
+def dispatch_chat(url, headers, body, path_type, was_streaming):
+    if path_type == 'cache':
+        try:
+            status, payload = response_cache.get_or_fetch(
+                response_cache_key(body), lambda: fetch_fixed(url, headers, non_streaming_body(body)))
+        except Exception as e:
+            logger.error(f'Forward error: {e}')
+            return forward_error(e)
+        return cached_json_response(status, payload, was_streaming)
+    if path_type == 'stream_extract':
+        return stream_and_extract(url, headers, body)
+    if path_type == 'stream':
+        return stream_response(url, headers, body)
+    if path_type == 'rewrap_sse':
         return forward_fix_and_rewrap_sse(url, headers, body)
-    else:
-        return forward_with_body_and_fix(url, headers, body)
+    return forward_with_body_and_fix(url, headers, body)
+
+
+
+class RetryBudget:
+    """Caps retries and hedges at RETRY_BUDGET of the requests sent: each
+    request deposits that fraction of a token, each retry or hedge spends a
+    whole one. At most `reserve` tokens are banked, so a struggling vLLM gets
+    a bounded burst of retries rather than a multiple of its load."""
+
+    def __init__(self, ratio, reserve):
+        self.lock = threading.Lock()
+        self.ratio = ratio
+        self.reserve = reserve
+        self.balance = float(reserve)
+
+    def deposit(self):
+        with self.lock:
+            self.balance = min(self.reserve, self.balance + self.ratio)
+
+    def spend(self):
+        with self.lock:
+            if self.balance < 1:
+                metrics.inc('proxy_upstream_retries_denied_total')
+                return False
+            self.balance -= 1
+            return True
+
+
+class HedgeDelay:
+    """How long the first backend gets before a hedge is sent:
+    HEDGE_PERCENTILE of the last WINDOW non-streaming upstream latencies,
+    recomputed every RECOMPUTE samples. None until MIN_SAMPLES are in."""
+
+    WINDOW = 1000
+    MIN_SAMPLES = 20
+    RECOMPUTE = 50
+
+    def __init__(self):
+        self.samples = collections.deque(maxlen=self.WINDOW)
+        self.count = 0
+        self.delay = None
+
+    def observe(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        if len(self.samples) >= self.MIN_SAMPLES and (self.delay is None or self.count % self.RECOMPUTE == 0):
+            ordered = sorted(self.samples)
+            rank = min(len(ordered) - 1, int(len(ordered) * HEDGE_PERCENTILE / 100))
+            self.delay = max(HEDGE_MIN_DELAY, ordered[rank])
+
+
+retry_budget = RetryBudget(RETRY_BUDGET, RETRY_BUDGET_RESERVE)
+hedge_delay = HedgeDelay()
+
+
+def retry_allowed(attempt, reason):
+    if attempt >= RETRY_MAX or not retry_budget.spend():
+        return False
+    metrics.inc('proxy_upstream_retries_total', reason=reason)
+    return True
+
+
+def retry_delay(attempt):
+    return random.uniform(0, RETRY_BACKOFF * 2 ** attempt)
+
+
+def hedge_configured():
+    return HEDGE_PERCENTILE > 0 and len(router.backends) > 1
+
+
+def hedging(hedge):
+    """Whether to hedge now; until hedge_delay has its samples, hedge=True
+    posts go out alone and are timed."""
+    return hedge and hedge_configured() and hedge_delay.delay is not None
+
+
+def hedge_url(url, backend):
+    return backend.url + url[url.index('/v1/'):]
+
+
+def post_upstream(url, headers, body, stream=False, hedge=False):
+    """POST a chat request to vLLM: connect/read timeouts, retries (see
+    RETRY_MAX) and, with hedge=True, a hedged copy on a second backend.
+    Returns the requests Response; raises the last error if all attempts fail."""
+    data = encode_body(body)
+    retry_budget.deposit()
+    if hedging(hedge):
+        return post_hedged(url, headers, data)
+    sent = time.monotonic()
+    resp = post_with_retries(url, headers, data, stream)
+    if hedge and HEDGE_PERCENTILE > 0 and resp.status_code < 500:
+        hedge_delay.observe(time.monotonic() - sent)
+    return resp
 
 
+def watch_upstream(url, body):
+    """Whether post_chat reads this request from vLLM as a stream so it can
+    be cut short: tool turns under early cutoff, and, with
+    DEGENERATION_NON_STREAMING, everything else the degeneration check
+    applies to unless hedging is configured. Decided on the configuration,
+    not on hedge_delay: only unwatched posts feed it."""
+    if not url.endswith('/chat/completions'):
+        return False
+    if cutoff_enabled(body):
+        return True
+    return DEGENERATION_NON_STREAMING and degeneration_enabled(body) and not hedge_configured()
+
+
+def post_chat(url, headers, body):
+    """post_upstream for the non-streaming chat paths. A watched request
+    (see watch_upstream) goes upstream as a stream, read into a
+    StreamedCompletion; the connection is closed (and vLLM aborts the
+    sequence) as soon as the turn is over or the text degenerates.
+    Otherwise, or on an upstream error, the requests Response."""
+    if not watch_upstream(url, body):
+        return post_upstream(url, headers, body, hedge=True)
+    resp = post_upstream(url, headers, streamed_body(body), stream=True)
+    if resp.status_code != 200:
+        resp.content        # read it all, as a non-streaming request would
+        return resp
+    completion = StreamedCompletion(body)
+    chunks = resp.iter_content(chunk_size=None)
+    tap = upstream_tap(resp)
+    if tap is not None:
+        chunks = tee_chunks(chunks, tap)
+    with resp:
+        for data in iter_sse_data(chunks):
+            if not completion.feed(data):
+                break
+    return completion
+
+
+def post_with_retries(url, headers, data, stream=False):
+    for attempt in itertools.count():
+        try:
+            resp = upstream.post(url, headers=headers, data=data, stream=stream,
+                                 timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+            if client_gone() or not retry_allowed(attempt, 'error'):
+                raise
+            logger.warning(f'Upstream error, retrying: {e}')
+        else:
+            if resp.status_code not in RETRY_STATUSES or not retry_allowed(attempt, str(resp.status_code)):
+                return resp
+            resp.close()
+            logger.warning(f'Upstream answered {resp.status_code}, retrying')
+        time.sleep(retry_delay(attempt))
+
+
+class UpstreamCall:
+    """The pooled connections to vLLM that one thread has checked out for a
+    request (see upstream_call). cancel() shuts their sockets down, so a
+    blocked read fails and vLLM sees the client go away and aborts the
+    generation. Calls attached to this one (the copies of a hedged request,
+    on threads of their own) are cancelled with it."""
+
+    def __init__(self, path_type=None):
+        self.lock = threading.Lock()
+        self.conns = set()
+        self.children = []
+        self.cancelled = threading.Event()
+        self.path_type = path_type
+        self.info = request_log.get()
+
+    def checkout(self, conn):
+        with self.lock:
+            self.conns.add(conn)
+
+    def checkin(self, conn):
+        with self.lock:
+            self.conns.discard(conn)
+
+    def attach(self, call):
+        with self.lock:
+            self.children.append(call)
+            cancelled = self.cancelled.is_set()
+        if cancelled:
+            call.cancel()
+
+    def busy(self):
+        """Whether a request is in flight on one of its connections."""
+        with self.lock:
+            children = list(self.children)
+            if self.conns:
+                return True
+        return any(child.busy() for child in children)
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled.set()
+            for conn in self.conns:
+                if conn.sock is not None:
+                    try:
+                        conn.sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+            children = list(self.children)
+        for child in children:
+            child.cancel()
+
+
+class HedgedAttempt(UpstreamCall):
+    """One copy of a hedged request, on a thread of its own."""
+
+    def __init__(self, url, headers, data):
+        super().__init__()
+        self.future = concurrent.futures.Future()
+        parent = getattr(upstream_call, 'current', None)
+        if parent is not None:
+            parent.attach(self)
+        threading.Thread(target=self.run, args=(url, headers, data), daemon=True, name='hedge').start()
+
+    def run(self, url, headers, data):
+        upstream_call.current = self
+        try:
+            self.future.set_result(post_with_retries(url, headers, data))
+        except BaseException as e:
+            self.future.set_exception(e)
+        finally:
+            upstream_call.current = None
+
+
+def observe_cancelled(path_type, info=None):
+    """A generation cut off because its client hung up, counted with the
+    tokens vLLM was spared (at most: see generation_budget)."""
+    if info is None:
+        info = request_log.get() or RequestLog()
+    metrics.inc('proxy_cancelled_generations_total', path=path_type)
+    budget = generation_budget(info.body, info) if isinstance(info.body, dict) else None
+    if budget:
+        metrics.inc('proxy_cancelled_tokens_avoided_total', max(0, budget - info.tokens))
+    logger.info(f'Client disconnected: {path_type} generation cancelled after {info.tokens} tokens')
+
+
+class DisconnectWatcher:
+    """Notices Flask-engine chat clients that hang up before their response
+    is done, which Werkzeug itself only finds out on its next write (never,
+    while a request waits on prefill or a non-streaming generation). One
+    thread polls the sockets of the watched requests; when one reads as
+    closed, the request's UpstreamCall is cancelled."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}          # client socket -> UpstreamCall
+        self.thread = None
+
+    def watch(self, sock, call):
+        with self.lock:
+            self.calls[sock] = call
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True, name='disconnect-watch')
+                self.thread.start()
+
+    def unwatch(self, sock):
+        with self.lock:
+            self.calls.pop(sock, None)
+
+    @staticmethod
+    def hung_up(sock):
+        try:
+            return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+
+    def run(self):
+        events = select.POLLIN | select.POLLHUP | select.POLLERR | getattr(select, 'POLLRDHUP', 0)
+        while True:
+            with self.lock:
+                socks = {sock.fileno(): sock for sock in self.calls if sock.fileno() >= 0}
+            if not socks:
+                time.sleep(DISCONNECT_POLL_INTERVAL)
+                continue
+            poller = select.poll()
+            for fd in socks:
+                poller.register(fd, events)
+            for fd, _ in poller.poll(DISCONNECT_POLL_INTERVAL * 1000):
+                sock = socks[fd]
+                hung_up = self.hung_up(sock)
+                with self.lock:
+                    # Readable but open is a pipelined next request: stop watching, or poll would spin
+                    call = self.calls.pop(sock, None)
+                if call is not None and hung_up:
+                    if call.busy():
+                        observe_cancelled(call.path_type, call.info)
+                    call.cancel()
+
+
+disconnect_watcher = DisconnectWatcher()
+
+
+def client_gone():
+    """Whether the request on this thread was cancelled: its client hung up
+    (or, on a hedge thread, the other copy won)."""
+    call = getattr(upstream_call, 'current', None)
+    return call is not None and call.cancelled.is_set()
+
+
+def cancelled_response():
+    """What a request whose client hung up ends with; nobody receives it,
+    but 499 keeps it out of the backend's health (a forward error marks it down)."""
+    return Response(json.dumps({'error': 'client disconnected'}), status=499, mimetype='application/json')
+
+
+def forward_error(e):
+    """The proxy's own 502 for a request vLLM never answered. Only these mark
+    the backend down; a 502 relayed from upstream does not."""
+    response = Response(json.dumps({'error': str(e)}), status=502, mimetype='application/json')
+    response.forward_error = True
+    return response
+
+
+def hedge_winner(done):
+    """The first finished copy with an answer worth keeping, if any."""
+    for attempt in done:
+        if attempt.exception() is None and attempt.result().status_code < 500:
+            return attempt
+    return None
+
+
+def post_hedged(url, headers, data):
+    sent = time.monotonic()
+    primary = HedgedAttempt(url, headers, data)
+    done, _ = concurrent.futures.wait([primary.future], timeout=hedge_delay.delay)
+    backend = None if done else router.alternate(url)
+    if backend is None or not retry_budget.spend():
+        if backend is not None:
+            router.release(backend)
+        resp = primary.future.result()
+        if resp.status_code < 500:
+            hedge_delay.observe(time.monotonic() - sent)
+        return resp
+    hedge = HedgedAttempt(hedge_url(url, backend), headers, data)
+    hedge.future.add_done_callback(lambda future: router.release(backend))
+    attempts = {primary.future: primary, hedge.future: hedge}
+    pending, winner = set(attempts), None
+    while pending and winner is None:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        winner = hedge_winner(done)
+    for future in pending:
+        attempts[future].cancel()
+    if winner is None:
+        metrics.inc('proxy_upstream_hedges_total', result='neither')
+        return primary.future.result()
+    metrics.inc('proxy_upstream_hedges_total', result='primary' if winner is primary.future else 'hedge')
+    hedge_delay.observe(time.monotonic() - sent)
+    return winner.result()
+
 
 def forward_fix_and_rewrap_sse(url, headers, body):
     """Forward non-streaming, fix tool calls, then re-wrap as SSE for streaming clients."""
     try:
-        resp = requests.post(url, headers=headers, json=body, timeout=300)
+        sent = time.monotonic()
+        resp = post_chat(url, headers, body)
+        # Non-streaming: vLLM answers once generation is done, so this is connect + prefill + generation
+        t = stage('upstream', sent)
+        observe_ttfb('rewrap_sse', sent)
+        capture_upstream(resp)
         try:
-            resp_json = resp.json()
-            if body and has_tools(body):
-                extract_tools_from_content(resp_json)
-            clean_response_for_openclaw(resp_json)
-            logger.info("SSE-REWRAP: " + json.dumps({"c": str((resp_json.get("choices") or [{}])[0].get("message",{}).get("content"))[:200], "tc": len((resp_json.get("choices") or [{}])[0].get("message",{}).get("tool_calls",[])), "f": (resp_json.get("choices") or [{}])[0].get("finish_reason"), "s": resp.status_code}))
+            resp_json = completion_json(resp)
+            stage('decode', t)
+            observe_usage(resp_json.get('usage'), time.monotonic() - sent)
+            fix_response(resp_json, body)
+            log_rewrap_summary(resp_json, resp.status_code)
             return Response(
-                convert_to_sse_stream(resp_json),
+                rewrap_frames(resp_json),
                 status=200,
                 mimetype='text/event-stream',
                 headers={'Cache-Control': 'no-cache', 'Connection': 'keep-alive'}
@@ -370,85 +4318,1349 @@ def forward_fix_and_rewrap_sse(url, headers, body):
             logger.error(f'SSE rewrap parse error: {e}')
             return Response(resp.content, status=resp.status_code)
     except Exception as e:
+        if client_gone():
+            return cancelled_response()
         logger.error(f'SSE rewrap forward error: {e}')
-        return Response(json.dumps({'error': str(e)}), status=502, mimetype='application/json')
+        return forward_error(e)
+
+class InboundBody:
+    """File-like view of the client's request body. Giving it a length makes
+    requests send the client's Content-Length and pull the body through with
+    read() as it uploads, instead of reading it all into memory first."""
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+
+def inbound_body():
+    if request.content_length:
+        return InboundBody(request.stream, request.content_length)
+    if request.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+        return iter(lambda: request.stream.read(PASSTHROUGH_CHUNK), b'')
+    return None
+
+
+def relay_headers(resp_headers):
+    # Bytes are relayed undecoded, so Content-Length/Content-Encoding stay valid
+    return {k: v for k, v in resp_headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+
 
 def forward_request(url):
-    headers = {k: v for k, v in request.headers if k.lower() not in ('host', 'content-length')}
+    headers = forward_headers(request.headers)
+    if request.query_string:
+        url = f'{url}?{request.query_string.decode("latin-1")}'
     try:
-        resp = requests.request(
+        sent = time.monotonic()
+        resp = upstream.request(
             method=request.method, url=url, headers=headers,
-            data=request.get_data(), stream=True, timeout=300
+            data=inbound_body(), stream=True, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)
         )
-        excluded = {'content-encoding', 'transfer-encoding', 'content-length'}
-        resp_headers = {k: v for k, v in resp.headers.items() if k.lower() not in excluded}
-        return Response(resp.iter_content(chunk_size=1024), status=resp.status_code, headers=resp_headers)
+        stage('upstream', sent)
+        observe_ttfb('passthrough', sent)
+
+        def relay():
+            with resp:
+                yield from resp.raw.stream(PASSTHROUGH_CHUNK, decode_content=False)
+        return Response(relay(), status=resp.status_code, headers=relay_headers(resp.headers))
     except Exception as e:
         logger.error(f'Forward error: {e}')
-        return Response(json.dumps({'error': str(e)}), status=502, mimetype='application/json')
+        return forward_error(e)
+
+
+def fetch_fixed(url, headers, body):
+    """Non-streaming forward + fix for the response cache. Returns (status, payload bytes);
+    a forward error is raised, so coalesced requests fetch for themselves."""
+    sent = time.monotonic()
+    resp = post_chat(url, headers, body)
+    t = stage('upstream', sent)
+    observe_ttfb('cache', sent)
+    capture_upstream(resp)
+    try:
+        resp_json = completion_json(resp)
+    except ValueError:
+        return resp.status_code, resp.content
+    stage('decode', t)
+    observe_usage(resp_json.get('usage'), time.monotonic() - sent)
+    fix_response(resp_json, body)
+    log_response_summary(resp_json, resp.status_code)
+    return resp.status_code, encode_response(resp_json)
 
 
 def forward_with_body_and_fix(url, headers, body):
     try:
-        resp = requests.post(url, headers=headers, json=body, timeout=300)
+        sent = time.monotonic()
+        resp = post_chat(url, headers, body)
+        t = stage('upstream', sent)
+        observe_ttfb('fix', sent)
+        capture_upstream(resp)
         try:
-            resp_json = resp.json()
-            if body and has_tools(body): extract_tools_from_content(resp_json)  # Only when tools present
-            clean_response_for_openclaw(resp_json)
-            logger.info("RESPONSE: " + json.dumps({"c": str((resp_json.get("choices") or [{}])[0].get("message",{}).get("content"))[:200], "r": str((resp_json.get("choices") or [{}])[0].get("message",{}).get("reasoning",""))[:100], "f": (resp_json.get("choices") or [{}])[0].get("finish_reason"), "s": resp.status_code}))
+            resp_json = completion_json(resp)
+            stage('decode', t)
+            observe_usage(resp_json.get('usage'), time.monotonic() - sent)
+            fix_response(resp_json, body)
+            log_response_summary(resp_json, resp.status_code)
             return Response(
-                json.dumps(resp_json),
+                encode_response(resp_json),
                 status=resp.status_code,
                 mimetype='application/json'
             )
         except Exception:
             return Response(resp.content, status=resp.status_code)
     except Exception as e:
+        if client_gone():
+            return cancelled_response()
         logger.error(f'Forward error: {e}')
-        return Response(json.dumps({'error': str(e)}), status=502, mimetype='application/json')
+        return forward_error(e)
+
+
+def stream_and_extract(url, headers, body):
+    """Stream from vLLM and run the deltas through StreamingToolExtractor,
+    so text reaches the client immediately and tool calls as soon as they close."""
+    try:
+        sent = time.monotonic()
+        resp = post_upstream(url, headers, body, stream=True)
+        connected = stage('connect', sent)
+    except Exception as e:
+        if client_gone():
+            return cancelled_response()
+        logger.error(f'Stream extract forward error: {e}')
+        return forward_error(e)
+    if resp.status_code != 200:
+        # vLLM rejected the request (bad params, context overflow): relay its error as-is
+        content = resp.content
+        resp.close()
+        capture_upstream(resp)
+        return Response(content, status=resp.status_code, mimetype='application/json')
+    tap = upstream_tap(resp)
+
+    def generate():
+        extractor = StreamingToolExtractor(body)
+        first_at = None
+        chunks = resp.iter_content(chunk_size=None)
+        if tap is not None:
+            chunks = tee_chunks(chunks, tap)
+        t = connected
+        try:
+            with resp:
+                for data in iter_sse_data(chunks):
+                    got = time.monotonic()
+                    if first_at is None:
+                        first_at = got
+                        observe_ttfb('stream_extract', sent)
+                        stage('prefill', t, got)
+                    else:
+                        stage('generate', t, got)
+                    frames = extractor.process(data)
+                    stage('extract', got)
+                    yield from frames
+                    if extractor.cut:
+                        break       # closing resp makes vLLM abort the generation
+                    t = time.monotonic()
+            yield from extractor.finish()
+            extractor.observe(time.monotonic() - (first_at or sent))
+            log_stream_summary(extractor, resp.status_code)
+        except GeneratorExit:
+            # Werkzeug closes the stream when a write to the client fails; leaving resp closes the upstream
+            if not client_gone():
+                observe_cancelled('stream_extract')
+            raise
+        except Exception as e:
+            if client_gone():
+                return
+            logger.error(f'Stream extract error: {e}')
+            error_data = json.dumps({"error": str(e)})
+            yield f'data: {error_data}\n\n'
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'Connection': 'keep-alive'})
 
 
 def stream_response(url, headers, body):
     def generate():
+        info = request_log.get() or RequestLog()
         try:
-            with requests.post(url, headers=headers, json=body, stream=True, timeout=300) as resp:
+            sent = time.monotonic()
+            first_at = None
+            prev = last = b''
+            with post_upstream(url, headers, body, stream=True) as resp:
+                t = stage('connect', sent)
+                tap = upstream_tap(resp)
+                watch = DegenerationStream(body) if resp.status_code == 200 and degeneration_enabled(body) else None
                 for chunk in resp.iter_content(chunk_size=None):
                     if chunk:
-                        yield chunk
+                        got = time.monotonic()
+                        if first_at is None:
+                            first_at = got
+                            observe_ttfb('stream', sent)
+                            stage('prefill', t, got)
+                        else:
+                            stage('generate', t, got)
+                        prev, last = last, chunk
+                        info.tokens += 1
+                        if tap is not None:
+                            tap.append(chunk)
+                        if watch is None:
+                            yield chunk
+                        else:
+                            yield from watch.feed(chunk)
+                            if watch.cut:
+                                break       # closing resp makes vLLM abort the generation
+                        t = time.monotonic()
+                if watch is not None and not watch.cut:
+                    yield from watch.close()
+            # vLLM's usage chunk (stream_options.include_usage) is the last event before [DONE]
+            observe_usage(usage_from_sse_tail(prev + last), time.monotonic() - (first_at or sent))
+        except GeneratorExit:
+            if not client_gone():
+                observe_cancelled('stream')
+            raise
         except Exception as e:
+            if client_gone():
+                return
             logger.error(f'Stream error: {e}')
             error_data = json.dumps({"error": str(e)})
             yield f'data: {error_data}\n\n'
     return Response(generate(), mimetype='text/event-stream')
 
 
-@app.route('/health')
-def health():
-    return {'status': 'ok', 'vllm_url': VLLM_URL, 'version': 'v4'}
+def live_metrics():
+    """Gauges read straight from router/admission/cache state at scrape time."""
+    samples = []
+    for b in router.backends:
+        samples.append(('proxy_backend_in_flight', 'gauge', 'Requests in flight per vLLM backend',
+                        {'backend': b.url}, b.inflight))
+        samples.append(('proxy_backend_up', 'gauge', 'Whether the backend passed its last health check',
+                        {'backend': b.url}, int(b.healthy)))
+    if admission.enabled:
+        samples += [
+            ('proxy_admission_in_flight', 'gauge', 'Chat requests admitted upstream', {}, admission.inflight),
+            ('proxy_admission_queued', 'gauge', 'Chat requests waiting for admission', {}, admission.queued),
+            ('proxy_admission_limit', 'gauge', 'Current admission limit', {}, admission.limit),
+            ('proxy_admission_rejected_total', 'counter', 'Requests turned away with 429', {}, admission.rejected),
+        ]
+    if response_cache:
+        for result in ('hits', 'misses', 'coalesced'):
+            samples.append(('proxy_cache_lookups_total', 'counter', 'Response cache lookups by result',
+                            {'result': result}, getattr(response_cache, result)))
+        samples.append(('proxy_cache_bytes', 'gauge', 'Payload bytes held in the response cache',
+                        {}, response_cache.size))
+    if CONTEXT_GUARD and context_guard.tokenizer:
+        for result in ('hits', 'misses'):
+            samples.append(('proxy_token_count_cache_total', 'counter', 'Per-message token count lookups by result',
+                            {'result': result}, getattr(context_guard, result)))
+    if traffic_capture:
+        for result in ('written', 'dropped'):
+            samples.append(('proxy_capture_records_total', 'counter', 'Sampled requests written to or dropped from the capture',
+                            {'result': result}, getattr(traffic_capture, result)))
+    return samples
 
 
-@app.route('/')
-def root():
+def health_info():
+    info = {'status': 'ok', 'vllm_url': VLLM_URL, 'version': VERSION}
+    if CONFIG_FILE:
+        info['config_version'] = current_config.version
+    if WORKER_INDEX is not None:
+        info['worker'] = {'index': WORKER_INDEX, 'pid': os.getpid(), 'of': WORKERS}
+    if len(router.backends) > 1:
+        info['backends'] = router.info()
+    if admission.enabled:
+        info['admission'] = {'limit': admission.limit, 'inflight': admission.inflight,
+                             'queued': admission.queued, 'rejected': admission.rejected}
+    return info
+
+
+def service_info():
     return {
         'service': 'vLLM Tool Call Proxy ',
-        'version': 'v4',
+        'version': VERSION,
         'vllm_url': VLLM_URL,
         'features': [
             'force tool_choice=required when tools present',
             'extract tool calls from <tools> tags in content',
             'extract tool calls from bare JSON in content',
             'extract tool calls from multi-line JSON in content',
-            'force non-streaming when tools present'
+            f'tool streaming: {TOOL_STREAMING}',
+            'async ASGI engine (--engine asgi)',
+            'pooled keep-alive upstream connections (TCP or Unix socket)',
+            'repeated tool call loop detection',
+            'temperature-0 response cache with request coalescing (--cache-mb)',
+            'prefix-cache-affinity routing across backends',
+            'admission control with priority queue and 429 backpressure (--max-inflight)',
+            'Prometheus metrics on /metrics',
+            f'JSON codec: {JSON_CODEC}',
+            'unchanged chat bodies forwarded as sent, top-level edits patched into the bytes',
+            'prefix-cache warm-up of frequent agent prompts at start and backend recovery (--warmup-file)',
+            'sampled traffic capture to gzip JSONL (--capture-dir)',
+            'stale tool-result compaction (--compact-after, --compact-max-chars)',
+            'pre-fork workers with shared loop state and metrics, graceful recycling (--workers)',
+            'budgeted upstream retries, separate connect/read timeouts, hedged requests (--hedge-percentile)',
+            'hot-reloadable config file with /admin/config (--config, SIGHUP)',
+            'queued logging on a writer thread, sampled summaries (--log-sample), rate-limited SLOW log',
+            'per-stage Server-Timing header, slowest requests at /debug/slow',
+            'early upstream cutoff after a complete tool call (repeat or leaked template token)',
+            'degeneration check: rolling n-gram repetition score and leaked-token blocklist stop runaway '
+            'generations (finish_reason "degenerate")',
+            'client disconnects cancel the upstream generation, streaming or not',
+            'context-budget guard: max_tokens clamping, early overflow errors '
+            f'({"tokenizer" if context_guard.tokenizer else "length estimate"})'
         ]
     }
 
 
+def config_info():
+    config = current_config
+    return {'version': config.version, 'file': CONFIG_FILE,
+            'loaded_at': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(config.loaded_at)),
+            'settings': config.settings}
+
+
+def is_local(remote_addr):
+    return remote_addr in ('127.0.0.1', '::1')
+
+
+def admin_reload(remote_addr):
+    """(status, body) for POST /admin/config/reload."""
+    if not is_local(remote_addr):
+        return 403, {'error': 'config reload is only allowed from localhost'}
+    if not CONFIG_FILE:
+        return 400, {'error': 'no --config file to reload'}
+    ok, result = reload_config('admin')
+    if ok and WORKER_INDEX is not None:
+        os.kill(os.getppid(), signal.SIGHUP)     # the master passes it on to the other workers
+    if not ok:
+        return 400, {'error': result, 'version': current_config.version}
+    return 200, config_info()
+
+
+def debug_slow(remote_addr):
+    """(status, body) for GET /debug/slow: these include response text, so localhost only."""
+    if not is_local(remote_addr):
+        return 403, {'error': '/debug/slow is only served to localhost'}
+    info = {'window_seconds': DEBUG_SLOW_WINDOW, 'requests': slow_requests.snapshot()}
+    if WORKER_INDEX is not None:
+        info['worker'] = {'index': WORKER_INDEX, 'pid': os.getpid(), 'of': WORKERS}
+    return 200, info
+
+
+@app.route('/health')
+def health():
+    return health_info()
+
+
+@app.route('/debug/slow')
+def debug_slow_requests():
+    status, info = debug_slow(request.remote_addr)
+    return info, status
+
+
+@app.route('/admin/config')
+def admin_config():
+    return config_info()
+
+
+@app.route('/admin/config/reload', methods=['POST'])
+def admin_config_reload():
+    status, info = admin_reload(request.remote_addr)
+    return info, status
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(live_metrics()), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/')
+def root():
+    return service_info()
+
+
+# ---------------------------------------------------------------------------
+# ASGI engine (--engine asgi)
+#
+# Same routes and post-processing as the Flask app above, but upstream calls
+# are awaited on a single event loop via httpx instead of pinning one OS
+# thread per in-flight generation. Needs: pip3 install starlette uvicorn httpx
+# ---------------------------------------------------------------------------
+
+def create_asgi_app():
+    import httpx
+    from starlette.applications import Starlette
+    from starlette.background import BackgroundTask
+    from starlette.responses import JSONResponse, StreamingResponse
+    from starlette.responses import Response as AsgiResponse
+    from starlette.routing import Route
+
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    # One shared client: no per-thread limits, so hundreds of generations can
+    # be in flight at once without pool starvation.
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=POOL_SIZE,
+                          keepalive_expiry=POOL_IDLE_TIMEOUT)
+    client = httpx.AsyncClient(
+        timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+        transport=httpx.AsyncHTTPTransport(limits=limits, uds=VLLM_SOCKET),
+    )
+
+    def error_response(e):
+        response = AsgiResponse(json.dumps({'error': str(e)}), status_code=502, media_type='application/json')
+        response.forward_error = True     # see forward_error()
+        return response
+
+    async def wait_disconnect(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    async def until_disconnect(request, awaitable):
+        """Await the upstream work unless the client hangs up first; then it
+        is cancelled (httpx closes the connection, vLLM aborts) and the
+        result is None. Streams are covered once they are being sent:
+        Starlette cancels those itself when the client goes away."""
+        work = asyncio.ensure_future(awaitable)
+        hangup = asyncio.ensure_future(wait_disconnect(request.receive))
+        try:
+            await asyncio.wait({work, hangup}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            hangup.cancel()
+            if not work.done():
+                work.cancel()
+                await asyncio.wait({work})
+        if work.cancelled():
+            return None
+        return work.result()
+
+    async def post_upstream_async(url, headers, body, stream=False, hedge=False):
+        """post_upstream for the ASGI engine; returns an httpx Response."""
+        data = encode_body(body)
+        retry_budget.deposit()
+        if hedging(hedge):
+            return await post_hedged_async(url, headers, data)
+        sent = time.monotonic()
+        resp = await post_with_retries_async(url, headers, data, stream)
+        if hedge and HEDGE_PERCENTILE > 0 and resp.status_code < 500:
+            hedge_delay.observe(time.monotonic() - sent)
+        return resp
+
+    async def post_chat_async(url, headers, body):
+        """post_chat for the ASGI engine."""
+        if not watch_upstream(url, body):
+            return await post_upstream_async(url, headers, body, hedge=True)
+        resp = await post_upstream_async(url, headers, streamed_body(body), stream=True)
+        if resp.status_code != 200:
+            await resp.aread()
+            await resp.aclose()
+            return resp
+        completion = StreamedCompletion(body)
+        chunks = resp.aiter_raw()
+        tap = upstream_tap(resp)
+        if tap is not None:
+            chunks = tee_chunks_async(chunks, tap)
+        try:
+            async for data in aiter_sse_data(chunks):
+                if not completion.feed(data):
+                    break
+        finally:
+            await resp.aclose()
+        return completion
+
+    async def post_with_retries_async(url, headers, data, stream=False):
+        for attempt in itertools.count():
+            try:
+                req = client.build_request('POST', url, headers=headers, content=data)
+                resp = await client.send(req, stream=stream)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.ReadError, httpx.WriteError,
+                    httpx.RemoteProtocolError) as e:
+                if not retry_allowed(attempt, 'error'):
+                    raise
+                logger.warning(f'Upstream error, retrying: {e!r}')
+            else:
+                if resp.status_code not in RETRY_STATUSES or not retry_allowed(attempt, str(resp.status_code)):
+                    return resp
+                await resp.aclose()
+                logger.warning(f'Upstream answered {resp.status_code}, retrying')
+            await asyncio.sleep(retry_delay(attempt))
+
+    async def post_hedged_async(url, headers, data):
+        sent = time.monotonic()
+        primary = asyncio.ensure_future(post_with_retries_async(url, headers, data))
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=hedge_delay.delay)
+        except asyncio.CancelledError:
+            primary.cancel()
+            raise
+        backend = None if done else router.alternate(url)
+        if backend is None or not retry_budget.spend():
+            if backend is not None:
+                router.release(backend)
+            resp = await primary
+            if resp.status_code < 500:
+                hedge_delay.observe(time.monotonic() - sent)
+            return resp
+        hedge = asyncio.ensure_future(post_with_retries_async(hedge_url(url, backend), headers, data))
+        hedge.add_done_callback(lambda task: router.release(backend))
+        pending, winner = {primary, hedge}, None
+        try:
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = hedge_winner(done)
+        finally:
+            # Cancelling the task closes its connection; vLLM aborts the generation
+            for task in pending:
+                task.cancel()
+        if winner is None:
+            metrics.inc('proxy_upstream_hedges_total', result='neither')
+            return await primary
+        metrics.inc('proxy_upstream_hedges_total', result='primary' if winner is primary else 'hedge')
+        hedge_delay.observe(time.monotonic() - sent)
+        return winner.result()
+
+    async def fetch_fixed_async(url, headers, body):
+        sent = time.monotonic()
+        resp = await post_chat_async(url, headers, body)
+        t = stage('upstream', sent)
+        observe_ttfb('cache', sent)
+        capture_upstream(resp)
+        try:
+            resp_json = completion_json(resp)
+        except ValueError:
+            return resp.status_code, resp.content
+        stage('decode', t)
+        observe_usage(resp_json.get('usage'), time.monotonic() - sent)
+        fix_response(resp_json, body)
+        log_response_summary(resp_json, resp.status_code)
+        return resp.status_code, encode_response(resp_json)
+
+    async def forward_with_body_and_fix_async(url, headers, body):
+        try:
+            sent = time.monotonic()
+            resp = await post_chat_async(url, headers, body)
+            t = stage('upstream', sent)
+            observe_ttfb('fix', sent)
+            capture_upstream(resp)
+            try:
+                resp_json = completion_json(resp)
+                stage('decode', t)
+                observe_usage(resp_json.get('usage'), time.monotonic() - sent)
+                fix_response(resp_json, body)
+                log_response_summary(resp_json, resp.status_code)
+                return AsgiResponse(encode_response(resp_json), status_code=resp.status_code,
+                                    media_type='application/json')
+            except Exception:
+                return AsgiResponse(resp.content, status_code=resp.status_code)
+        except Exception as e:
+            logger.error(f'Forward error: {e}')
+            return error_response(e)
+
+    async def forward_fix_and_rewrap_sse_async(url, headers, body):
+        try:
+            sent = time.monotonic()
+            resp = await post_chat_async(url, headers, body)
+            t = stage('upstream', sent)
+            observe_ttfb('rewrap_sse', sent)
+            capture_upstream(resp)
+            try:
+                resp_json = completion_json(resp)
+                stage('decode', t)
+                observe_usage(resp_json.get('usage'), time.monotonic() - sent)
+                fix_response(resp_json, body)
+                log_rewrap_summary(resp_json, resp.status_code)
+                return StreamingResponse(
+                    iterate_async(rewrap_frames(resp_json)),
+                    status_code=200,
+                    media_type='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'Connection': 'keep-alive'}
+                )
+            except Exception as e:
+                logger.error(f'SSE rewrap parse error: {e}')
+                return AsgiResponse(resp.content, status_code=resp.status_code)
+        except Exception as e:
+            logger.error(f'SSE rewrap forward error: {e}')
+            return error_response(e)
+
+    def stream_response_async(url, headers, body):
+        async def generate():
+            info = request_log.get() or RequestLog()
+            try:
+                sent = time.monotonic()
+                first_at = None
+                prev = last = b''
+                resp = await post_upstream_async(url, headers, body, stream=True)
+                t = stage('connect', sent)
+                try:
+                    tap = upstream_tap(resp)
+                    watch = DegenerationStream(body) if resp.status_code == 200 and degeneration_enabled(body) else None
+                    async for chunk in resp.aiter_raw():
+                        if chunk:
+                            got = time.monotonic()
+                            if first_at is None:
+                                first_at = got
+                                observe_ttfb('stream', sent)
+                                stage('prefill', t, got)
+                            else:
+                                stage('generate', t, got)
+                            prev, last = last, chunk
+                            info.tokens += 1
+                            if tap is not None:
+                                tap.append(chunk)
+                            if watch is None:
+                                yield chunk
+                            else:
+                                for frame in watch.feed(chunk):
+                                    yield frame
+                                if watch.cut:
+                                    break
+                            t = time.monotonic()
+                    if watch is not None and not watch.cut:
+                        for frame in watch.close():
+                            yield frame
+                finally:
+                    await resp.aclose()
+                observe_usage(usage_from_sse_tail(prev + last), time.monotonic() - (first_at or sent))
+            except asyncio.CancelledError:
+                # Starlette cancels the stream when the client hangs up; aclose() above ended the upstream
+                observe_cancelled('stream', info)
+                raise
+            except Exception as e:
+                logger.error(f'Stream error: {e}')
+                error_data = json.dumps({"error": str(e)})
+                yield f'data: {error_data}\n\n'
+        return StreamingResponse(generate(), media_type='text/event-stream')
+
+    async def stream_and_extract_async(url, headers, body):
+        try:
+            sent = time.monotonic()
+            resp = await post_upstream_async(url, headers, body, stream=True)
+            connected = stage('connect', sent)
+        except Exception as e:
+            logger.error(f'Stream extract forward error: {e}')
+            return error_response(e)
+        if resp.status_code != 200:
+            content = await resp.aread()
+            await resp.aclose()
+            capture_upstream(resp)
+            return AsgiResponse(content, status_code=resp.status_code, media_type='application/json')
+        tap = upstream_tap(resp)
+
+        async def generate():
+            info = request_log.get() or RequestLog()
+            extractor = StreamingToolExtractor(body)
+            first_at = None
+            chunks = resp.aiter_raw()
+            if tap is not None:
+                chunks = tee_chunks_async(chunks, tap)
+            t = connected
+            try:
+                async for data in aiter_sse_data(chunks):
+                    got = time.monotonic()
+                    if first_at is None:
+                        first_at = got
+                        observe_ttfb('stream_extract', sent)
+                        stage('prefill', t, got)
+                    else:
+                        stage('generate', t, got)
+                    frames = extractor.process(data)
+                    stage('extract', got)
+                    for frame in frames:
+                        yield frame
+                    if extractor.cut:
+                        break
+                    t = time.monotonic()
+                for frame in extractor.finish():
+                    yield frame
+                extractor.observe(time.monotonic() - (first_at or sent))
+                log_stream_summary(extractor, resp.status_code)
+            except asyncio.CancelledError:
+                observe_cancelled('stream_extract', info)
+                raise
+            except Exception as e:
+                logger.error(f'Stream extract error: {e}')
+                error_data = json.dumps({"error": str(e)})
+                yield f'data: {error_data}\n\n'
+            finally:
+                await resp.aclose()
+        return StreamingResponse(generate(), media_type='text/event-stream',
+                                 headers={'Cache-Control': 'no-cache', 'Connection': 'keep-alive'})
+
+    async def forward_request_async(request, url):
+        headers = forward_headers(request.headers.items())
+        content = None
+        if 'content-length' in request.headers:
+            # Piped upstream as it arrives; httpx keeps our Content-Length instead of chunking
+            headers['Content-Length'] = request.headers['content-length']
+            content = request.stream()
+        elif request.headers.get('transfer-encoding', '').lower() == 'chunked':
+            content = request.stream()
+        if request.url.query:
+            url = f'{url}?{request.url.query}'
+        try:
+            sent = time.monotonic()
+            req = client.build_request(request.method, url, headers=headers, content=content)
+            resp = await client.send(req, stream=True)
+            stage('upstream', sent)
+            observe_ttfb('passthrough', sent)
+        except Exception as e:
+            logger.error(f'Forward error: {e}')
+            return error_response(e)
+
+        async def relay():
+            try:
+                async for chunk in resp.aiter_raw():
+                    yield chunk
+            finally:
+                await resp.aclose()
+        return StreamingResponse(relay(), status_code=resp.status_code, headers=relay_headers(resp.headers))
+
+    def track_async(backend, response, path_type, started, admitted=False):
+        if getattr(response, 'forward_error', False):
+            router.mark(backend, False)
+
+        def done():
+            router.release(backend)
+            if admitted:
+                admission.release(started)
+            request_finished(path_type, started, response.status_code)
+        response.background = BackgroundTask(done)
+        return response
+
+    def capture_response_async(record, response):
+        """capture_response for Starlette responses."""
+        if record is None:
+            return response
+        record.status = response.status_code
+        if hasattr(response, 'body_iterator'):
+            response.body_iterator = record.tee_async(response.body_iterator)
+        else:
+            record.sent(response.body)
+        previous = response.background
+
+        async def submit():
+            if previous:
+                await previous()
+            traffic_capture.submit(record)
+        response.background = BackgroundTask(submit)
+        return response
+
+    async def proxy_async(request):
+        request_config.set(current_config)
+        info = RequestLog()
+        request_log.set(info)
+        path = request.path_params['path']
+
+        if request.method == 'OPTIONS':
+            return AsgiResponse('', status_code=204)
+
+        if path not in ('chat/completions', 'responses'):
+            started = request_started('passthrough')
+            backend = router.pick()
+            info.backend = backend.url
+            try:
+                response = await forward_request_async(request, f'{backend.url}/v1/{path}')
+            except BaseException:
+                router.release(backend)
+                request_finished('passthrough', started, 499)
+                raise
+            return with_server_timing(track_async(backend, response, 'passthrough', started), info)
+
+        raw_body = await request.body()
+        record = traffic_capture.start(path, raw_body, request.headers) if traffic_capture else None
+        capture_record.set(record)
+        try:
+            body = json_loads(raw_body)
+        except Exception:
+            body = None
+        info.body = body
+        client_body.set(ClientBody(raw_body, body) if isinstance(body, dict) else None)
+        t = stage('parse', info.started)
+
+        loop_response, was_streaming, is_streaming = prepare_chat_body(body)
+        if loop_response:
+            if was_streaming:
+                return capture_response_async(record, StreamingResponse(
+                    iterate_async(convert_to_sse_stream(loop_response)), media_type='text/event-stream'))
+            return capture_response_async(record, AsgiResponse(json_dumps(loop_response), status_code=200,
+                                                               media_type='application/json'))
+        estimate, overflow = check_context(body)
+        if overflow:
+            return capture_response_async(record, AsgiResponse(
+                overflow, status_code=400, media_type='application/json',
+                headers={'X-Prompt-Tokens-Estimate': str(estimate)}))
+        headers = json_headers(request.headers.items())
+        if prefix_warmer is not None and path == 'chat/completions':
+            prefix_warmer.observe(body)
+
+        path_type = chat_path_type(body, was_streaming, is_streaming)
+        started = request_started(path_type)
+        if record:
+            record.path_type = path_type
+        t = stage('prepare', t)
+        try:
+            admitted = await admission.acquire_async(request_priority(request.headers, body))
+        except BaseException:
+            request_finished(path_type, started, 499)
+            raise
+        stage('queue', t)
+        if not admitted:
+            request_finished(path_type, started, 429)
+            return capture_response_async(record, AsgiResponse(
+                busy_error(), status_code=429, media_type='application/json',
+                headers={'Retry-After': str(admission.retry_after())}))
+        backend = router.pick(affinity_key(body))
+        info.backend, info.estimate = backend.url, estimate
+        if record:
+            record.backend = backend.url
+        url = f'{backend.url}/v1/{path}'
+        try:
+            dispatch = dispatch_chat_async(url, headers, body, path_type, was_streaming)
+            # A cached fetch is shared with the requests coalesced onto it, so it is never cancelled
+            if DISCONNECT_CANCEL and path_type != 'cache':
+                response = await until_disconnect(request, dispatch)
+                if response is None:
+                    observe_cancelled(path_type, info)
+                    response = AsgiResponse(json.dumps({'error': 'client disconnected'}), status_code=499,
+                                            media_type='application/json')
+            else:
+                response = await dispatch
+        except BaseException:
+            router.release(backend)
+            admission.release(None)
+            request_finished(path_type, started, 499)
+            raise
+        if estimate is not None:
+            response.headers['X-Prompt-Tokens-Estimate'] = str(estimate)
+        return capture_response_async(record, with_server_timing(
+            track_async(backend, response, path_type, started, admitted=True), info))
+
+    async def dispatch_chat_async(url, headers, body, path_type, was_streaming):
+        if path_type == 'cache':
+            try:
+                status, payload = await response_cache.get_or_fetch_async(
+                    response_cache_key(body), lambda: fetch_fixed_async(url, headers, non_streaming_body(body)))
+            except Exception as e:
+                logger.error(f'Forward error: {e}')
+                return error_response(e)
+            if status == 200 and was_streaming:
+                return StreamingResponse(iterate_async(convert_to_sse_stream(json_loads(payload))),
+                                         media_type='text/event-stream',
+                                         headers={'Cache-Control': 'no-cache', 'Connection': 'keep-alive'})
+            return AsgiResponse(payload, status_code=status, media_type='application/json')
+        if path_type == 'stream_extract':
+            return await stream_and_extract_async(url, headers, body)
+        if path_type == 'stream':
+            return stream_response_async(url, headers, body)
+        if path_type == 'rewrap_sse':
+            return await forward_fix_and_rewrap_sse_async(url, headers, body)
+        return await forward_with_body_and_fix_async(url, headers, body)
+
+    async def health_async(request):
+        return JSONResponse(health_info())
+
+    async def root_async(request):
+        return JSONResponse(service_info())
+
+    async def debug_slow_async(request):
+        status, info = debug_slow(request.client.host if request.client else None)
+        return JSONResponse(info, status_code=status)
+
+    async def admin_config_async(request):
+        return JSONResponse(config_info())
+
+    async def admin_config_reload_async(request):
+        status, info = admin_reload(request.client.host if request.client else None)
+        return JSONResponse(info, status_code=status)
+
+    async def metrics_async(request):
+        return AsgiResponse(metrics.render(live_metrics()), media_type='text/plain; version=0.0.4')
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        yield
+        await client.aclose()
+
+    return Starlette(
+        routes=[
+            Route('/v1/{path:path}', proxy_async, methods=['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS']),
+            Route('/health', health_async),
+            Route('/metrics', metrics_async),
+            Route('/admin/config', admin_config_async),
+            Route('/debug/slow', debug_slow_async),
+            Route('/admin/config/reload', admin_config_reload_async, methods=['POST']),
+            Route('/', root_async),
+        ],
+        lifespan=lifespan,
+    )
+
+
+async def iterate_async(gen):
+    """Adapt a sync generator (convert_to_sse_stream) for StreamingResponse
+    without bouncing each chunk through the threadpool."""
+    for chunk in gen:
+        yield chunk
+
+
+# ---------------------------------------------------------------------------
+# Pre-fork workers (--workers N)
+#
+# The master binds the port and forks N workers that all accept on that one
+# socket; it serves nothing itself, only replaces workers that exit. A worker
+# is retired gracefully (SIGUSR2 to the master retires all of them, and
+# --worker-max-requests retires one): it stops accepting, the master forks its
+# replacement at once, and it exits when its in-flight requests - SSE streams
+# included - are done. Admission limits, the response cache and backend health
+# are per worker; loop state and metrics are shared via WorkerPool.state_dir.
+# ---------------------------------------------------------------------------
+
+def listen_socket(host, port):
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    sock.set_inheritable(True)
+    return sock
+
+
+class WorkerPool:
+    """The master process: forks, replaces and retires workers."""
+
+    def __init__(self, size, sock, engine, start_services):
+        self.size = size
+        self.sock = sock
+        self.engine = engine
+        self.start_services = start_services
+        self.state_dir = tempfile.mkdtemp(prefix='vllm-tool-proxy-',
+                                          dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        SharedConversationStore.create(os.path.join(self.state_dir, 'conversations.sqlite'))
+        self.workers = {}          # pid -> (slot, fork time)
+        self.retiring = set()
+        self.stopping = self.stop_sent = self.recycle = False
+        # Workers write their pid here when they stop accepting
+        self.notify_r, self.notify_w = os.pipe()
+
+    def spawn(self, slot):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                os.close(self.notify_r)
+                for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGUSR2):
+                    signal.signal(sig, signal.SIG_DFL)
+                signal.signal(signal.SIGHUP, reload_config_soon)
+                Worker(slot, self.notify_w).run(self.sock, self.engine, self.state_dir, self.start_services)
+                code = 0
+            except BaseException:
+                logger.exception(f'Worker {slot} failed')
+            finally:
+                stop_log_writer()
+                os._exit(code)
+        self.workers[pid] = (slot, time.monotonic())
+        logger.info(f'Worker {slot} started (pid {pid})')
+
+    def retire(self, pid):
+        """A worker stopped accepting: fork its replacement now, not when it exits."""
+        if pid in self.workers and pid not in self.retiring:
+            self.retiring.add(pid)
+            if not self.stopping:
+                self.spawn(self.workers[pid][0])
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            slot, forked = self.workers.pop(pid, (None, 0))
+            retire_worker_metrics(self.state_dir, pid)
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                logger.info(f'Worker {slot} (pid {pid}) retired')
+            elif not self.stopping and slot is not None:
+                logger.warning(f'Worker {slot} (pid {pid}) exited unexpectedly (status {status}), restarting')
+                if time.monotonic() - forked < 5:
+                    time.sleep(1)    # crash loop: don't fork as fast as we can
+                self.spawn(slot)
+
+    def run(self):
+        def stop(signum, frame):
+            self.stopping = True
+
+        def recycle(signum, frame):
+            self.recycle = True
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGUSR2, recycle)
+        # Each worker reloads --config itself
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.signal_workers(self.workers, signal.SIGHUP))
+        for slot in range(self.size):
+            self.spawn(slot)
+        pending = b''
+        try:
+            while self.workers:
+                if self.stopping and not self.stop_sent:
+                    logger.info(f'Stopping {len(self.workers)} worker(s) after their in-flight requests')
+                    self.signal_workers(self.workers)
+                    self.stop_sent = True
+                if self.recycle and not self.stopping:
+                    self.recycle = False
+                    logger.info('Recycling all workers')
+                    self.signal_workers([pid for pid in self.workers if pid not in self.retiring])
+                if select.select([self.notify_r], [], [], 0.5)[0]:
+                    *lines, pending = (pending + os.read(self.notify_r, 4096)).split(b'\n')
+                    for line in lines:
+                        self.retire(int(line))
+                self.reap()
+        finally:
+            shutil.rmtree(self.state_dir, ignore_errors=True)
+
+    @staticmethod
+    def signal_workers(pids, sig=signal.SIGTERM):
+        for pid in list(pids):
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+
+class Worker:
+    """A forked worker's side of WorkerPool."""
+
+    def __init__(self, slot, notify_fd):
+        self.slot = slot
+        self.notify_fd = notify_fd
+        self.master = os.getppid()
+        self.retiring = threading.Event()
+        self.stop_accepting = None
+        # Jitter so workers forked together are not all recycled at once
+        self.max_requests = WORKER_MAX_REQUESTS + random.randint(0, WORKER_MAX_REQUESTS // 10)
+
+    def run(self, sock, engine, state_dir, start_services):
+        global WORKER_INDEX, conversations
+        WORKER_INDEX = self.slot
+        os.setpgid(0, 0)    # Ctrl-C in a terminal reaches only the master, which retires us
+        for handler in logging.getLogger().handlers:
+            handler.setFormatter(logging.Formatter(f'%(asctime)s %(levelname)s [w{self.slot}]: %(message)s'))
+        conversations = SharedConversationStore(os.path.join(state_dir, 'conversations.sqlite'))
+        start_services()
+        metrics.share(state_dir, self.slot, live_metrics)
+        threading.Thread(target=self.watch_master, daemon=True, name='watch-master').start()
+        try:
+            if engine == 'asgi':
+                self.serve_asgi(sock)
+            else:
+                self.serve_flask(sock)
+        finally:
+            if traffic_capture:
+                traffic_capture.close()
+            if prefix_warmer is not None:
+                prefix_warmer.save()
+            metrics.publish()
+
+    def retire(self):
+        """Stop accepting and have the master fork a replacement; runs once."""
+        if self.retiring.is_set():
+            return
+        self.retiring.set()
+        logger.info('Retiring: no new connections, finishing in-flight requests')
+        try:
+            os.write(self.notify_fd, f'{os.getpid()}\n'.encode())
+        except OSError:
+            pass
+        self.stop_accepting()
+
+    def retire_soon(self, *args):
+        # From signal handlers and request threads: retire() logs and may block
+        threading.Thread(target=self.retire, daemon=True).start()
+
+    def watch_master(self):
+        while not self.retiring.wait(1.0):
+            if os.getppid() != self.master:
+                logger.warning('Master process is gone')
+                self.retire()
+
+    def serve_flask(self, sock):
+        from werkzeug.serving import make_server
+        host, port = sock.getsockname()[:2]
+        server = make_server(host, port, app, threaded=True, fd=sock.fileno())
+        sock.close()
+        # Count connections from accept() until the handler thread is done
+        # with them; werkzeug writes the whole response (a stream included)
+        # before that, and closes the connection after one request
+        idle = threading.Condition()
+        active = served = 0
+        process_request, shutdown_request = server.process_request, server.shutdown_request
+
+        def counted_process_request(request, client_address):
+            nonlocal active, served
+            with idle:
+                active += 1
+                served += 1
+                if served == self.max_requests:
+                    self.retire_soon()
+            process_request(request, client_address)
+
+        def counted_shutdown_request(request):
+            nonlocal active
+            try:
+                shutdown_request(request)
+            finally:
+                with idle:
+                    active -= 1
+                    idle.notify_all()
+
+        server.process_request = counted_process_request
+        server.shutdown_request = counted_shutdown_request
+        self.stop_accepting = lambda: threading.Thread(target=server.shutdown, daemon=True).start()
+        signal.signal(signal.SIGTERM, self.retire_soon)
+        signal.signal(signal.SIGINT, self.retire_soon)
+        server.serve_forever()
+        server.server_close()
+        deadline = time.monotonic() + WORKER_DRAIN_TIMEOUT
+        with idle:
+            while active:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning(f'Drain timeout: cutting off {active} request(s)')
+                    break
+                idle.wait(remaining)
+
+    def serve_asgi(self, sock):
+        import uvicorn
+        worker = self
+
+        class WorkerServer(uvicorn.Server):
+            async def on_tick(self, counter):
+                should_exit = await super().on_tick(counter)
+                if should_exit:
+                    worker.retire()
+                return should_exit
+
+        server = WorkerServer(uvicorn.Config(create_asgi_app(), log_level='info', log_config=None,
+                                             limit_max_requests=self.max_requests or None,
+                                             timeout_graceful_shutdown=WORKER_DRAIN_TIMEOUT))
+        self.stop_accepting = lambda: setattr(server, 'should_exit', True)
+        # uvicorn re-raises the signal that stopped it once it has drained;
+        # make that a no-op so we still flush capture and metrics on the way out
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda signum, frame: None)
+        server.run(sockets=[sock])
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--port', type=int, default=8003)
-    parser.add_argument('--vllm-url', type=str, default='http://localhost:8000')
+    parser.add_argument('--vllm-url', type=str, default='http://localhost:8000',
+                        help='vLLM base URL; comma-separate several to route across backends')
+    parser.add_argument('--backend-max-inflight', type=int, default=BACKEND_MAX_INFLIGHT,
+                        help='in-flight requests at which a sticky backend spills over to the least loaded one')
     parser.add_argument('--host', type=str, default='0.0.0.0')
+    parser.add_argument('--engine', choices=['flask', 'asgi'], default='flask',
+                        help='flask: threaded WSGI (default). asgi: async event loop via uvicorn')
+    parser.add_argument('--tool-streaming', choices=['incremental', 'rewrap'], default=TOOL_STREAMING,
+                        help='streaming requests with tools: extract tool calls on the fly (incremental) '
+                             'or force stream=false and re-wrap the fixed response as SSE (rewrap)')
+    parser.add_argument('--loop-repeat-limit', type=int, default=LOOP_REPEAT_LIMIT,
+                        help='abort when the same tool call is made this many times in a row')
+    parser.add_argument('--max-inflight', type=int, default=ADMISSION_MAX_INFLIGHT,
+                        help='max chat requests in flight to vLLM; extra ones queue by priority (0 = unlimited)')
+    parser.add_argument('--max-queue', type=int, default=ADMISSION_MAX_QUEUE,
+                        help='requests allowed to wait for a slot before failing fast with 429')
+    parser.add_argument('--background-models', type=str, default='',
+                        help='comma-separated model names always queued as background priority')
+    parser.add_argument('--adaptive-inflight', action='store_true',
+                        help="shrink/grow --max-inflight from vLLM's /metrics queue depth")
+    parser.add_argument('--cache-mb', type=float, default=CACHE_MAX_MB,
+                        help='enable the temperature-0 response cache with this many MB of payloads (0 = off)')
+    parser.add_argument('--cache-ttl', type=float, default=CACHE_TTL,
+                        help='seconds a cached response stays valid')
+    parser.add_argument('--json-codec', choices=['auto', 'orjson', 'stdlib'], default='auto',
+                        help='JSON library for bodies and SSE frames (auto = orjson if installed)')
+    parser.add_argument('--compact-after', type=int, default=COMPACT_AFTER_TURNS,
+                        help='replace tool results this many assistant turns old with a short marker (0 = off)')
+    parser.add_argument('--compact-max-chars', type=int, default=COMPACT_MAX_CHARS,
+                        help='cut tool results the model has already seen down to this many chars, head and tail (0 = off)')
+    parser.add_argument('--compact-step', type=int, default=COMPACT_STEP,
+                        help='turns the --compact-after cutoff advances at a time (higher = fewer prefix-cache misses)')
+    parser.add_argument('--context-window', type=int, default=CONTEXT_WINDOW,
+                        help="context length in tokens for the budget guard (0 = vLLM's max_model_len)")
+    parser.add_argument('--tokenizer', type=str, default=None,
+                        help='tokenizer.json, model directory or HF model id for exact prompt counts '
+                             '(needs pip3 install tokenizers; default: length estimate)')
+    parser.add_argument('--no-context-guard', action='store_true',
+                        help='do not estimate prompt size, clamp max_tokens or refuse oversized requests')
+    parser.add_argument('--capture-dir', type=str, default=None,
+                        help='record sampled chat requests, upstream replies and timings here (for proxy-replay.py)')
+    parser.add_argument('--capture-sample', type=float, default=CAPTURE_SAMPLE,
+                        help='fraction of chat requests to capture')
+    parser.add_argument('--capture-file-mb', type=float, default=CAPTURE_FILE_MB,
+                        help='start a new capture file after this many compressed MB')
+    parser.add_argument('--capture-keep', type=int, default=CAPTURE_KEEP,
+                        help='capture files kept; older ones are deleted (0 = keep all)')
+    parser.add_argument('--log-sample', type=str, default='',
+                        help='fraction of per-request summary lines logged: one rate for all, or EVENT=RATE,... '
+                             'with events RESPONSE, SSE-REWRAP, STREAM-EXTRACT (e.g. RESPONSE=0.1,STREAM-EXTRACT=0.05)')
+    parser.add_argument('--slow-log-seconds', type=float, default=SLOW_LOG_SECONDS,
+                        help='always log requests slower than this in full, as SLOW lines (0 = off)')
+    parser.add_argument('--slow-log-per-minute', type=int, default=SLOW_LOG_PER_MINUTE,
+                        help='at most this many SLOW lines a minute per process')
+    parser.add_argument('--no-early-cutoff', action='store_true',
+                        help='let tool turns run to the end instead of stopping vLLM once a complete call '
+                             'is followed by a repeat or a leaked chat-template token')
+    parser.add_argument('--cutoff-tokens', type=str, default=','.join(CUTOFF_TOKENS),
+                        help='comma-separated chat-template tokens that end a tool turn when they leak into the text '
+                             '(and any generation, under the degeneration check)')
+    parser.add_argument('--degeneration-window', type=int, default=DEGENERATION_WINDOW,
+                        help='token n-grams scored for repetition per generation; stop vLLM when too many repeat')
+    parser.add_argument('--degeneration-ngram', type=int, default=DEGENERATION_NGRAM,
+                        help='tokens per n-gram for the degeneration check')
+    parser.add_argument('--degeneration-threshold', type=float, default=DEGENERATION_THRESHOLD,
+                        help='fraction of the window that must be repeated n-grams to stop the generation (0-1]')
+    parser.add_argument('--degeneration-non-streaming', action='store_true',
+                        help='also check non-streaming requests without tools, by reading them from vLLM as a stream')
+    parser.add_argument('--no-degeneration-check', action='store_true',
+                        help='let generations run to the end instead of stopping vLLM on a repetition loop '
+                             'or a leaked chat-template token')
+    parser.add_argument('--warmup-file', type=str, default=None,
+                        help='remember the most used agent prompts (system messages and tools) in this file and '
+                             'prefill them into vLLM at start and when a backend comes back up')
+    parser.add_argument('--warmup-prefixes', type=int, default=WARMUP_PREFIXES,
+                        help='prompt prefixes kept in --warmup-file and replayed')
+    parser.add_argument('--warmup-interval', type=float, default=WARMUP_INTERVAL,
+                        help='seconds between warm-up requests to a backend')
+    parser.add_argument('--no-disconnect-cancel', action='store_true',
+                        help='let vLLM finish generations whose client has hung up instead of closing the upstream request')
+    parser.add_argument('--no-server-timing', action='store_true',
+                        help='do not send the per-stage Server-Timing header')
+    parser.add_argument('--debug-slow-size', type=int, default=DEBUG_SLOW_SIZE,
+                        help='slowest requests (of the last hour) kept with stage timings for GET /debug/slow (0 = off)')
+    parser.add_argument('--config', type=str, default=None,
+                        help='JSON file overriding vllm_url, max_tool_calls, loop_repeat_limit, backend_max_inflight, '
+                             'tool_tag and strip_fields; reloaded on SIGHUP or when it changes')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='worker processes accepting on the port (pre-fork); loop-detector state '
+                             'and metrics are shared, --max-inflight/--max-queue are split between them')
+    parser.add_argument('--worker-max-requests', type=int, default=WORKER_MAX_REQUESTS,
+                        help='retire a worker gracefully after about this many requests (0 = never)')
+    parser.add_argument('--worker-drain-timeout', type=float, default=WORKER_DRAIN_TIMEOUT,
+                        help='seconds a retiring worker waits for in-flight requests and streams')
+    parser.add_argument('--connect-timeout', type=float, default=CONNECT_TIMEOUT,
+                        help='seconds to open a connection to vLLM')
+    parser.add_argument('--read-timeout', type=float, default=READ_TIMEOUT,
+                        help='seconds vLLM may stay silent (prefill included) before the request fails')
+    parser.add_argument('--retries', type=int, default=RETRY_MAX,
+                        help='times a chat request is resent after a connection error or 502/503/504')
+    parser.add_argument('--retry-budget', type=float, default=RETRY_BUDGET,
+                        help='retries plus hedges allowed as a fraction of requests')
+    parser.add_argument('--hedge-percentile', type=float, default=HEDGE_PERCENTILE,
+                        help='with several backends, duplicate a non-streaming request to a second one when '
+                             'the first is slower than this latency percentile, e.g. 95 (0 = off)')
+    parser.add_argument('--pool-size', type=int, default=POOL_SIZE,
+                        help='max idle keep-alive connections kept to vLLM')
+    parser.add_argument('--pool-idle-timeout', type=float, default=POOL_IDLE_TIMEOUT,
+                        help="seconds before an idle upstream connection is dropped (keep below vLLM's keep-alive)")
+    parser.add_argument('--vllm-socket', type=str, default=None,
+                        help='connect to vLLM over this Unix socket (vllm serve --uds) instead of TCP')
     args = parser.parse_args()
-    VLLM_URL = args.vllm_url
-    logger.info(f'Starting vLLM Tool Call Proxy v4 on {args.host}:{args.port} -> {VLLM_URL}')
-    app.run(host=args.host, port=args.port, threaded=True)
+    VLLM_URLS = [u.strip() for u in args.vllm_url.split(',') if u.strip()]
+    BACKEND_MAX_INFLIGHT = args.backend_max_inflight
+    LOOP_REPEAT_LIMIT = args.loop_repeat_limit
+    CONFIG_FILE = args.config
+    try:
+        current_config = load_config(CONFIG_FILE) if CONFIG_FILE else ProxyConfig(base_settings(), 'cli')
+    except (OSError, ValueError) as e:
+        raise SystemExit(f'--config {CONFIG_FILE}: {e}')
+    VLLM_URL = current_config.backends[0]
+    WORKERS = max(1, args.workers)
+    WORKER_MAX_REQUESTS = args.worker_max_requests
+    WORKER_DRAIN_TIMEOUT = args.worker_drain_timeout
+    router = BackendRouter(current_config.backends)
+    BACKGROUND_MODELS = {m.strip() for m in args.background_models.split(',') if m.strip()}
+    admission = AdmissionController(math.ceil(args.max_inflight / WORKERS), math.ceil(args.max_queue / WORKERS),
+                                    ADMISSION_QUEUE_TIMEOUT)
+    TOOL_STREAMING = args.tool_streaming
+    if args.cache_mb > 0:
+        response_cache = ResponseCache(int(args.cache_mb * 1024 * 1024), args.cache_ttl)
+    configure_upstream(args.pool_size, args.pool_idle_timeout, args.vllm_socket)
+    CONNECT_TIMEOUT = args.connect_timeout
+    READ_TIMEOUT = args.read_timeout
+    RETRY_MAX = args.retries
+    retry_budget = RetryBudget(args.retry_budget, RETRY_BUDGET_RESERVE)
+    HEDGE_PERCENTILE = args.hedge_percentile
+    configure_json(args.json_codec)
+    COMPACT_AFTER_TURNS = args.compact_after
+    COMPACT_MAX_CHARS = args.compact_max_chars
+    COMPACT_STEP = max(1, args.compact_step)
+    CONTEXT_GUARD = not args.no_context_guard
+    for item in filter(None, (part.strip() for part in args.log_sample.split(','))):
+        event, _, rate = item.rpartition('=')
+        try:
+            LOG_SAMPLE[event.upper() or '*'] = min(1.0, max(0.0, float(rate)))
+        except ValueError:
+            parser.error(f'--log-sample: bad rate in {item!r}')
+    SLOW_LOG_SECONDS = args.slow_log_seconds
+    SLOW_LOG_PER_MINUTE = max(1, args.slow_log_per_minute)
+    SERVER_TIMING = not args.no_server_timing
+    EARLY_CUTOFF = not args.no_early_cutoff
+    configure_cutoff_tokens([t.strip() for t in args.cutoff_tokens.split(',')])
+    DISCONNECT_CANCEL = not args.no_disconnect_cancel
+    WARMUP_FILE = args.warmup_file
+    WARMUP_PREFIXES = max(1, args.warmup_prefixes)
+    WARMUP_INTERVAL = max(0.0, args.warmup_interval)
+    for flag, value in (('--degeneration-window', args.degeneration_window),
+                        ('--degeneration-ngram', args.degeneration_ngram)):
+        if value < 1:
+            parser.error(f'{flag}: expected a positive integer')
+    if not 0 < args.degeneration_threshold <= 1:
+        parser.error('--degeneration-threshold: expected a fraction above 0 and at most 1')
+    DEGENERATION_CHECK = not args.no_degeneration_check
+    DEGENERATION_NON_STREAMING = args.degeneration_non_streaming
+    DEGENERATION_WINDOW = args.degeneration_window
+    DEGENERATION_NGRAM = args.degeneration_ngram
+    DEGENERATION_THRESHOLD = args.degeneration_threshold
+    DEBUG_SLOW_SIZE = max(0, args.debug_slow_size)
+
+    def start_services():
+        """Background threads, and the tokenizer: nothing here may cross a fork,
+        so with --workers each worker calls this after it is forked."""
+        global context_guard, traffic_capture, prefix_warmer
+        start_log_writer()
+        # With --workers only worker 0 keeps the file and sends the warm-ups
+        if WARMUP_FILE and WORKER_INDEX in (None, 0):
+            prefix_warmer = PrefixWarmer(WARMUP_FILE)
+            atexit.register(prefix_warmer.save)
+        router.start_health_checks()
+        start_config_watch()
+        if admission.enabled and args.adaptive_inflight:
+            admission.start_adaptive()
+        if CONTEXT_GUARD:
+            context_guard = ContextGuard(args.context_window, load_tokenizer(args.tokenizer) if args.tokenizer else None)
+            context_guard.start()
+        if args.capture_dir:
+            traffic_capture = TrafficCapture(args.capture_dir, args.capture_sample,
+                                             int(args.capture_file_mb * 1024 * 1024), args.capture_keep)
+            atexit.register(traffic_capture.close)
+        if prefix_warmer is not None:
+            prefix_warmer.start()
+
+    logger.info(f'Starting vLLM Tool Call Proxy {VERSION} ({args.engine}'
+                f'{f", {WORKERS} workers" if WORKERS > 1 else ""}) on {args.host}:{args.port} -> {", ".join(current_config.backends)}'
+                f'{f" (config {current_config.version})" if CONFIG_FILE else ""}')
+    if WORKERS > 1:
+        WorkerPool(WORKERS, listen_socket(args.host, args.port), args.engine, start_services).run()
+        sys.exit(0)
+    start_services()
+    signal.signal(signal.SIGHUP, reload_config_soon)
+    # start-proxy.sh stops us with SIGTERM; exit normally so queued log lines are
+    # written and the last capture file gets its gzip trailer
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if args.engine == 'asgi':
+        import uvicorn
+        # log_config=None: uvicorn's loggers go through ours (and its writer thread)
+        uvicorn.run(create_asgi_app(), host=args.host, port=args.port, log_level='info', log_config=None)
+    else:
+        app.run(host=args.host, port=args.port, threaded=True)